@@ -9,9 +9,10 @@ import numpy as np
 from itertools import product
 
 from utils.utils_synthesized import *
+from .batched_act import BatchedActMixin
 
 
-class DQN_synthesized(object):
+class DQN_synthesized(BatchedActMixin):
 
     def __init__(self, conf, action_size, state_size, device):
         self.num_qubits = conf['env']['num_qubits']
@@ -46,6 +47,7 @@ class DQN_synthesized(object):
 
         self.state_size = self.state_size + 1 if conf['agent']['en_state'] else self.state_size
         self.state_size = self.state_size + 1 if ("threshold_in_state" in conf['agent'].keys() and conf['agent']["threshold_in_state"]) else self.state_size
+        self.state_size = self.state_size + 1 if "ham_models" in conf['problem'].keys() else self.state_size
         # print('---------------')
         # print(self.state_size)
         # print('---------------')
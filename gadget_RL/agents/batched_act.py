@@ -0,0 +1,37 @@
+"""
+Actions for N states at once, for the lockstep training loop (utils/lockstep.py).
+
+BatchedActMixin gives an agent with a policy_net, an epsilon and an
+action_size the method act_batch(states, ill_actions): the epsilon-greedy
+choice of act for every row of states [N, state], with one forward pass of
+the policy net for the greedy rows. The DQN agents of this package use it.
+
+act_batch(agent, states, ill_actions) calls agent.act_batch, and falls back
+to one agent.act per row for agents without it.
+"""
+import torch
+
+
+class BatchedActMixin:
+    def act_batch(self, states, ill_actions):
+        """ act for every row of states [N, state], with one forward pass of the policy net. """
+        greedy = [torch.rand(1).item() > self.epsilon for _ in ill_actions]
+        actions = [None] * len(ill_actions)
+        if any(greedy):
+            act_values = self.policy_net.forward(states)
+        for i, ill_action in enumerate(ill_actions):
+            if greedy[i]:
+                act_values[i][ill_action] = float('-inf')
+                actions[i] = (torch.argmax(act_values[i]).item(), False)
+            else:
+                rand_ac = torch.randint(self.action_size, (1,)).item()
+                while rand_ac in ill_action:
+                    rand_ac = torch.randint(self.action_size, (1,)).item()
+                actions[i] = (rand_ac, True)
+        return actions
+
+
+def act_batch(agent, states, ill_actions):
+    if hasattr(agent, 'act_batch'):
+        return agent.act_batch(states, ill_actions)
+    return [agent.act(state, ill_action) for state, ill_action in zip(states, ill_actions)]
@@ -3,50 +3,38 @@ from utils.synthesized_gates import *
 import numpy as np
 from qiskit import QuantumCircuit
 from qiskit.quantum_info import Statevector
+from environments.VQEs.simulator import (OpTape, GateGroup, compile_tape, one_qubit_groups, one_hot_positions, state_array,
+                                         expectation, get_energy_tape, get_exp_val_tape, get_family_energies)
+from environments.VQEs.optimizers import optimize, incremental_optimize
+from environments.VQEs.canonical import canonicalize
+from environments.VQEs.noise import get_noise_model
+from environments.VQEs.shots import ShotEstimator
+from environments.VQEs.mps import set_mps_options
+from environments.VQEs.clifford import set_clifford_options
 
 
 
 
 
 class Parametric_Circuit:
-    def __init__(self,n_qubits,noise_models = [],noise_values = []):
+    def __init__(self,n_qubits,noise_models = [],noise_values = [], simulator = 'qiskit', noise_options = {}):
         self.n_qubits = n_qubits
-        self.ansatz = QuantumCircuit(n_qubits)
-
-    def construct_ansatz(self, state):
-        # print('--------------')
-        # print(state[:3])
-        
-        for _, local_state in enumerate(state):
-            
-            thetas = local_state[self.n_qubits+3:]
-            rot_pos = (local_state[self.n_qubits: self.n_qubits+3] == 1).nonzero( as_tuple = True )
-            cnot_pos = (local_state[:self.n_qubits] == 1).nonzero( as_tuple = True )
-            
-            targ = cnot_pos[0]
-            ctrl = cnot_pos[1]
-
-            if len(ctrl) != 0:
-                for r in range(len(ctrl)):
-                    self.ansatz.cx([ctrl[r].item()], [targ[r].item()])
-            
-            rot_direction_list = rot_pos[0]
-            rot_qubit_list = rot_pos[1]
-            if len(rot_qubit_list) != 0:
-                for pos, r in enumerate(rot_direction_list):
-                    rot_qubit = rot_qubit_list[pos]
-                    if r == 0:
-                        self.ansatz.rx(thetas[0][rot_qubit].item(), rot_qubit.item())
-                    elif r == 1:
-                        self.ansatz.ry(thetas[1][rot_qubit].item(), rot_qubit.item())
-                    elif r == 2:
-                        self.ansatz.rz(thetas[2][rot_qubit].item(), rot_qubit.item())
-                    else:
-                        print(f'rot-axis = {r} is in invalid')
-                        assert r >2                       
+        self.simulator = simulator
+        self.noise = get_noise_model(noise_models, noise_values, **noise_options)
+        self.ansatz = OpTape(n_qubits, simulator, self.noise)
+
+    def construct_ansatz(self, state, gates = None):
+        """ Compiles the whole state into an OpTape: per layer the CX, then RX, RY, RZ. """
+        state = state_array(state)
+        thetas = state[:, self.n_qubits+3:]
+        layer, targ, ctrl = one_hot_positions(state, 0, self.n_qubits, gates)
+        groups = [GateGroup('cx', layer, np.column_stack((ctrl, targ)))]
+        groups += one_qubit_groups(one_hot_positions(state, self.n_qubits, self.n_qubits+3, gates),
+                                   ['rx', 'ry', 'rz'], thetas, {'rx': 0, 'ry': 1, 'rz': 2})
+        self.ansatz = compile_tape(self.n_qubits, groups, self.simulator, noise = self.noise)
         return self.ansatz
-    
-    def construct_ansatz_decomposed(self, state):
+
+    def construct_ansatz_decomposed(self, state, gates = None):
         """
         THE PREVIOUS ENCODING
 
@@ -74,59 +62,22 @@ class Parametric_Circuit:
         [0., 0.], - The RZCZ (angle)
         [0., 0.], - The RZ (angle)
 
+        The whole state is compiled into an OpTape at once; within a layer
+        the gates are applied as CZ, RZCZ, then SX, X, RZ.
         """
-        
-        for _, local_state in enumerate(state):
-            
-            thetas = local_state[self.n_qubits+3+self.n_qubits:]
-            """
-            OLDS!
-
-            rot_pos = (local_state[2*self.n_qubits: 2*self.n_qubits+3] == 1).nonzero( as_tuple = True )
-            rzcz_pos = (local_state[:self.n_qubits] == 1).nonzero( as_tuple = True )
-            cz_pos = (local_state[self.n_qubits:2*self.n_qubits] == 1).nonzero( as_tuple = True )
-            """
-
-            # mod cz position extraction!
-            cz_pos = np.where(local_state[0:self.n_qubits] == 1)
-            # rotation position extration
-            one_gate_pos = np.where(local_state[self.n_qubits: self.n_qubits+3] == 1)
-            # mod rzcz extration
-            rzcz_pos = np.where(local_state[self.n_qubits+3: self.n_qubits+3+self.n_qubits] == 1)
-            
-            # print(rot_pos, 'this!!!')
-            # print('RZCZ POS')
-            # print(rzcz_pos)
-            # print('CZ POS')
-            # print(cz_pos)
-
-            targ_cz = cz_pos[0]
-            ctrl_cz = cz_pos[1]
-            if len(ctrl_cz) != 0:
-                for r in range(len(ctrl_cz)):
-                    self.ansatz.cz([ctrl_cz[r].item()], [targ_cz[r].item()])
-            
-            targ_rzcz = rzcz_pos[0]
-            ctrl_rzcz = rzcz_pos[1]
-
-            if len(ctrl_rzcz) != 0:
-                for r in range(len(ctrl_rzcz)):
-                    self.ansatz.append(rzcz(thetas[targ_rzcz[r].item()+1][targ_rzcz[r].item()].item(), ctrl=ctrl_rzcz[r].item(), targ=targ_rzcz[r].item()), [ctrl_rzcz[r].item(), targ_rzcz[r].item()])
-
-            rot_direction_list = one_gate_pos[0]
-            rot_qubit_list = one_gate_pos[1]
-            if len(rot_qubit_list) != 0:
-                for pos, r in enumerate(rot_direction_list):
-                    rot_qubit = rot_qubit_list[pos]
-                    if r == 0:
-                        self.ansatz.sx(rot_qubit.item())
-                    elif r == 1:
-                        self.ansatz.x(rot_qubit.item())
-                    elif r == 2:
-                        self.ansatz.rz(thetas[0][rot_qubit].item(), rot_qubit.item())
-                    else:
-                        print(f'rot-axis = {r} is in invalid')
-                        assert r >2                       
+        n = self.n_qubits
+        state = state_array(state)
+        thetas = state[:, n+3+n:]
+        # cz, one-qubit gate and rzcz positions of all layers at once
+        cz_pos = one_hot_positions(state, 0, n, gates)
+        one_gate_pos = one_hot_positions(state, n, n+3, gates)
+        layer, targ, ctrl = one_hot_positions(state, n+3, n+3+n, gates)
+
+        groups = [GateGroup('cz', cz_pos[0], np.column_stack((cz_pos[2], cz_pos[1]))),
+                  GateGroup('rzcz', layer, np.column_stack((ctrl, targ)),
+                            thetas[layer, targ+1, ctrl], np.column_stack((targ+1, ctrl)))]
+        groups += one_qubit_groups(one_gate_pos, ['sx', 'x', 'rz'], thetas, {'rz': 0})
+        self.ansatz = compile_tape(n, groups, self.simulator, noise = self.noise)
         return self.ansatz
 
 
@@ -139,7 +90,7 @@ def get_energy_qiskit(angles, observable,circuit, n_qubits, n_shots,
     Input:
     angles                [array]      : list of trial angles for ansatz
     observable            [Observable] : Qulacs observable (Hamiltonian)
-    circuit               [circuit]    : ansatz circuit
+    circuit               [OpTape]     : compiled ansatz circuit
     n_qubits              [int]        : number of qubits
     energy_shift          [float]      : energy shift for Qiskit Hamiltonian after freezing+removing orbitals
     n_shots               [int]        : Statistical noise, number of samples taken from QC
@@ -149,24 +100,7 @@ def get_energy_qiskit(angles, observable,circuit, n_qubits, n_shots,
     expval [float] : expectation value 
     
     """
-    # print(angles)
-    # print(circuit, 'before')
-
-    no = 0
-    for i in circuit:
-        gate_detail = list(i)[0]
-        # print(gate_detail.name)
-        if gate_detail.name in ['rx', 'ry', 'rz', 'rzcz01', 'rzcz10']:
-            list(i)[0].params = [angles[no]]
-            no+=1
-    # print(circuit, 'after')
-    # print('-x-x-x-x-x-')
-    # print()
-    
-    state = np.asmatrix(Statevector.from_instruction(circuit))
-    energy = (state @ observable) @ state.getH()
-
-    return float(energy.real)#[0][0]
+    return get_energy_tape(angles, observable, circuit)
 
 def get_shot_noise(weights, n_shots):
     
@@ -175,10 +109,12 @@ def get_shot_noise(weights, n_shots):
 
 
 def get_exp_val(n_qubits,circuit,op, phys_noise = False, err_mitig = 0):
-            
-    state = np.asmatrix(Statevector.from_instruction(circuit))
+    
+    if isinstance(circuit, OpTape):
+        return get_exp_val_tape(circuit, op)
+    state = Statevector.from_instruction(circuit).data
     # print(state.shape)
-    energy = (state @ op) @ state.getH()
+    energy = expectation(state, op)
 
     return float(energy.real)
 
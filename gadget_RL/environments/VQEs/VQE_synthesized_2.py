@@ -6,47 +6,36 @@ from typing import List, Callable, Optional, Dict
 from scipy.optimize import OptimizeResult
 from qiskit import QuantumCircuit
 from qiskit.quantum_info import Statevector
-from itertools import permutations
+from environments.VQEs.simulator import (OpTape, GateGroup, compile_tape, one_qubit_groups, one_hot_positions, state_array,
+                                         expectation, get_energy_tape, get_exp_val_tape, get_family_energies, get_energy_batch)
+from environments.VQEs.gradients import GRADIENT_METHODS, get_jac, minimize, finite_difference_grad
+from environments.VQEs.rotosolve import rotosolve, min_rotosolve
+from environments.VQEs.optimizers import optimize, incremental_optimize, restrict
+from environments.VQEs.canonical import canonicalize
+from environments.VQEs.noise import KRAUS, get_noise_model
+from environments.VQEs.shots import ShotEstimator
+from environments.VQEs.mps import set_mps_options
+from environments.VQEs.clifford import set_clifford_options
 
 class Parametric_Circuit:
-    def __init__(self,n_qubits,noise_models = [],noise_values = []):
+    def __init__(self,n_qubits,noise_models = [],noise_values = [], simulator = 'qiskit', noise_options = {}):
         self.n_qubits = n_qubits
-        self.ansatz = QuantumCircuit(n_qubits)
-
-    def construct_ansatz(self, state):
-        # print('--------------')
-        # print(state[:3])
-        
-        for _, local_state in enumerate(state):
-            
-            thetas = local_state[self.n_qubits+3:]
-            rot_pos = (local_state[self.n_qubits: self.n_qubits+3] == 1).nonzero( as_tuple = True )
-            cnot_pos = (local_state[:self.n_qubits] == 1).nonzero( as_tuple = True )
-            
-            targ = cnot_pos[0]
-            ctrl = cnot_pos[1]
-
-            if len(ctrl) != 0:
-                for r in range(len(ctrl)):
-                    self.ansatz.cx([ctrl[r].item()], [targ[r].item()])
-            
-            rot_direction_list = rot_pos[0]
-            rot_qubit_list = rot_pos[1]
-            if len(rot_qubit_list) != 0:
-                for pos, r in enumerate(rot_direction_list):
-                    rot_qubit = rot_qubit_list[pos]
-                    if r == 0:
-                        self.ansatz.rx(thetas[0][rot_qubit].item(), rot_qubit.item())
-                    elif r == 1:
-                        self.ansatz.ry(thetas[1][rot_qubit].item(), rot_qubit.item())
-                    elif r == 2:
-                        self.ansatz.rz(thetas[2][rot_qubit].item(), rot_qubit.item())
-                    else:
-                        print(f'rot-axis = {r} is in invalid')
-                        assert r >2                       
+        self.simulator = simulator
+        self.noise = get_noise_model(noise_models, noise_values, **noise_options)
+        self.ansatz = OpTape(n_qubits, simulator, self.noise)
+
+    def construct_ansatz(self, state, gates = None):
+        """ Compiles the whole state into an OpTape: per layer the CX, then RX, RY, RZ. """
+        state = state_array(state)
+        thetas = state[:, self.n_qubits+3:]
+        layer, targ, ctrl = one_hot_positions(state, 0, self.n_qubits, gates)
+        groups = [GateGroup('cx', layer, np.column_stack((ctrl, targ)))]
+        groups += one_qubit_groups(one_hot_positions(state, self.n_qubits, self.n_qubits+3, gates),
+                                   ['rx', 'ry', 'rz'], thetas, {'rx': 0, 'ry': 1, 'rz': 2})
+        self.ansatz = compile_tape(self.n_qubits, groups, self.simulator, noise = self.noise)
         return self.ansatz
-    
-    def construct_ansatz_decomposed(self, state):
+
+    def construct_ansatz_decomposed(self, state, gates = None):
         """
         THE PREVIOUS ENCODING
 
@@ -74,61 +63,22 @@ class Parametric_Circuit:
         [0., 0.], - The RZCZ (angle)
         [0., 0.], - The RZ (angle)
 
+        The whole state is compiled into an OpTape at once; within a layer
+        the gates are applied as CZ, RZCZ, then SX, X, XSX, RZ.
         """
-        
-        for _, local_state in enumerate(state):
-            
-            thetas = local_state[self.n_qubits+4+self.n_qubits:]
-            """
-            OLDS!
-
-            rot_pos = (local_state[2*self.n_qubits: 2*self.n_qubits+3] == 1).nonzero( as_tuple = True )
-            rzcz_pos = (local_state[:self.n_qubits] == 1).nonzero( as_tuple = True )
-            cz_pos = (local_state[self.n_qubits:2*self.n_qubits] == 1).nonzero( as_tuple = True )
-            """
-
-            # mod cz position extraction!
-            cz_pos = np.where(local_state[0:self.n_qubits] == 1)
-            # rotation position extration
-            one_gate_pos = np.where(local_state[self.n_qubits: self.n_qubits+4] == 1)
-            # mod rzcz extration
-            rzcz_pos = np.where(local_state[self.n_qubits+4: self.n_qubits+4+self.n_qubits] == 1)
-            
-            # print(rot_pos, 'this!!!')
-            # print('RZCZ POS')
-            # print(rzcz_pos)
-            # print('CZ POS')
-            # print(cz_pos)
-
-            targ_cz = cz_pos[0]
-            ctrl_cz = cz_pos[1]
-            if len(ctrl_cz) != 0:
-                for r in range(len(ctrl_cz)):
-                    self.ansatz.cz([ctrl_cz[r].item()], [targ_cz[r].item()])
-            
-            targ_rzcz = rzcz_pos[0]
-            ctrl_rzcz = rzcz_pos[1]
-
-            if len(ctrl_rzcz) != 0:
-                for r in range(len(ctrl_rzcz)):
-                    self.ansatz.append(rzcz(thetas[targ_rzcz[r].item()][targ_rzcz[r].item()].item(), ctrl=ctrl_rzcz[r].item(), targ=targ_rzcz[r].item()), [ctrl_rzcz[r].item(), targ_rzcz[r].item()])
-            
-            rot_direction_list = one_gate_pos[0]
-            rot_qubit_list = one_gate_pos[1]
-            if len(rot_qubit_list) != 0:
-                for pos, r in enumerate(rot_direction_list):
-                    rot_qubit = rot_qubit_list[pos]
-                    if r == 0:
-                        self.ansatz.sx(rot_qubit.item())
-                    elif r == 1:
-                        self.ansatz.x(rot_qubit.item())
-                    elif r == 2:
-                        self.ansatz.append(xsx(), [rot_qubit.item()])
-                    elif r == 3:
-                        self.ansatz.rz(thetas[0][rot_qubit].item(), rot_qubit.item())
-                    else:
-                        print(f'rot-axis = {r} is in invalid')
-                        assert r >3                       
+        n = self.n_qubits
+        state = state_array(state)
+        thetas = state[:, n+4+n:]
+        # cz, one-qubit gate and rzcz positions of all layers at once
+        cz_pos = one_hot_positions(state, 0, n, gates)
+        one_gate_pos = one_hot_positions(state, n, n+4, gates)
+        layer, targ, ctrl = one_hot_positions(state, n+4, n+4+n, gates)
+
+        groups = [GateGroup('cz', cz_pos[0], np.column_stack((cz_pos[2], cz_pos[1]))),
+                  GateGroup('rzcz', layer, np.column_stack((ctrl, targ)),
+                            thetas[layer, targ+1, ctrl], np.column_stack((targ+1, ctrl)))]
+        groups += one_qubit_groups(one_gate_pos, ['sx', 'x', 'xsx', 'rz'], thetas, {'rz': 0})
+        self.ansatz = compile_tape(n, groups, self.simulator, noise = self.noise)
         return self.ansatz
 
 
@@ -141,7 +91,7 @@ def get_energy_qiskit(angles, observable,circuit, n_qubits, n_shots,
     Input:
     angles                [array]      : list of trial angles for ansatz
     observable            [Observable] : Qulacs observable (Hamiltonian)
-    circuit               [circuit]    : ansatz circuit
+    circuit               [OpTape]     : compiled ansatz circuit
     n_qubits              [int]        : number of qubits
     energy_shift          [float]      : energy shift for Qiskit Hamiltonian after freezing+removing orbitals
     n_shots               [int]        : Statistical noise, number of samples taken from QC
@@ -151,30 +101,15 @@ def get_energy_qiskit(angles, observable,circuit, n_qubits, n_shots,
     expval [float] : expectation value 
     
     """
-    # print(angles)
-    # print(circuit, 'before')
-    
-
-    rzcz_list = []
-    for p in permutations(list(range(n_qubits)), 2):
-        id = ''.join(map(str, p))
-        rzcz_list.append('rzcz' + id)
-    
-    no = 0
-    for i in circuit:
-        gate_detail = list(i)[0]
-        # print(gate_detail.name)
-        if gate_detail.name in ['rx', 'ry', 'rz'] + rzcz_list:
-            list(i)[0].params = [angles[no]]
-            no+=1
-    # print(circuit, 'after')
-    # print('-x-x-x-x-x-')
-    # print()
-    
-    state = np.asmatrix(Statevector.from_instruction(circuit))
-    energy = (state @ observable) @ state.getH()
+    return get_energy_tape(angles, observable, circuit)
 
-    return float(energy.real)#[0][0]
+def get_energy_qiskit_batch(angles, observable, circuit, n_qubits, n_shots,
+                            phys_noise = False):
+    """
+    get_energy_qiskit for a (B, P) array of angles. The numpy backend
+    simulates the rows as one (B, 2^n) batch, the Qiskit backend row by row.
+    """
+    return get_energy_batch(angles, circuit, observable)
 
 def get_shot_noise(weights, n_shots):
     
@@ -192,31 +127,19 @@ def get_shot_noise(weights, n_shots):
 
 
 def get_exp_val(n_qubits,circuit,op, phys_noise = False, err_mitig = 0):
-            
-    state = np.asmatrix(Statevector.from_instruction(circuit))
+    
+    if isinstance(circuit, OpTape):
+        return get_exp_val_tape(circuit, op)
+    state = Statevector.from_instruction(circuit).data
     # print(state.shape)
-    energy = (state @ op) @ state.getH()
+    energy = expectation(state, op)
 
     return float(energy.real)
 
 def get_noise_channels(model_name, n_qubits, error_prob):
-    if model_name == "depolarizing":
-        noise_model = DepolarizingNoise
-    elif model_name == 'bitflip':
-        noise_model = BitFlipNoise
-    elif model_name == 'XZ':
-        noise_model = IndependentXZNoise
-    elif model_name =='dephasing':
-        noise_model = DephasingNoise
-    elif model_name == 'amplitude_damping':
-        noise_model = AmplitudeDampingNoise
-    elif model_name == 'two_depolarizing':
-        noise_model = TwoQubitDepolarizingNoise
-        
-    fun = lambda x: noise_model(x,error_prob)
-
-    channels = list(map(fun,range(n_qubits)))
-    return channels
+    """ (qubit, Kraus operators) of the channel model_name (see noise.KRAUS) on every qubit. """
+    kraus = KRAUS[model_name](error_prob)
+    return [(q, kraus) for q in range(n_qubits)]
 
 
 
@@ -229,7 +152,8 @@ def min_spsa(
     a: float = 1.0,
     alpha: float = 0.602,
     c: float = 1.0,
-    gamma: float = 0.101
+    gamma: float = 0.101,
+    fun_batch: Optional[Callable] = None
     )-> OptimizeResult:
     
     
@@ -260,7 +184,7 @@ def min_spsa(
         ak = spsa_lr_dec(epoch, a, A, alpha)
         ck = spsa_grad_dec(epoch, c, gamma)
         
-        grad = spsa_grad(fun, current_params, n_params, ck)
+        grad = spsa_grad(fun, current_params, n_params, ck, fun_batch)
         
         n_fevals += 2 
         
@@ -293,7 +217,8 @@ def min_adam_spsa(
     gamma: float = 0.101,
     beta_1: float = 0.9,
     beta_2: float = 0.999,
-    epsilon: float = 1e-8
+    epsilon: float = 1e-8,
+    fun_batch: Optional[Callable] = None
     )-> OptimizeResult:
     
     
@@ -327,7 +252,7 @@ def min_adam_spsa(
         ak = spsa_lr_dec(epoch, a, A, alpha)
         ck = spsa_grad_dec(epoch, c, gamma)
         
-        grad = spsa_grad(fun, current_params, n_params, ck)
+        grad = spsa_grad(fun, current_params, n_params, ck, fun_batch)
         
         a_grad, m, v = adam_grad(epoch, grad, m, v, beta_1, beta_2, epsilon)
         
@@ -370,7 +295,10 @@ def min_adam_spsa3(
     gamma: float = 0.101,
     beta_1: float = 0.9,
     beta_2: float = 0.999,
-    epsilon: float = 1e-8
+    epsilon: float = 1e-8,
+    fun1_batch: Optional[Callable] = None,
+    fun2_batch: Optional[Callable] = None,
+    fun3_batch: Optional[Callable] = None
     )-> OptimizeResult:
     
     
@@ -410,13 +338,13 @@ def min_adam_spsa3(
         ck = spsa_grad_dec(epoch, c, gamma)
         
         if epoch < maxiter1:
-            fun = fun1
+            fun, fun_batch = fun1, fun1_batch
         elif epoch >= maxiter1 and epoch < (maxiter1 + maxiter2):
-            fun = fun2
+            fun, fun_batch = fun2, fun2_batch
         elif epoch >= (maxiter1 + maxiter2) and epoch < maxiter:
-            fun = fun3
+            fun, fun_batch = fun3, fun3_batch
         
-        grad = spsa_grad(fun, current_params, n_params, ck)
+        grad = spsa_grad(fun, current_params, n_params, ck, fun_batch)
         
         
         
@@ -461,7 +389,11 @@ def spsa_grad_dec(epoch, c, gamma):
     ck = c / (epoch + 1.0) ** gamma
     return ck
 
-def spsa_grad(fun, current_params, n_params, ck):
+def spsa_grad(fun, current_params, n_params, ck, fun_batch = None):
+    """
+    SPSA gradient estimate. If fun_batch (maps a (B, P) array of angles to
+    B energies) is given, both perturbed points are evaluated in one call.
+    """
     
     n_params = len(current_params)
     
@@ -470,13 +402,28 @@ def spsa_grad(fun, current_params, n_params, ck):
     
     Deltak = np.random.choice([-1, 1], size=n_params)
     
-    grad = ((fun(current_params + ck * Deltak) -
-                     fun(current_params - ck * Deltak)) /
-                    (2 * ck * Deltak))
+    if fun_batch is not None:
+        f_plus, f_minus = fun_batch(np.stack((current_params + ck * Deltak,
+                                              current_params - ck * Deltak)))
+    else:
+        f_plus, f_minus = fun(current_params + ck * Deltak), fun(current_params - ck * Deltak)
+    
+    grad = (f_plus - f_minus) / (2 * ck * Deltak)
     
     return grad
 
 
+def multi_start(fun_batch, x0, n_starts, rng = np.random):
+    """
+    Screens x0 together with n_starts-1 uniformly random angle vectors
+    in one fun_batch call and returns the candidate with the lowest energy.
+    """
+    x0 = np.asarray(x0, dtype=float)
+    candidates = np.concatenate((x0[None], rng.uniform(0, 2*np.pi, size=(n_starts-1, len(x0)))))
+    energies = fun_batch(candidates)
+    return candidates[np.argmin(energies)]
+
+
 def adam_grad(epoch, grad, m, v, beta_1, beta_2, epsilon):
     
     m = beta_1 * m + (1 - beta_1) * grad
@@ -503,7 +450,10 @@ def min_spsa3_v2(
     lamda: float = 0.4,
     epsilon: float = 1e-8,
         adam: bool = True,
-    rglr: bool = False
+    rglr: bool = False,
+    fun1_batch: Optional[Callable] = None,
+    fun2_batch: Optional[Callable] = None,
+    fun3_batch: Optional[Callable] = None
     )-> OptimizeResult:
     
     
@@ -550,9 +500,9 @@ def min_spsa3_v2(
         
         
         if epoch < maxiter1:
-            fun = fun1
+            fun, fun_batch = fun1, fun1_batch
         elif epoch >= maxiter1 and epoch < (maxiter1 + maxiter2):
-            fun = fun2
+            fun, fun_batch = fun2, fun2_batch
             
             if rglr:
                 epoch_ctr = 0
@@ -560,14 +510,14 @@ def min_spsa3_v2(
                 v = 0
                 
         elif epoch >= (maxiter1 + maxiter2) and epoch < maxiter:
-            fun = fun3
+            fun, fun_batch = fun3, fun3_batch
                         
             if rglr:
                 epoch_ctr = 0
                 m = 0
                 v = 0
         
-        grad = spsa_grad(fun, current_params, n_params, ck)
+        grad = spsa_grad(fun, current_params, n_params, ck, fun_batch)
         
         if adam:
             beta_1t = beta_1_t(epoch_ctr, beta_1, lamda)
@@ -628,7 +578,8 @@ def min_spsa_v2(
     beta_1: float = 0.999,
     beta_2: float = 0.999,
     epsilon: float = 1e-8,
-    adam: bool = True)-> OptimizeResult:
+    adam: bool = True,
+    fun_batch: Optional[Callable] = None)-> OptimizeResult:
     
     
     current_params = np.asarray(x0)
@@ -661,7 +612,7 @@ def min_spsa_v2(
         ak = spsa_lr_dec_new(epoch, a, alpha)
         ck = spsa_grad_dec(epoch, c, gamma)
         
-        grad = spsa_grad(fun, current_params, n_params, ck)
+        grad = spsa_grad(fun, current_params, n_params, ck, fun_batch)
         
         if adam:
             if epoch > 0:
@@ -723,7 +674,8 @@ def min_spsa_n_v2(
     beta_1: float = 0.999,
     beta_2: float = 0.999,
     epsilon: float = 1e-8,
-    adam: bool = True)-> OptimizeResult:
+    adam: bool = True,
+    fun_batch: Optional[Callable] = None)-> OptimizeResult:
     
     
     current_params = np.asarray(x0)
@@ -756,7 +708,7 @@ def min_spsa_n_v2(
         ak = spsa_lr_dec_new(epoch, a, alpha)
         ck = spsa_grad_dec(epoch, c, gamma)
         
-        grad = spsa_grad(fun, current_params, n_params, ck)
+        grad = spsa_grad(fun, current_params, n_params, ck, fun_batch)
         
         if adam:
             if epoch > 0:
@@ -794,6 +746,8 @@ def min_spsa_n_v2(
                               nfev=n_fevals)
 
 
+SPSA_OPTIMIZERS = {'spsa': min_spsa, 'adam_spsa': min_adam_spsa, 'adam_spsa3': min_adam_spsa3,
+                   'spsa3_v2': min_spsa3_v2, 'spsa_v2': min_spsa_v2, 'spsa_n_v2': min_spsa_n_v2}
 
 if __name__ == "__main__":
     pass
@@ -0,0 +1,139 @@
+"""
+Canonical form of a compiled circuit (OpTape), up to gate commutation.
+
+Different action sequences of an episode often build the same circuit: gates
+on disjoint qubits placed in another order, a rotation moved through a CZ, or
+pairs that cancel. canonicalize() reduces a tape to one representative per
+equivalence class, so caches can key on it:
+
+1. peephole pass: every gate is moved back through the gates it commutes
+   with; it cancels against an equal self-inverse gate (X, CX, CZ) or merges
+   into an equal rotation (RX, RY, RZ on the same qubit, angles add);
+2. normal form: the lexicographically smallest order of the remaining gates
+   that respects their non-commuting pairs (the commutation DAG).
+
+Two gates commute when on every shared qubit both act in the same basis:
+Z (RZ, CZ, the RZCZ gadget, the control of CX), X (RX, X, SX, XSX, the target
+of CX) or Y (RY). The fixed 'unitary' ops commute only with disjoint gates.
+
+Noise channels after every gate (OpTape.noise) break these identities, so
+a noisy tape keeps its gate order and only the noise model joins the key.
+"""
+import hashlib
+import heapq
+import numpy as np
+
+
+SELF_INVERSE = {'x', 'cx', 'cz'}
+MERGEABLE = {'rx', 'ry', 'rz'}
+SYMMETRIC = {'cz'}
+BASES = {'rx': 'X', 'x': 'X', 'sx': 'X', 'xsx': 'X', 'ry': 'Y', 'rz': 'Z',
+         'cx': 'ZX', 'cz': 'ZZ', 'rzcz': 'ZZ', 'ryrx': 'YX'}
+
+
+class CanonicalForm:
+    """
+    key    : hex digest of the canonical gate sequence
+    ops    : (name, qubits, unitary) per remaining gate, in normal form order
+    groups : for every canonical angle, the tape slots merged into it
+    n_params : number of angles of the original tape
+    """
+    def __init__(self, key, ops, groups, n_params):
+        self.key = key
+        self.ops = ops
+        self.groups = groups
+        self.n_params = n_params
+
+    def to_canonical(self, x):
+        """ Angles of the tape -> angles of the canonical form (merged ones add up). """
+        x = np.asarray(x, dtype=float)
+        return np.array([x[list(g)].sum() for g in self.groups])
+
+    def from_canonical(self, y):
+        """
+        Angles of the canonical form -> angles of the tape: a merged angle goes
+        to the first slot of its group, the other slots and the angles of
+        cancelled gates are 0.
+        """
+        x = np.zeros(self.n_params)
+        for g, angle in zip(self.groups, y):
+            x[g[0]] = angle
+        return x
+
+    def __len__(self):
+        return len(self.ops)
+
+
+def _letter(name, qubits, slot, unitaries):
+    if name in SYMMETRIC:
+        qubits = tuple(sorted(qubits))
+    unitary = tuple(np.round(np.array(unitaries[slot]).view(float), 12)) if name == 'unitary' else ()
+    return name, qubits, unitary
+
+
+def commute(a, b):
+    """ Whether the gates with letters a and b commute (see the module docstring). """
+    shared = set(a[1]) & set(b[1])
+    if not shared:
+        return True
+    if a[0] == 'unitary' or b[0] == 'unitary':
+        return False
+    basis_a = dict(zip(a[1], BASES[a[0]]))
+    basis_b = dict(zip(b[1], BASES[b[0]]))
+    return all(basis_a[q] == basis_b[q] for q in shared)
+
+
+def _peephole(tape):
+    out = []
+    for name, qubits, slot in tape.ops:
+        letter = _letter(name, qubits, slot, tape.unitaries)
+        slots = (slot,) if slot >= 0 and name != 'unitary' else ()
+        for i in range(len(out) - 1, -1, -1):
+            if out[i][0] == letter:
+                if name in SELF_INVERSE:
+                    del out[i]
+                    break
+                if name in MERGEABLE:
+                    out[i] = (letter, out[i][1] + slots)
+                    break
+            if not commute(out[i][0], letter):
+                out.append((letter, slots))
+                break
+        else:
+            out.append((letter, slots))
+    return out
+
+
+def _normal_form(gates):
+    n = len(gates)
+    succ = [[] for _ in range(n)]
+    indeg = [0]*n
+    for j in range(n):
+        for i in range(j):
+            if not commute(gates[i][0], gates[j][0]):
+                succ[i].append(j)
+                indeg[j] += 1
+    heap = [(gates[i][0], i) for i in range(n) if indeg[i] == 0]
+    heapq.heapify(heap)
+    order = []
+    while heap:
+        _, i = heapq.heappop(heap)
+        order.append(i)
+        for j in succ[i]:
+            indeg[j] -= 1
+            if indeg[j] == 0:
+                heapq.heappush(heap, (gates[j][0], j))
+    return [gates[i] for i in order]
+
+
+def canonicalize(tape):
+    """ The CanonicalForm of an OpTape. """
+    if tape.noise is None:
+        gates = _normal_form(_peephole(tape))
+    else:
+        gates = [(_letter(name, qubits, slot, tape.unitaries), (slot,) if slot >= 0 and name != 'unitary' else ())
+                 for name, qubits, slot in tape.ops]
+    ops = tuple(letter for letter, _ in gates)
+    groups = [slots for _, slots in gates if slots]
+    digest = hashlib.blake2b(repr((tape.num_qubits, ops, tape.noise)).encode(), digest_size=16)
+    return CanonicalForm(digest.hexdigest(), ops, groups, len(tape.params))
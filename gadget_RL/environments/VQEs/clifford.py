@@ -0,0 +1,291 @@
+"""
+Clifford+RZ backend (simulator = 'clifford') for the hardware gate set.
+
+CZ, CX, SX, X and RZ at multiples of pi/2 are Clifford gates. The longest
+Clifford prefix of an OpTape (at its bound angles) is run on a stabilizer
+tableau, polynomial in the number of qubits. The Hamiltonian is then moved
+backwards through the rest of the tape in the Heisenberg picture, as a sum of
+Pauli strings: a Clifford gate maps every string to one string, a one-qubit
+gate with a generic angle (e.g. RZ(theta)) maps a string that does not
+commute with it to up to three strings. The energy is the sum of the
+expectations of the remaining strings on the tableau.
+
+A circuit that is Clifford throughout costs O(terms * n^2); each
+non-Clifford one-qubit gate can at most double the number of strings. The
+energy comes from the numpy statevector simulator instead when that bound
+exceeds max_terms or the statevector is the cheaper one (few qubits), so
+optimized circuits with many generic angles (and the adjoint gradient, the
+batched and the rotosolve paths, which stay on the statevector kernels) cost
+what the numpy backend costs.
+
+Paulis use the codes I=0, X=1, Z=2, Y=3 (x bit + 2 z bit), a string being
+the tensor product of these Hermitian one-qubit Paulis times a sign (tableau)
+or a real coefficient (Hamiltonian). One-qubit gates act through their
+Pauli transfer matrix R[a, b] = Tr(s_a U s_b U^dagger) / 2, a signed
+permutation for a Clifford gate; CX and CZ use the update rules of
+Aaronson and Gottesman (2004).
+"""
+import numpy as np
+
+from environments.VQEs.simulator import (SX_MATRIX, XSX_MATRIX, X_MATRIX, rx_matrix, ry_matrix, rz_phases,
+                                         expectation, simulate, state_dtype)
+
+
+PAULIS = np.array([np.eye(2), [[0, 1], [1, 0]], [[1, 0], [0, -1]], [[0, -1j], [1j, 0]]], dtype=complex)
+CLIFFORD_GATES = {'cx', 'cz', 'sx', 'x', 'xsx'}
+
+CLIFFORD_OPTIONS = {'max_terms': 4096}
+
+
+def set_clifford_options(max_terms = 4096):
+    """ Largest number of Pauli strings before the statevector fallback (the [env] clifford_max_terms). """
+    CLIFFORD_OPTIONS.update(max_terms = int(max_terms))
+
+
+_TRANSFERS = {}
+
+def pauli_transfer(m):
+    """ R[a, b] = Tr(s_a m s_b m^dagger) / 2 of a 2x2 unitary, real; cached per matrix. """
+    m = np.asarray(m, dtype=complex).reshape(2, 2)
+    key = m.tobytes()
+    if key not in _TRANSFERS:
+        if len(_TRANSFERS) > 4096:
+            _TRANSFERS.clear()
+        _TRANSFERS[key] = np.einsum('aij,jk,bkl,il->ab', PAULIS, m, PAULIS, m.conj()).real / 2
+    return _TRANSFERS[key]
+
+
+def is_clifford_angle(theta, tol = 1e-9):
+    """ Whether a rotation by theta is a Clifford gate, i.e. theta is a multiple of pi/2. """
+    return abs(np.remainder(theta + np.pi/4, np.pi/2) - np.pi/4) < tol
+
+
+def non_clifford_count(circuit):
+    """ Number of one-qubit gates of an OpTape (at its bound angles) that are not Clifford; ryrx counts twice. """
+    count = 0
+    for name, qubits, p in circuit.ops:
+        if name == 'unitary':
+            count += 2*(signed_permutation(pauli_transfer(circuit.unitaries[p])) is None)
+        elif p >= 0 and not is_clifford_angle(circuit.params[p]):
+            count += 2 if name == 'ryrx' else 1
+    return count
+
+
+def signed_permutation(R, tol = 1e-9):
+    """ (perm, sign) with R[perm[b], b] = sign[b] = +-1 if R is one (a Clifford gate), None otherwise. """
+    perm = np.argmax(np.abs(R), axis=0)
+    sign = R[perm, np.arange(4)]
+    if np.all(np.abs(np.abs(sign) - 1) < tol) and np.all(np.abs(np.abs(R).sum(axis=0) - 1) < tol):
+        return perm, np.sign(sign)
+    return None
+
+
+def one_qubit_gates(name, qubits, theta, unitaries, slot):
+    """ (qubit, 2x2 matrix) of the one-qubit parts of a gate, in the order they act, plus its two-qubit part. """
+    if name == 'rx':
+        return [(qubits[0], rx_matrix(theta))], None
+    elif name == 'ry':
+        return [(qubits[0], ry_matrix(theta))], None
+    elif name == 'rz':
+        return [(qubits[0], np.diag(rz_phases(theta)))], None
+    elif name == 'sx':
+        return [(qubits[0], SX_MATRIX)], None
+    elif name == 'x':
+        return [(qubits[0], X_MATRIX)], None
+    elif name == 'xsx':
+        return [(qubits[0], XSX_MATRIX)], None
+    elif name == 'unitary':
+        return [(qubits[0], unitaries[slot])], None
+    elif name == 'rzcz':
+        return [(qubits[0], np.diag(rz_phases(theta)))], 'cz'
+    elif name == 'ryrx':
+        return [(qubits[0], ry_matrix(theta)), (qubits[1], rx_matrix(theta))], None
+    return [], name
+
+
+def _codes(x, z, q):
+    return x[:, q].astype(np.intp) + 2*z[:, q]
+
+
+def _set_codes(x, z, q, codes):
+    x[:, q] = codes & 1
+    z[:, q] = codes >> 1
+
+
+def apply_cx(x, z, signs, ctrl, targ):
+    """ CX on Pauli rows, in place; signs (bool, a flip) as in Aaronson-Gottesman. CX is its own inverse. """
+    signs ^= x[:, ctrl] & z[:, targ] & ~(x[:, targ] ^ z[:, ctrl])
+    x[:, targ] ^= x[:, ctrl]
+    z[:, ctrl] ^= z[:, targ]
+
+
+def apply_cz(x, z, signs, ctrl, targ):
+    """ CZ = H(targ) CX H(targ); symmetric and its own inverse. """
+    signs ^= x[:, ctrl] & x[:, targ] & (z[:, ctrl] ^ z[:, targ])
+    z[:, ctrl] ^= x[:, targ]
+    z[:, targ] ^= x[:, ctrl]
+
+
+def _phase_exponent(x1, z1, x2, z2):
+    """ Power of i picked up per qubit by the product s(x1, z1) s(x2, z2) (the g function of Aaronson-Gottesman). """
+    x1, z1, x2, z2 = (v.astype(np.int8) for v in (x1, z1, x2, z2))
+    return np.where(x1 & z1, z2 - x2, np.where(x1, z2*(2*x2 - 1), np.where(z1, x2*(1 - 2*z2), 0)))
+
+
+class StabilizerTableau:
+    """
+    Destabilizers (rows 0..n-1) and stabilizers (rows n..2n-1) of a
+    stabilizer state as bit arrays x, z (2n, n) and sign bits, starting in |0^n>.
+    """
+    def __init__(self, n_qubits):
+        self.n_qubits = n_qubits
+        self.x = np.zeros((2*n_qubits, n_qubits), dtype=bool)
+        self.z = np.zeros((2*n_qubits, n_qubits), dtype=bool)
+        self.x[np.arange(n_qubits), np.arange(n_qubits)] = True
+        self.z[n_qubits + np.arange(n_qubits), np.arange(n_qubits)] = True
+        self.signs = np.zeros(2*n_qubits, dtype=bool)
+
+    def apply_clifford(self, perm, sign, qubit):
+        """ One-qubit Clifford with the signed-permutation transfer matrix (perm, sign). """
+        codes = _codes(self.x, self.z, qubit)
+        self.signs ^= sign[codes] < 0
+        _set_codes(self.x, self.z, qubit, perm[codes])
+
+    def apply_cx(self, ctrl, targ):
+        apply_cx(self.x, self.z, self.signs, ctrl, targ)
+
+    def apply_cz(self, ctrl, targ):
+        apply_cz(self.x, self.z, self.signs, ctrl, targ)
+
+    def expectations(self, x, z):
+        """
+        <s> for Pauli rows x, z (m, n): 0 if the string anticommutes with a
+        stabilizer, otherwise +-1, the sign of the product of the stabilizers
+        whose destabilizers anticommute with it.
+        """
+        n = self.n_qubits
+        xi, zi = x.astype(np.int64), z.astype(np.int64)
+        anti = (xi @ self.z.T.astype(np.int64) + zi @ self.x.T.astype(np.int64)) % 2
+        out = np.zeros(len(x))
+        commuting = ~anti[:, n:].any(axis=1)
+        picks = anti[commuting, :n].astype(bool)
+        acc_x = np.zeros((len(picks), n), dtype=bool)
+        acc_z = np.zeros((len(picks), n), dtype=bool)
+        phase = np.zeros(len(picks), dtype=np.int64)
+        for i in range(n):
+            rows = picks[:, i]
+            if not rows.any():
+                continue
+            sx, sz = self.x[n + i], self.z[n + i]
+            phase[rows] += 2*self.signs[n + i] + _phase_exponent(sx, sz, acc_x[rows], acc_z[rows]).sum(axis=1)
+            acc_x[rows] ^= sx
+            acc_z[rows] ^= sz
+        out[commuting] = 1 - (phase % 4)
+        return out
+
+
+_TERMS = {}
+
+
+class PauliSum:
+    """ Real combination of Pauli strings: rows x, z (m, n) and coeffs (m,). """
+    def __init__(self, x, z, coeffs):
+        self.x, self.z, self.coeffs = x, z, coeffs
+
+    @classmethod
+    def from_hamiltonian(cls, hamiltonian):
+        """ The terms of a PauliHamiltonian, as bit rows built once per Hamiltonian. """
+        cached = _TERMS.get(id(hamiltonian))
+        if cached is None or cached[0] is not hamiltonian:
+            n = hamiltonian.n_qubits
+            x = np.array([[x_mask >> q & 1 for q in range(n)] for x_mask, _ in hamiltonian.masks], dtype=bool)
+            z = np.array([[z_mask >> q & 1 for q in range(n)] for _, z_mask in hamiltonian.masks], dtype=bool)
+            _TERMS.clear()
+            cached = _TERMS[id(hamiltonian)] = (hamiltonian, x, z)
+        return cls(cached[1].copy(), cached[2].copy(), hamiltonian.coeffs.astype(float))
+
+    def __len__(self):
+        return len(self.coeffs)
+
+    def conjugate_two_qubit(self, name, qubits):
+        """ U^dagger s U for CX or CZ (both self-inverse). """
+        flips = np.zeros(len(self), dtype=bool)
+        (apply_cx if name == 'cx' else apply_cz)(self.x, self.z, flips, *qubits)
+        self.coeffs[flips] *= -1
+
+    def conjugate_one_qubit(self, R, qubit):
+        """ U^dagger s U for a one-qubit gate with transfer matrix R: s_b -> sum_a R[b, a] s_a on qubit. """
+        codes = _codes(self.x, self.z, qubit)
+        xs, zs, cs = [], [], []
+        for a in range(4):
+            weights = R[codes, a]
+            keep = np.abs(weights) > 1e-14
+            if keep.any():
+                x, z = self.x[keep].copy(), self.z[keep].copy()
+                _set_codes(x, z, qubit, np.full(keep.sum(), a))
+                xs.append(x), zs.append(z), cs.append(self.coeffs[keep] * weights[keep])
+        self.x, self.z, self.coeffs = np.concatenate(xs), np.concatenate(zs), np.concatenate(cs)
+        self._merge()
+
+    def _merge(self):
+        keys = np.packbits(np.concatenate((self.x, self.z), axis=1), axis=1)
+        keys, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        coeffs = np.zeros(len(keys))
+        np.add.at(coeffs, inverse.ravel(), self.coeffs)
+        keep = np.abs(coeffs) > 1e-14
+        self.x, self.z, self.coeffs = self.x[first[keep]], self.z[first[keep]], coeffs[keep]
+
+
+def clifford_energy(circuit, observable):
+    """
+    <H> of an OpTape at its bound angles by the tableau and Heisenberg
+    propagation (module docstring); None once more than max_terms strings.
+    """
+    n = circuit.num_qubits
+    steps = []
+    for name, qubits, p in circuit.ops:
+        theta = circuit.params[p] if p >= 0 and name != 'unitary' else None
+        ones, two = one_qubit_gates(name, qubits, theta, circuit.unitaries, p)
+        steps += [('1q', q, pauli_transfer(m)) for q, m in ones]
+        if two is not None:
+            steps.append((two, qubits, None))
+
+    tableau = StabilizerTableau(n)
+    for k, (kind, qubits, R) in enumerate(steps):
+        if kind == '1q':
+            clifford = signed_permutation(R)
+            if clifford is None:
+                break
+            tableau.apply_clifford(*clifford, qubits)
+        elif kind == 'cx':
+            tableau.apply_cx(*qubits)
+        else:
+            tableau.apply_cz(*qubits)
+    else:
+        k = len(steps)
+
+    terms = PauliSum.from_hamiltonian(observable)
+    for kind, qubits, R in reversed(steps[k:]):
+        if kind == '1q':
+            terms.conjugate_one_qubit(R, qubits)
+            if len(terms) > CLIFFORD_OPTIONS['max_terms']:
+                return None
+        else:
+            terms.conjugate_two_qubit(kind, qubits)
+    return float(terms.coeffs @ tableau.expectations(terms.x, terms.z))
+
+
+def get_clifford_energy(circuit, observable):
+    """
+    clifford_energy when its bound on the number of strings is within
+    max_terms and below the cost of a statevector, the numpy statevector
+    energy otherwise (and for a dense observable).
+    """
+    energy = None
+    if hasattr(observable, 'masks'):
+        strings = len(observable) * 2.0**non_clifford_count(circuit)
+        if strings <= CLIFFORD_OPTIONS['max_terms'] and strings * circuit.num_qubits < 2.0**circuit.num_qubits:
+            energy = clifford_energy(circuit, observable)
+    if energy is None:
+        energy = expectation(simulate(circuit, state_dtype(observable)), observable)
+    return energy
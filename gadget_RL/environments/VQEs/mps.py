@@ -0,0 +1,187 @@
+"""
+Matrix product state backend (simulator = 'mps') for chains past the
+statevector limit.
+
+Site q of the MPS is qubit q, a tensor A[q] of shape (chi_left, 2, chi_right).
+MPSSimulator runs an OpTape gate by gate: one-qubit gates contract into
+their site, two-qubit gates on neighbouring sites are applied to the merged
+pair and split again by an SVD that keeps at most max_bond singular values
+(and drops those below cutoff relative to the largest). The orthogonality
+center is moved to the pair first, so every truncation is the optimal one
+and the discarded weight adds up in truncation_error. Gates on distant
+qubits are brought next to each other with a chain of SWAPs and moved back
+afterwards; the TFIM circuits of the environments are mostly nearest
+neighbour, so these chains are short.
+
+The energy is the contraction of the MPS with the MPO of the Hamiltonian
+(PauliHamiltonian.mpo(), bond dimension 3 for the open-chain TFIM), one
+site at a time, so neither the statevector nor the 2^n kernels of the
+Hamiltonian are ever built.
+"""
+import numpy as np
+
+from environments.VQEs.simulator import SX_MATRIX, XSX_MATRIX, X_MATRIX, rx_matrix, ry_matrix, rz_phases
+
+
+CZ_TENSOR = np.diag([1, 1, 1, -1]).astype(complex).reshape(2, 2, 2, 2)
+CX_TENSOR = np.array([[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 0, 1], [0, 0, 1, 0]], dtype=complex).reshape(2, 2, 2, 2)
+SWAP_TENSOR = np.array([[1, 0, 0, 0], [0, 0, 1, 0], [0, 1, 0, 0], [0, 0, 0, 1]], dtype=complex).reshape(2, 2, 2, 2)
+
+MPS_OPTIONS = {'max_bond': 64, 'cutoff': 1e-10}
+
+
+class MPSSimulator:
+    """
+    MPS of n_qubits with bond dimension at most max_bond, see the module
+    docstring. One instance per qubit count is kept by get_mps_simulator().
+    """
+    def __init__(self, n_qubits, max_bond = 64, cutoff = 1e-10):
+        self.n_qubits = n_qubits
+        self.max_bond = int(max_bond)
+        self.cutoff = cutoff
+        self.reset()
+
+    def reset(self):
+        self.tensors = [np.array([1, 0], dtype=complex).reshape(1, 2, 1) for _ in range(self.n_qubits)]
+        self.center = 0
+        self.truncation_error = 0.0
+        return self.tensors
+
+    @property
+    def bond_dims(self):
+        return [a.shape[2] for a in self.tensors[:-1]]
+
+    def _move_center(self, site):
+        """ QR sweeps that make site the orthogonality center. """
+        A = self.tensors
+        while self.center < site:
+            k = self.center
+            chi_l, _, chi_r = A[k].shape
+            q, r = np.linalg.qr(A[k].reshape(chi_l*2, chi_r))
+            A[k] = q.reshape(chi_l, 2, -1)
+            A[k+1] = np.tensordot(r, A[k+1], axes=(1, 0))
+            self.center += 1
+        while self.center > site:
+            k = self.center
+            chi_l, _, chi_r = A[k].shape
+            q, r = np.linalg.qr(A[k].reshape(chi_l, 2*chi_r).T)
+            A[k] = q.T.reshape(-1, 2, chi_r)
+            A[k-1] = np.tensordot(A[k-1], r.T, axes=(2, 0))
+            self.center -= 1
+
+    def apply_matrix(self, m, qubit):
+        """ m = (m00, m01, m10, m11) """
+        m = np.asarray(m, dtype=complex).reshape(2, 2)
+        self.tensors[qubit] = np.einsum('ts,lsr->ltr', m, self.tensors[qubit])
+
+    def apply_diagonal(self, d0, d1, qubit):
+        A = self.tensors[qubit]
+        A[:, 0, :] *= d0
+        A[:, 1, :] *= d1
+
+    def _apply_neighbours(self, gate, site):
+        """ gate[t0, t1, s0, s1] on the sites (site, site+1), truncated by an SVD. """
+        self._move_center(site)
+        A, B = self.tensors[site], self.tensors[site+1]
+        chi_l, chi_r = A.shape[0], B.shape[2]
+        theta = np.einsum('lsm,mur->lsur', A, B)
+        theta = np.einsum('tvsu,lsur->ltvr', gate, theta).reshape(chi_l*2, 2*chi_r)
+        u, s, vh = np.linalg.svd(theta, full_matrices=False)
+        keep = min(self.max_bond, int(np.count_nonzero(s > self.cutoff*s[0])) or 1)
+        self.truncation_error += float(np.sum(s[keep:]**2))
+        s = s[:keep] / np.linalg.norm(s[:keep])
+        self.tensors[site] = u[:, :keep].reshape(chi_l, 2, keep)
+        self.tensors[site+1] = (s[:, None] * vh[:keep]).reshape(keep, 2, chi_r)
+        self.center = site + 1
+
+    def apply_two_qubit(self, gate, a, b):
+        """ gate[t_a, t_b, s_a, s_b] on qubits a and b, through a SWAP chain if they are not neighbours. """
+        if a > b:
+            a, b, gate = b, a, gate.transpose(1, 0, 3, 2)
+        for k in range(b - 1, a, -1):
+            self._apply_neighbours(SWAP_TENSOR, k)
+        self._apply_neighbours(gate, a)
+        for k in range(a + 1, b):
+            self._apply_neighbours(SWAP_TENSOR, k)
+
+    def apply_gate(self, name, qubits, theta=None):
+        if name == 'cx':
+            self.apply_two_qubit(CX_TENSOR, *qubits)
+        elif name == 'cz':
+            self.apply_two_qubit(CZ_TENSOR, *qubits)
+        elif name == 'rz':
+            self.apply_diagonal(*rz_phases(theta), qubits[0])
+        elif name == 'rx':
+            self.apply_matrix(rx_matrix(theta), qubits[0])
+        elif name == 'ry':
+            self.apply_matrix(ry_matrix(theta), qubits[0])
+        elif name == 'sx':
+            self.apply_matrix(SX_MATRIX, qubits[0])
+        elif name == 'x':
+            self.apply_matrix(X_MATRIX, qubits[0])
+        elif name == 'xsx':
+            self.apply_matrix(XSX_MATRIX, qubits[0])
+        elif name == 'rzcz':
+            self.apply_diagonal(*rz_phases(theta), qubits[0])
+            self.apply_two_qubit(CZ_TENSOR, *qubits)
+        elif name == 'ryrx':
+            self.apply_matrix(ry_matrix(theta), qubits[0])
+            self.apply_matrix(rx_matrix(theta), qubits[1])
+        else:
+            raise ValueError(f'gate {name} is not supported by the MPS simulator')
+
+    def run(self, circuit):
+        self.reset()
+        params = circuit.params
+        for name, qubits, p in circuit.ops:
+            if name == 'unitary':
+                self.apply_matrix(circuit.unitaries[p], qubits[0])
+            else:
+                self.apply_gate(name, qubits, params[p] if p >= 0 else None)
+        return self.tensors
+
+    def expectation(self, mpo):
+        """ <psi|H|psi> for the MPO tensors W[q] of shape (D_left, D_right, 2, 2) (see PauliHamiltonian.mpo). """
+        env = np.zeros((1, mpo[0].shape[0], 1), dtype=complex)
+        env[0, 0, 0] = 1
+        for A, W in zip(self.tensors, mpo):
+            env = np.tensordot(env, A, axes=(2, 0))                     # (l*, w, s, r)
+            env = np.tensordot(env, W, axes=([1, 2], [0, 3]))           # (l*, r, w', t)
+            env = np.tensordot(A.conj(), env, axes=([0, 1], [0, 3]))    # (r*, r, w')
+            env = env.transpose(0, 2, 1)
+        return float(env[0, 1, 0].real)
+
+    def statevector(self):
+        """ The dense state in the little-endian order of the numpy simulator, for small chains and checks only. """
+        psi = self.tensors[0].reshape(2, -1)
+        for A in self.tensors[1:]:
+            psi = np.tensordot(psi, A, axes=(psi.ndim - 1, 0)).reshape(-1, A.shape[2])
+        return psi.reshape([2]*self.n_qubits).transpose(range(self.n_qubits - 1, -1, -1)).reshape(-1)
+
+
+_MPS_SIMULATORS = {}
+
+def set_mps_options(max_bond = 64, cutoff = 1e-10):
+    """ Bond dimension and SVD cutoff of every MPS simulation in this process (the [env] bond_dim and mps_cutoff). """
+    MPS_OPTIONS.update(max_bond = int(max_bond), cutoff = float(cutoff))
+    _MPS_SIMULATORS.clear()
+
+
+def get_mps_simulator(n_qubits):
+    if n_qubits not in _MPS_SIMULATORS:
+        _MPS_SIMULATORS[n_qubits] = MPSSimulator(n_qubits, **MPS_OPTIONS)
+    return _MPS_SIMULATORS[n_qubits]
+
+
+def mps_energy(circuit, observable):
+    """ <H> of an OpTape at its bound angles on the MPS backend, for a PauliHamiltonian observable. """
+    sim = get_mps_simulator(circuit.num_qubits)
+    sim.run(circuit)
+    return sim.expectation(observable.mpo())
+
+
+def mps_family_energies(circuit, family):
+    """ (K,) energies of an OpTape for every member of a HamiltonianFamily, from one MPS run. """
+    sim = get_mps_simulator(circuit.num_qubits)
+    sim.run(circuit)
+    return family.weights @ np.array([sim.expectation(a.mpo()) for a in family.components])
@@ -0,0 +1,432 @@
+"""
+Density-matrix simulation of the noise models of the environments.
+
+CircuitEnv parses noise_values into noise_models, e.g. [p1, p2] into
+['depolarizing', 'two_depolarizing'] (a third value adds 'amplitude_damping').
+NoiseModel attaches those channels to every gate of an OpTape:
+
+- depolarizing (p)      : after every one-qubit gate, on its qubit
+- two_depolarizing (p)  : after every two-qubit gate (and gadget), on its pair
+- amplitude_damping (g) : after every gate, on each qubit it acts on
+- bitflip, dephasing, XZ (p) : after every gate, on each qubit it acts on
+
+The fixed 'unitary' ops of the gadget noise are noise themselves and get no
+channel.
+
+The density matrix rho of n qubits is simulated as the vector vec(rho) of 2n
+qubits, index row + 2^n col: a gate U on qubits Q acts as U on Q and conj(U)
+on Q + n, so the StatevectorSimulator kernels do the gates. The channels
+act in place on strided views of the same buffer (closed forms of their
+Kraus sums for the three models above, the Kraus sum itself otherwise).
+
+With trajectories = K the density matrix (4^n memory) is replaced by K
+pure-state trajectories simulated together as a (K, 2^n) array: every
+channel picks one Kraus branch per trajectory (Pauli channels with fixed
+probabilities, amplitude damping with probability ||K psi||^2). The energy
+is the mean over the trajectories, NoiseModel.stderr its standard error.
+Trajectory k draws from its own stream, seeded with (seed, k), and the same
+draws are reused by every evaluation, so the optimizer sees a deterministic
+cost function. threads > 1 splits the trajectories over a thread pool.
+"""
+import math
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from environments.VQEs.simulator import (StatevectorSimulator, BatchStatevectorSimulator, TWO_QUBIT_OPS,
+                                         SX_ENTRIES, XSX_ENTRIES, rx_matrix, ry_matrix, expectation_batch)
+
+
+I2 = np.eye(2, dtype=complex)
+PAULI_X = np.array([[0, 1], [1, 0]], dtype=complex)
+PAULI_Y = np.array([[0, -1j], [1j, 0]], dtype=complex)
+PAULI_Z = np.array([[1, 0], [0, -1]], dtype=complex)
+
+
+def depolarizing_kraus(p):
+    """ rho -> (1-p) rho + p I/2 """
+    return [math.sqrt(1 - 3*p/4)*I2] + [math.sqrt(p/4)*P for P in (PAULI_X, PAULI_Y, PAULI_Z)]
+
+
+def two_depolarizing_kraus(p):
+    """ rho -> (1-p) rho + p I/4 on two qubits (first factor on the second qubit of the pair) """
+    paulis = [I2, PAULI_X, PAULI_Y, PAULI_Z]
+    kraus = [np.kron(A, B) for A in paulis for B in paulis]
+    return [math.sqrt(1 - 15*p/16)*kraus[0]] + [math.sqrt(p/16)*K for K in kraus[1:]]
+
+
+def amplitude_damping_kraus(gamma):
+    return [np.array([[1, 0], [0, math.sqrt(1 - gamma)]], dtype=complex),
+            np.array([[0, math.sqrt(gamma)], [0, 0]], dtype=complex)]
+
+
+def bitflip_kraus(p):
+    return [math.sqrt(1 - p)*I2, math.sqrt(p)*PAULI_X]
+
+
+def dephasing_kraus(p):
+    return [math.sqrt(1 - p)*I2, math.sqrt(p)*PAULI_Z]
+
+
+def xz_kraus(p):
+    """ independent X and Z flips with probability p each """
+    return [(1 - p)*I2, math.sqrt(p*(1 - p))*PAULI_X, math.sqrt(p*(1 - p))*PAULI_Z, p*PAULI_X @ PAULI_Z]
+
+
+KRAUS = {'depolarizing': depolarizing_kraus, 'two_depolarizing': two_depolarizing_kraus,
+         'amplitude_damping': amplitude_damping_kraus, 'bitflip': bitflip_kraus,
+         'dephasing': dephasing_kraus, 'XZ': xz_kraus}
+
+
+def pauli_mixture(model, p):
+    """
+    (probabilities, labels) of a Pauli channel, the same channel as
+    KRAUS[model]: branch i applies the Pauli labels[i][j] to the j-th qubit
+    of the channel (Y as XZ, equal up to a phase). None for the channels
+    that are not mixtures.
+    """
+    if model == 'depolarizing':
+        return [1 - 3*p/4] + [p/4]*3, ['I', 'X', 'Y', 'Z']
+    if model == 'two_depolarizing':
+        return [1 - 15*p/16] + [p/16]*15, [a + b for a in 'IXYZ' for b in 'IXYZ']
+    if model == 'bitflip':
+        return [1 - p, p], ['I', 'X']
+    if model == 'dephasing':
+        return [1 - p, p], ['I', 'Z']
+    if model == 'XZ':
+        return [(1 - p)**2, p*(1 - p), p*(1 - p), p**2], ['I', 'X', 'Z', 'Y']
+    return None
+
+
+class NoiseModel:
+    """
+    Error probabilities per channel, {model name: value}, see KRAUS for the
+    names. energy() and energy_batch() are what the energy functions of
+    simulator.py call for an OpTape that carries a NoiseModel: exact from
+    the density matrix, or a mean over trajectories (see the module
+    docstring) whose standard error is left in stderr.
+    """
+    def __init__(self, noise_models, noise_values, trajectories = 0, seed = 0, threads = 1):
+        self.channels = {}
+        for name, value in zip(noise_models, noise_values):
+            if name not in KRAUS:
+                raise ValueError(f'unknown noise model {name}')
+            self.channels[name] = float(value)
+        self.kraus = {name: KRAUS[name](value) for name, value in self.channels.items()}
+        self.mixtures = {}
+        for name, value in self.channels.items():
+            mixture = pauli_mixture(name, value)
+            if mixture is not None:
+                probs, labels = mixture
+                x_bits = np.array([[c in 'XY' for c in label] for label in labels])
+                z_bits = np.array([[c in 'ZY' for c in label] for label in labels])
+                self.mixtures[name] = (np.cumsum(probs), x_bits, z_bits)
+        self.trajectories = int(trajectories)
+        self.seed = seed
+        self.threads = max(1, int(threads))
+        self.stderr = 0.0
+
+    def __bool__(self):
+        return any(self.channels.values())
+
+    def __repr__(self):
+        return f'NoiseModel({self.channels}, trajectories={self.trajectories}, seed={self.seed})'
+
+    def channels_after(self, name, qubits):
+        """ (model, qubits) of the channels that follow a gate, in the order they act. """
+        channels, out = self.channels, []
+        if name in TWO_QUBIT_OPS:
+            if channels.get('two_depolarizing'):
+                out.append(('two_depolarizing', tuple(qubits)))
+        elif channels.get('depolarizing'):
+            out.append(('depolarizing', tuple(qubits)))
+        for q in qubits:
+            for model in ('amplitude_damping', 'bitflip', 'dephasing', 'XZ'):
+                if channels.get(model):
+                    out.append((model, (q,)))
+        return out
+
+    def density_matrix(self, circuit):
+        """ rho of an OpTape at its bound angles; a view into the simulator buffer. """
+        return get_density_simulator(circuit.num_qubits).run(circuit, self)
+
+    def trajectory_states(self, circuit, rows = None):
+        """ (K, 2^n) trajectories of an OpTape at its bound angles, or only the given rows of them """
+        n_steps = sum(len(self.channels_after(name, qubits)) for name, qubits, _ in circuit.ops if name != 'unitary')
+        uniforms = trajectory_uniforms(self.seed, self.trajectories, n_steps)
+        return get_trajectory_simulator(circuit.num_qubits).run(circuit, self, uniforms if rows is None else uniforms[:, rows])
+
+    def trajectory_energies(self, circuit, observable):
+        """ Energy of every trajectory of an OpTape at its bound angles, (K,) """
+        run = lambda rows: expectation_batch(self.trajectory_states(circuit, rows), observable)
+        chunks = np.array_split(np.arange(self.trajectories), min(self.threads, self.trajectories))
+        if len(chunks) == 1:
+            return run(chunks[0])
+        with ThreadPoolExecutor(len(chunks)) as pool:
+            return np.concatenate(list(pool.map(run, chunks)))
+
+    def energy(self, circuit, observable):
+        if not self.trajectories:
+            self.stderr = 0.0
+            return expectation_density(self.density_matrix(circuit), observable)
+        energies = self.trajectory_energies(circuit, observable)
+        self.stderr = float(np.std(energies, ddof=1) / np.sqrt(len(energies))) if len(energies) > 1 else 0.0
+        return float(np.mean(energies))
+
+    def energy_batch(self, angles, circuit, observable):
+        energies = np.empty(len(angles))
+        for b, x in enumerate(angles):
+            circuit.bind(x)
+            energies[b] = self.energy(circuit, observable)
+        return energies
+
+
+class DensityMatrixSimulator:
+    """
+    Noisy circuits on vec(rho), a preallocated StatevectorSimulator of 2n
+    qubits (see the module docstring), plus scratch buffers for the partial
+    traces and Kraus sums of the channels.
+    """
+    def __init__(self, n_qubits):
+        self.n_qubits = n_qubits
+        self.dim = 2**n_qubits
+        self.sv = StatevectorSimulator(2*n_qubits)
+        self._trace = np.empty(self.dim**2 // 4, dtype=complex)
+        self._acc = np.empty(self.dim**2, dtype=complex)
+        self._copy = np.empty(self.dim**2, dtype=complex)
+
+    def _tensor(self):
+        return self.sv.state.reshape((2,)*(2*self.n_qubits))
+
+    def _index(self, bits):
+        """ Basic index of vec(rho) as a 2n-axis tensor fixing {bit: value} (bit b is axis 2n-1-b). """
+        index = [slice(None)]*(2*self.n_qubits)
+        for bit, value in bits.items():
+            index[2*self.n_qubits - 1 - bit] = value
+        return tuple(index)
+
+    def depolarize(self, p, qubits):
+        """ rho -> (1-p) rho + p I/d (x) Tr_qubits(rho), d = 2^len(qubits) """
+        n, t = self.n_qubits, self._tensor()
+        diag = [dict(zip(qubits + tuple(q+n for q in qubits), values*2))
+                for values in np.ndindex(*(2,)*len(qubits))]
+        trace = self._trace[:self.dim**2 // 4**len(qubits)].reshape((2,)*(2*n - 2*len(qubits)))
+        np.copyto(trace, t[self._index(diag[0])])
+        for bits in diag[1:]:
+            trace += t[self._index(bits)]
+        trace *= p / 2**len(qubits)
+        t *= 1 - p
+        for bits in diag:
+            t[self._index(bits)] += trace
+
+    def amplitude_damp(self, gamma, qubit):
+        n, t = self.n_qubits, self._tensor()
+        r0, r1 = self._index({qubit: 0, qubit+n: 0}), self._index({qubit: 1, qubit+n: 1})
+        t[r0] += gamma * t[r1]
+        t[r1] *= 1 - gamma
+        s = math.sqrt(1 - gamma)
+        t[self._index({qubit: 0, qubit+n: 1})] *= s
+        t[self._index({qubit: 1, qubit+n: 0})] *= s
+
+    def apply_kraus(self, kraus, qubit):
+        """ rho -> sum_k K rho K^dagger for one-qubit Kraus operators """
+        n, sv = self.n_qubits, self.sv
+        np.copyto(self._copy, sv.state)
+        self._acc[:] = 0
+        for K in kraus:
+            np.copyto(sv.state, self._copy)
+            sv.apply_matrix(K.ravel(), qubit)
+            sv.apply_matrix(K.conj().ravel(), qubit+n)
+            self._acc += sv.state
+        np.copyto(sv.state, self._acc)
+
+    def apply_gate(self, name, qubits, theta = None):
+        """ U rho U^dagger: U on the row qubits, conj(U) on the column qubits """
+        n, sv = self.n_qubits, self.sv
+        shifted = tuple(q+n for q in qubits)
+        sv.apply_gate(name, qubits, theta)
+        if name in ('rx', 'rz', 'rzcz'):
+            sv.apply_gate(name, shifted, -theta)
+        elif name == 'ryrx':
+            sv.apply_matrix(ry_matrix(theta), shifted[0])
+            sv.apply_matrix(rx_matrix(-theta), shifted[1])
+        elif name == 'sx':
+            sv.apply_matrix(np.conj(SX_ENTRIES), shifted[0])
+        elif name == 'xsx':
+            sv.apply_matrix(np.conj(XSX_ENTRIES), shifted[0])
+        else:
+            sv.apply_gate(name, shifted, theta)
+
+    def apply_noise(self, noise, name, qubits):
+        for model, channel_qubits in noise.channels_after(name, qubits):
+            value = noise.channels[model]
+            if model in ('depolarizing', 'two_depolarizing'):
+                self.depolarize(value, channel_qubits)
+            elif model == 'amplitude_damping':
+                self.amplitude_damp(value, channel_qubits[0])
+            else:
+                self.apply_kraus(noise.kraus[model], channel_qubits[0])
+
+    def run(self, circuit, noise):
+        """ Density matrix of an OpTape with noise after every gate, as a (2^n, 2^n) view. """
+        sv = self.sv
+        sv.reset()
+        params = circuit.params
+        for name, qubits, p in circuit.ops:
+            if name == 'unitary':
+                m = np.asarray(circuit.unitaries[p])
+                sv.apply_matrix(m, qubits[0])
+                sv.apply_matrix(m.conj(), qubits[0] + self.n_qubits)
+                continue
+            self.apply_gate(name, qubits, params[p] if p >= 0 else None)
+            self.apply_noise(noise, name, qubits)
+        # vec(rho)[row + 2^n col] = rho[row, col]
+        return sv.state.reshape(self.dim, self.dim).T
+
+
+class TrajectorySimulator:
+    """
+    K noisy trajectories of an OpTape on the BatchStatevectorSimulator
+    kernels, row k being trajectory k. Every channel application consumes
+    one row of uniforms, one number per trajectory.
+    """
+    def __init__(self, n_qubits):
+        self.n_qubits = n_qubits
+        self.dim = 2**n_qubits
+        self.batch = BatchStatevectorSimulator(n_qubits)
+        index = np.arange(self.dim)
+        self._z_signs = [1 - 2*(index >> q & 1) for q in range(n_qubits)]
+
+    def sample_mixture(self, states, cdf, x_bits, z_bits, qubits, u):
+        """
+        Pauli channel: the rows whose u falls in branch i get its Paulis, as
+        one sign flip (Z part) and one masked permutation (X part) per qubit.
+        """
+        branch = np.minimum(np.searchsorted(cdf, u, side='right'), len(cdf) - 1)
+        for j, q in enumerate(qubits):
+            has_z, has_x = z_bits[branch, j], x_bits[branch, j]
+            if has_z.any():
+                states[has_z] *= self._z_signs[q]
+            if has_x.any():
+                states[has_x] = states[has_x][:, self.batch._flip(None, q)]
+        return states
+
+    def amplitude_damp(self, states, gamma, qubit, u):
+        """
+        Amplitude damping: a row decays (|1> -> |0> on qubit) with probability
+        gamma * P(qubit = 1), otherwise it gets the no-jump Kraus operator;
+        both branches renormalised.
+        """
+        v = states.reshape(len(states), -1, 2, 2**qubit)
+        excited = np.sum(v[:, :, 1, :].real**2 + v[:, :, 1, :].imag**2, axis=(1, 2))
+        jump = u < gamma*excited
+        stay = ~jump
+        v[stay, :, 1, :] *= math.sqrt(1 - gamma)
+        v[stay] /= np.sqrt(1 - gamma*excited[stay])[:, None, None, None]
+        if jump.any():
+            v[jump, :, 0, :] = v[jump, :, 1, :] / np.sqrt(excited[jump])[:, None, None]
+            v[jump, :, 1, :] = 0
+        return states
+
+    def run(self, circuit, noise, uniforms):
+        """ (K, 2^n) trajectories, K = uniforms.shape[1] """
+        n_traj = uniforms.shape[1]
+        states = np.zeros((n_traj, self.dim), dtype=complex)
+        states[:, 0] = 1
+        params, step = circuit.params, 0
+        for name, qubits, p in circuit.ops:
+            if name == 'unitary':
+                states = self.batch.apply_matrix(states, np.array(circuit.unitaries[p]).reshape(2, 2), qubits[0])
+                continue
+            theta = np.full(n_traj, params[p]) if p >= 0 else None
+            states = self.batch.apply_gate(states, name, qubits, theta)
+            for model, channel_qubits in noise.channels_after(name, qubits):
+                if model in noise.mixtures:
+                    states = self.sample_mixture(states, *noise.mixtures[model], channel_qubits, uniforms[step])
+                else:
+                    states = self.amplitude_damp(states, noise.channels[model], channel_qubits[0], uniforms[step])
+                step += 1
+        return states
+
+
+_DENSITY_SIMULATORS = {}
+_TRAJECTORY_SIMULATORS = {}
+_UNIFORMS = {}
+
+def get_density_simulator(n_qubits):
+    if n_qubits not in _DENSITY_SIMULATORS:
+        _DENSITY_SIMULATORS[n_qubits] = DensityMatrixSimulator(n_qubits)
+    return _DENSITY_SIMULATORS[n_qubits]
+
+
+def get_trajectory_simulator(n_qubits):
+    if n_qubits not in _TRAJECTORY_SIMULATORS:
+        _TRAJECTORY_SIMULATORS[n_qubits] = TrajectorySimulator(n_qubits)
+    return _TRAJECTORY_SIMULATORS[n_qubits]
+
+
+def trajectory_uniforms(seed, n_trajectories, n_steps):
+    """
+    (n_steps, K) uniforms, column k from the stream seeded with (seed, k).
+    Cached and grown on demand; a longer draw of a stream starts with the
+    shorter one, so a circuit sees the same numbers whatever was drawn before.
+    """
+    key = (seed, n_trajectories)
+    if key not in _UNIFORMS or len(_UNIFORMS[key]) < n_steps:
+        steps = max(n_steps, 2*len(_UNIFORMS.get(key, ())), 64)
+        _UNIFORMS[key] = np.stack([np.random.default_rng([seed, k]).random(steps) for k in range(n_trajectories)], axis=1)
+    return _UNIFORMS[key][:n_steps]
+
+
+def expectation_density(rho, op):
+    """ Tr(op rho) for a PauliHamiltonian (bitwise kernels) or a dense Hermitian matrix. """
+    if hasattr(op, 'expectation_density'):
+        return op.expectation_density(rho)
+    return float(np.sum(np.asarray(op) * rho.T).real)
+
+
+class GadgetNoise:
+    """
+    Noise of the gadget_noise environment: a fixed single-qubit unitary on
+    the control of an rzcz gadget, injected with probability prob.
+
+    The unitary is drawn once (random_unitary with unitary_seed, as before)
+    and kept as the 2x2 entries the OpTape 'unitary' op takes. Whether the
+    gadget at (layer, ctrl, targ) is noisy is drawn once per episode from a
+    generator seeded with (seed, episode) and then remembered, so every
+    circuit built from the same state within an episode (scipy_optim,
+    get_energy) gets the same noise.
+    """
+    def __init__(self, prob = 0.5, seed = 0, unitary_seed = 42):
+        from qiskit.quantum_info import random_unitary
+        self.prob = prob
+        self.seed = seed
+        self.matrix = random_unitary(2, seed=unitary_seed).data
+        self.entries = tuple(complex(m) for m in self.matrix.reshape(4))
+        self.episode = -1
+        self.reset()
+
+    def reset(self):
+        """ Starts the next episode: a new injection pattern. """
+        self.episode += 1
+        self._rng = np.random.default_rng(None if self.seed is None else [self.seed, self.episode])
+        self._pattern = {}
+
+    def inject(self, layer, ctrl, targ):
+        key = (int(layer), int(ctrl), int(targ))
+        if key not in self._pattern:
+            self._pattern[key] = bool(self._rng.random() < self.prob)
+        return self._pattern[key]
+
+    def mask(self, layers, ctrls, targs):
+        """ inject() for arrays of gadgets, as a bool array """
+        return np.array([self.inject(*key) for key in zip(layers, ctrls, targs)], dtype=bool)
+
+    def injected(self):
+        """ (layer, ctrl, targ) of the gadgets drawn noisy in this episode, sorted. """
+        return tuple(sorted(key for key, noisy in self._pattern.items() if noisy))
+
+
+def get_noise_model(noise_models, noise_values, **options):
+    """ The NoiseModel of a Parametric_Circuit (options: trajectories, seed, threads), None without noise. """
+    noise = NoiseModel(noise_models, noise_values, **options)
+    return noise if noise else None
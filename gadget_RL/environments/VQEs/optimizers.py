@@ -0,0 +1,113 @@
+"""
+The optimizer call of scipy_optim, on all angles or on a subset of them.
+
+optimize runs a scipy.optimize.minimize method or rotosolve with the
+gradient of gradients.py. With which, only those angles move and the rest
+stay frozen at x0; the result always holds the full angle vector.
+
+incremental_optimize is the incremental mode of scipy_optim: the angles
+added since the last optimization are optimized first with the older ones
+frozen at the previous step's optimum (the warm start, kept in the env
+state), followed by a short joint polish of all angles.
+"""
+import numpy as np
+from scipy.optimize import OptimizeResult
+
+from environments.VQEs.simulator import OpTape, get_energy_batch
+from environments.VQEs.gradients import GRADIENT_METHODS, get_jac, minimize, shift_orders
+from environments.VQEs.rotosolve import rotosolve, min_rotosolve
+
+
+def restrict(x_full, which, fun, fun_batch = None, jac = None):
+    """
+    fun, fun_batch and jac as functions of the angles x_full[which] only,
+    the other angles frozen at x_full.
+    """
+    x_full = np.array(x_full, dtype=float)
+    which = np.asarray(which, dtype=int)
+
+    def expand(x):
+        full = x_full.copy()
+        full[which] = x
+        return full
+
+    def expand_rows(X):
+        full = np.tile(x_full, (len(X), 1))
+        full[:, which] = X
+        return full
+
+    sub_fun = lambda x: fun(expand(x))
+    sub_batch = None if fun_batch is None else lambda X: fun_batch(expand_rows(X))
+    sub_jac = None if jac is None else lambda x: jac(expand(x))[which]
+    return sub_fun, sub_batch, sub_jac
+
+
+def optimize(fun, x0, circuit, observable, method, maxiter, gradient = 'adjoint',
+             which = None, fun_batch = None):
+    """
+    Minimizes fun over the angles which (all if None) with method, a
+    scipy.optimize.minimize method or 'rotosolve'.
+
+    Input:
+    fun        [Callable] : energy of one full angle vector
+    x0         [array]    : initial (and frozen) angles
+    circuit    [OpTape]   : compiled ansatz circuit
+    observable [PauliHamiltonian or array] : Hamiltonian
+    method     [str]      : optim_alg
+    maxiter    [int]      : iteration budget (sweeps for rotosolve)
+    gradient   [str]      : see gradients.get_jac
+    which      [array]    : indices of the angles to optimize
+    fun_batch  [Callable] : energies of a (B, P) array of angles, optional
+
+    Output:
+    OptimizeResult with the full angle vector as x
+    """
+    x0 = np.array(x0, dtype=float)
+    if fun_batch is None and isinstance(circuit, OpTape):
+        fun_batch = lambda X: get_energy_batch(X, circuit, observable)
+    jac = get_jac(gradient, circuit, observable, fun, fun_batch) if method in GRADIENT_METHODS else None
+    if which is None:
+        if method == 'rotosolve':
+            return rotosolve(fun, x0, circuit, observable, maxiter, fun_batch = fun_batch)
+        return minimize(fun, x0, method, maxiter, jac)
+
+    which = np.asarray(which, dtype=int)
+    sub_fun, sub_batch, sub_jac = restrict(x0, which, fun, fun_batch, jac)
+    if method == 'rotosolve' and len(which):
+        orders = shift_orders(circuit, len(x0))[which]
+        res = min_rotosolve(sub_fun, x0[which], maxiter, fun_batch = sub_batch, orders = orders)
+    elif method == 'rotosolve':
+        res = OptimizeResult(fun = fun(x0), x = np.zeros(0), nfev = 1, nit = 0)
+    else:
+        res = minimize(sub_fun, x0[which], method, maxiter, sub_jac)
+    x = x0.copy()
+    x[which] = res.x
+    res.x = x
+    return res
+
+
+def incremental_optimize(optimize_fn, x0, new, polish_iters):
+    """
+    Optimizes the angles new with the others frozen at x0, then all angles
+    jointly for polish_iters iterations (skipped if 0).
+
+    Input:
+    optimize_fn  [Callable] : optimize_fn(x0, which, maxiter) -> OptimizeResult
+                              over the full angle vector (which None: all angles)
+    x0           [array]    : warm start, the previous optimum plus the new angles
+    new          [array]    : indices of the angles added since the last optimization
+    polish_iters [int]      : iteration budget of the joint polish
+
+    Output:
+    OptimizeResult with x and the nfev of both stages
+    """
+    res = OptimizeResult(x = np.array(x0, dtype=float), nfev = 0)
+    nfev = 0
+    if len(new):
+        res = optimize_fn(res.x, new, None)
+        nfev += res.nfev
+    if polish_iters > 0 and len(res.x):
+        res = optimize_fn(res.x, None, polish_iters)
+        nfev += res.nfev
+    res.nfev = nfev
+    return res
@@ -0,0 +1,156 @@
+"""
+Rotosolve: exact coordinate-wise minimisation of the energy.
+
+Every angle enters through a single rotation, so along one coordinate the
+energy is E(t) = M + R cos(t - phi) and its minimum follows in closed form.
+The shared ryrx angle rotates two qubits, which adds a second harmonic; that
+coordinate is minimised on its exact trigonometric reconstruction instead.
+Rotoselect (also picking the rotation axis) does not apply here, because the
+axis of every gate is the agent's action.
+
+rotosolve_statevector works on an OpTape and keeps the prefix state of
+the sweep, so updating one angle only simulates the gates after it, on the
+two rows psi and G psi (three for ryrx). min_rotosolve only needs energies
+and also covers Qiskit circuits.
+"""
+import numpy as np
+from scipy.optimize import OptimizeResult, minimize_scalar
+
+from environments.VQEs.simulator import has_statevector, get_batch_simulator, get_energy_batch
+from environments.VQEs.gradients import apply_generator, apply_pauli, shift_orders
+
+
+def trig_argmin(energy, grid_size = 360):
+    """ Minimum of a periodic 1-D energy(theta) by a grid search refined with Brent. """
+    grid = np.linspace(0, 2*np.pi, grid_size, endpoint=False)
+    best = grid[np.argmin(energy(grid))]
+    step = 2*np.pi / grid_size
+    res = minimize_scalar(energy, bounds=(best - step, best + step), method='bounded')
+    return float(res.x), float(res.fun)
+
+
+def min_rotosolve(fun, x0, maxiter = 100, tol = 1e-8, fun_batch = None, orders = None):
+    """
+    Rotosolve from energy evaluations only. An angle with one frequency
+    takes two new evaluations (theta +- pi/2), an angle with two
+    frequencies (ryrx) four (theta + 2 pi j / 5).
+
+    Input:
+    fun       [Callable] : energy of one angle vector
+    x0        [array]    : initial angles
+    maxiter   [int]      : maximal number of sweeps over all angles
+    tol       [float]    : stop when a sweep lowers the energy by less
+    fun_batch [Callable] : energies of a (B, P) array of angles, optional
+    orders    [array]    : number of frequencies of every angle (default 1)
+
+    Output:
+    OptimizeResult with fun, x, nfev, nit
+    """
+    x = np.array(x0, dtype=float)
+    if orders is None:
+        orders = np.ones(len(x), dtype=int)
+    if fun_batch is None:
+        fun_batch = lambda X: np.array([fun(v) for v in X])
+    energy = fun(x)
+    nfev = 1
+    sweep = 0
+    for sweep in range(maxiter):
+        prev_energy = energy
+        for p in range(len(x)):
+            theta = x[p]
+            if orders[p] == 1:
+                rows = np.tile(x, (2, 1))
+                rows[:, p] += [np.pi/2, -np.pi/2]
+                e_plus, e_minus = fun_batch(rows)
+                nfev += 2
+                mean = (e_plus + e_minus) / 2
+                amplitude = np.hypot(energy - mean, (e_plus - e_minus) / 2)
+                if amplitude < 1e-12:
+                    continue
+                x[p] = theta - np.pi/2 - np.arctan2(2*energy - e_plus - e_minus, e_plus - e_minus)
+                energy = mean - amplitude
+            else:
+                shifts = 2*np.pi*np.arange(5) / 5
+                rows = np.tile(x, (4, 1))
+                rows[:, p] += shifts[1:]
+                samples = np.concatenate(([energy], fun_batch(rows)))
+                nfev += 4
+                coeffs = [(2/5) * (samples @ np.cos(k*shifts)) for k in (1, 2)]
+                coeffs += [(2/5) * (samples @ np.sin(k*shifts)) for k in (1, 2)]
+                if np.max(np.abs(coeffs)) < 1e-12:
+                    continue
+                a1, a2, b1, b2 = coeffs
+                fitted = lambda t: (samples.mean() + a1*np.cos(t) + a2*np.cos(2*t)
+                                    + b1*np.sin(t) + b2*np.sin(2*t))
+                shift, energy = trig_argmin(fitted)
+                x[p] = theta + shift
+        if prev_energy - energy < tol:
+            break
+    return OptimizeResult(fun=energy, x=x, nfev=nfev, nit=sweep+1)
+
+
+def rotosolve_statevector(angles, circuit, observable, maxiter = 100, tol = 1e-8):
+    """
+    Rotosolve on an OpTape with a cached prefix state.
+
+    For the gate U(t) = V exp(-i t G / 2) holding angle p, the rows psi and
+    G psi (psi = prefix state before the gate) are run through V and the
+    rest of the circuit with t = 0, giving |a> and |b>. Then
+        E(t) = (A + B)/2 + (A - B)/2 cos t + Im<a|H|b> sin t
+    with A = <a|H|a>, B = <b|H|b>, so t* needs no further simulation.
+    nfev counts simulated rows, so it is comparable with energy evaluations.
+    """
+    sim = get_batch_simulator(circuit.num_qubits)
+    x = np.array(angles, dtype=float)
+    if hasattr(observable, 'matvec'):
+        apply_h = observable.matvec
+    else:
+        apply_h = lambda states: states @ np.asarray(observable).T
+    slots = [(i, name, qubits, p) for i, (name, qubits, p) in enumerate(circuit.ops)
+             if p >= 0 and name != 'unitary']
+
+    energy = float(get_energy_batch(x[None], circuit, observable)[0])
+    nfev = 1
+    sweep = 0
+    for sweep in range(maxiter):
+        prev_energy = energy
+        prefix = np.zeros((1, sim.dim), dtype=complex)
+        prefix[0, 0] = 1
+        pos = 0
+        for i, name, qubits, p in slots:
+            prefix = sim.run(circuit, x, prefix, start=pos, stop=i)
+            pos = i
+            psi = prefix[0]
+            rows = [psi, apply_generator(name, qubits, psi)]
+            if name == 'ryrx':
+                rows.append(apply_pauli(apply_pauli(psi, 'X', qubits[1]), 'Y', qubits[0]))
+            zeroed = np.tile(x, (len(rows), 1))
+            zeroed[:, p] = 0
+            out = sim.run(circuit, zeroed, np.array(rows), start=i)
+            m = out.conj() @ apply_h(out).T
+            nfev += len(rows)
+            if name != 'ryrx':
+                A, B, C = m[0, 0].real, m[1, 1].real, m[0, 1].imag
+                if np.hypot((A - B)/2, C) < 1e-12:
+                    continue
+                x[p] = np.arctan2(-C, -(A - B)/2)
+                energy = (A + B)/2 - np.hypot((A - B)/2, C)
+            else:
+                # RY(t) x RX(t) = c^2 - i c s (Y + X) - s^2 YX with c, s = cos, sin(t/2)
+                def fitted(t):
+                    c, s = np.cos(np.asarray(t)/2), np.sin(np.asarray(t)/2)
+                    w = np.stack((c*c, -1j*c*s, -s*s), axis=-1)
+                    return np.einsum('...j,jk,...k->...', w.conj(), m, w).real
+                x[p], energy = trig_argmin(fitted)
+        if prev_energy - energy < tol:
+            break
+    return OptimizeResult(fun=energy, x=x, nfev=nfev, nit=sweep+1)
+
+
+def rotosolve(fun, x0, circuit, observable, maxiter = 100, tol = 1e-8, fun_batch = None):
+    """ Rotosolve with the cached statevector sweep for noiseless statevector OpTapes, from energies otherwise. """
+    if len(x0) == 0:
+        return OptimizeResult(fun=fun(x0), x=np.asarray(x0, dtype=float), nfev=1, nit=0)
+    if has_statevector(circuit):
+        return rotosolve_statevector(x0, circuit, observable, maxiter, tol)
+    return min_rotosolve(fun, x0, maxiter, tol, fun_batch, shift_orders(circuit, len(x0)))
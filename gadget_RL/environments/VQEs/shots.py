@@ -0,0 +1,132 @@
+"""
+Finite-shot energy estimator.
+
+A Pauli term is measured by rotating every qubit it acts on into the Z basis
+(H for X, H S^dagger for Y) and reading the parity of those bits. Terms that
+are qubit-wise commuting (the same Pauli on every qubit they share, e.g. all
+ZZ couplings of the TFIM, or all its X fields) share one measurement
+setting. measurement_groups() splits a PauliHamiltonian into such groups
+greedily, largest |coeff| first.
+
+ShotEstimator draws n_shots bitstrings for every group from the measurement
+probabilities of the circuit (statevector, density matrix or noise
+trajectories), all groups in one vectorized multinomial draw, and returns
+the estimate of <H> with its variance: per group the sample variance of the
+group observable over n_shots, summed over the independently measured
+groups.
+"""
+import numpy as np
+from qiskit.quantum_info import Statevector
+
+from environments.VQEs.simulator import OpTape, simulate
+from utils.pauli_hamiltonian import label_to_masks, _popcount_parity
+
+
+HADAMARD = np.array([[1, 1], [1, -1]], dtype=complex) / np.sqrt(2)
+BASIS_CHANGE = {'X': HADAMARD, 'Y': HADAMARD @ np.diag([1, -1j])}
+
+
+class MeasurementGroup:
+    """
+    basis : {qubit: 'X', 'Y' or 'Z'}, the measurement setting
+    terms : (support mask, coeff) per term; after the basis change a term is
+            coeff * (-1)^popcount(bitstring & support)
+    """
+    def __init__(self):
+        self.basis = {}
+        self.terms = []
+        self.paulis = []
+
+    def fits(self, paulis):
+        return all(self.basis.get(q, p) == p for q, p in paulis.items())
+
+    def add(self, label, coeff, paulis):
+        self.basis.update(paulis)
+        x_mask, z_mask = label_to_masks(label)
+        self.terms.append((x_mask | z_mask, coeff))
+        self.paulis.append(label)
+
+    def values(self, index):
+        """ Value of the group observable on every bitstring of index. """
+        out = np.zeros(len(index))
+        for support, coeff in self.terms:
+            out += coeff * _popcount_parity(index & support)
+        return out
+
+
+def measurement_groups(hamiltonian):
+    """ Qubit-wise commuting groups of the terms of a PauliHamiltonian, see the module docstring. """
+    n = hamiltonian.n_qubits
+    groups = []
+    for k in np.argsort(-np.abs(hamiltonian.coeffs), kind='stable'):
+        label = hamiltonian.paulis[k]
+        paulis = {n - 1 - i: p for i, p in enumerate(label) if p != 'I'}
+        group = next((g for g in groups if g.fits(paulis)), None)
+        if group is None:
+            group = MeasurementGroup()
+            groups.append(group)
+        group.add(label, float(hamiltonian.coeffs[k]), paulis)
+    return groups
+
+
+def _rotate(states, matrix, qubit):
+    """ matrix on qubit of the last axis of a (..., 2^n) array """
+    v = states.reshape(states.shape[:-1] + (-1, 2, 2**qubit))
+    return np.einsum('ij,...ajb->...aib', matrix, v).reshape(states.shape)
+
+
+class ShotEstimator:
+    """
+    Energy from n_shots measurements per group of measurement_groups(hamiltonian),
+    drawn from a generator seeded with seed.
+    """
+    def __init__(self, hamiltonian, n_shots, seed = None):
+        self.n_shots = int(n_shots)
+        self.groups = measurement_groups(hamiltonian)
+        index = np.arange(2**hamiltonian.n_qubits)
+        self.values = np.stack([g.values(index) for g in self.groups])
+        self.rng = np.random.default_rng(seed)
+
+    def probabilities(self, circuit):
+        """ (groups, 2^n) measurement probabilities of a circuit (OpTape or QuantumCircuit) per group. """
+        noise = getattr(circuit, 'noise', None)
+        if not isinstance(circuit, OpTape):
+            states, rho = Statevector(circuit).data, None
+        elif noise is None:
+            states, rho = simulate(circuit), None
+        elif noise.trajectories:
+            states, rho = noise.trajectory_states(circuit), None
+        else:
+            states, rho = None, noise.density_matrix(circuit)
+        probs = np.empty(self.values.shape)
+        for g, group in enumerate(self.groups):
+            rotations = [(BASIS_CHANGE[p], q) for q, p in group.basis.items() if p != 'Z']
+            if rho is None:
+                rotated = states
+                for matrix, q in rotations:
+                    rotated = _rotate(rotated, matrix, q)
+                p = rotated.real**2 + rotated.imag**2
+                probs[g] = p if p.ndim == 1 else p.mean(axis=0)
+            else:
+                # diag(U rho U^dagger): U on the rows, conj(U) on the columns
+                rotated = rho.T
+                for matrix, q in rotations:
+                    rotated = _rotate(rotated, matrix, q)
+                rotated = rotated.T
+                for matrix, q in rotations:
+                    rotated = _rotate(rotated, matrix.conj(), q)
+                probs[g] = np.diagonal(rotated).real
+        probs = np.clip(probs, 0, None)
+        return probs / probs.sum(axis=1, keepdims=True)
+
+    def sample(self, probs):
+        """ (estimate, variance) of <H> from one multinomial draw of n_shots per group. """
+        counts = self.rng.multinomial(self.n_shots, probs)
+        means = np.sum(counts * self.values, axis=1) / self.n_shots
+        second = np.sum(counts * self.values**2, axis=1) / self.n_shots
+        variances = (second - means**2) / max(self.n_shots - 1, 1)
+        return float(means.sum()), float(np.clip(variances, 0, None).sum())
+
+    def estimate(self, circuit):
+        """ (estimate, variance) of the energy of a circuit at its bound angles. """
+        return self.sample(self.probabilities(circuit))
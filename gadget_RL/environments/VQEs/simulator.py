@@ -0,0 +1,818 @@
+"""
+Native NumPy statevector simulator for the VQE energy hot path.
+
+The Parametric_Circuit classes compile the env state into an OpTape once per
+step; simulate() runs a tape on its backend (numpy kernels or Qiskit).
+
+Qubit ordering follows Qiskit (little endian): qubit q is bit q of the
+basis-state index, so a state of n qubits viewed with shape
+(2**(n-1-q), 2, 2**q) exposes qubit q on the middle axis.
+
+Before a tape is run on the numpy kernels, fuse_ops() merges every
+maximal run of diagonal gates (RZ, CZ, rzcz) into one phase tensor and the
+consecutive one-qubit gates on a qubit into one 2x2 matrix, so a fused run
+costs one pass over the state instead of one per gate.
+
+The numpy simulators run in the state_dtype of the Hamiltonian they are
+evaluated against: complex128, or complex64 for a single-precision
+PauliHamiltonian (utils/pauli_hamiltonian.py).
+"""
+import math
+import cmath
+from collections import namedtuple
+import numpy as np
+from qiskit import QuantumCircuit
+from qiskit.circuit import ParameterVector
+from qiskit.quantum_info import Statevector
+from utils.synthesized_gates import rzcz, ryrx, xsx
+
+
+X_MATRIX = np.array([[0, 1], [1, 0]], dtype=complex)
+SX_MATRIX = 0.5*np.array([[1+1j, 1-1j], [1-1j, 1+1j]], dtype=complex)
+XSX_MATRIX = SX_MATRIX @ X_MATRIX
+
+
+def rx_matrix(theta):
+    c, s = math.cos(theta/2), math.sin(theta/2)
+    return c, -1j*s, -1j*s, c
+
+
+def ry_matrix(theta):
+    c, s = math.cos(theta/2), math.sin(theta/2)
+    return c, -s, s, c
+
+
+def rz_phases(theta):
+    return cmath.exp(-0.5j*theta), cmath.exp(0.5j*theta)
+
+
+def as_entries(matrix):
+    """ Flattens a 2x2 matrix into the (m00, m01, m10, m11) tuple the kernels take. """
+    return tuple(complex(m) for m in np.asarray(matrix).reshape(4))
+
+
+SX_ENTRIES = as_entries(SX_MATRIX)
+XSX_ENTRIES = as_entries(XSX_MATRIX)
+
+
+OPCODES = ('cx', 'cz', 'rx', 'ry', 'rz', 'sx', 'x', 'xsx', 'rzcz', 'ryrx', 'unitary')
+TWO_QUBIT_OPS = {'cx', 'cz', 'rzcz', 'ryrx'}
+
+GateGroup = namedtuple('GateGroup', 'name layers qubits thetas keys pos refs rank',
+                       defaults=(None, None, None, None, None))
+GateGroup.__doc__ = """
+One gate type of a whole env state, as arrays over its k occurrences.
+
+name   : opcode name (see OPCODES)
+layers : (k,) layer of every gate
+qubits : (k, 1) or (k, 2) qubits, (ctrl, targ) for two-qubit gates
+thetas : (k,) angles of a parametric gate, None otherwise
+keys   : (k, 2) (angle row, column) of every angle in the env state; the
+         parameter slots follow (layer, row, column), the order in which the
+         env reads the angles with nonzero()
+pos    : (k,) order within the group in a layer (default: as given)
+refs   : (k,) index into the unitaries of a 'unitary' group
+rank   : place of the group in a layer (default: its index in the group list);
+         groups of equal rank are interleaved by pos
+"""
+
+
+class OpTape:
+    """
+    Compiled circuit: one opcode, qubit pair and parameter slot per gate.
+
+    opcodes   : (G,) int8 index into OPCODES
+    qubits    : (G, 2) qubits (second entry -1 for one-qubit gates)
+    slots     : (G,) index into params (into unitaries for 'unitary'), -1 if none
+    params    : angles, one per slot; binding new angles is a single array write
+    unitaries : fixed 2x2 matrices referenced by the 'unitary' ops
+    noise     : NoiseModel (environments/VQEs/noise.py) applied after every
+                gate, None for a noiseless circuit
+
+    Every backend consumes the tape directly: the numpy simulators walk the
+    cached ops list, the Qiskit backend builds one parametrized
+    QuantumCircuit per tape and only assigns parameters per evaluation.
+    The gate methods keep it a drop-in for the parts of QuantumCircuit the
+    make_circuit* methods of the environments use.
+    """
+    def __init__(self, n_qubits, simulator = 'numpy', noise = None):
+        self.num_qubits = n_qubits
+        self.simulator = simulator
+        self.noise = noise
+        self.params = []
+        self.unitaries = []
+        self._codes, self._qubits, self._slots = [], [], []
+        self._arrays = None
+        self._ops = None
+        self._fused = None
+        self._qiskit = None
+
+    @classmethod
+    def from_arrays(cls, n_qubits, opcodes, qubits, slots, params, unitaries = (), simulator = 'numpy', noise = None):
+        tape = cls(n_qubits, simulator, noise)
+        tape._codes, tape._qubits, tape._slots = opcodes.tolist(), qubits.tolist(), slots.tolist()
+        tape._arrays = (opcodes, qubits, slots)
+        tape.params = np.asarray(params, dtype=float)
+        tape.unitaries = list(unitaries)
+        return tape
+
+    def _append(self, name, qubits, theta=None):
+        qubits = [int(np.ravel(q)[0]) for q in qubits]
+        self._codes.append(OPCODES.index(name))
+        self._qubits.append(qubits + [-1]*(2 - len(qubits)))
+        if theta is None:
+            self._slots.append(-1)
+        else:
+            self._slots.append(len(self.params))
+            self.params.append(float(theta))
+        self._arrays = self._ops = self._fused = self._qiskit = None
+
+    def _compiled(self):
+        if self._arrays is None:
+            self._arrays = (np.array(self._codes, dtype=np.int8),
+                            np.array(self._qubits, dtype=np.intp).reshape(-1, 2),
+                            np.array(self._slots, dtype=np.intp))
+        return self._arrays
+
+    @property
+    def opcodes(self):
+        return self._compiled()[0]
+
+    @property
+    def qubits(self):
+        return self._compiled()[1]
+
+    @property
+    def slots(self):
+        return self._compiled()[2]
+
+    @property
+    def ops(self):
+        """ (name, qubits, slot) per gate, the form the simulator loops iterate """
+        if self._ops is None:
+            self._ops = []
+            for code, qubits, slot in zip(self._codes, self._qubits, self._slots):
+                name = OPCODES[code]
+                self._ops.append((name, tuple(qubits[:2 if name in TWO_QUBIT_OPS else 1]), slot))
+        return self._ops
+
+    @property
+    def fused(self):
+        """ ops after fuse_ops(), built once per tape; the fused blocks read their angles from params when run """
+        if self._fused is None:
+            self._fused = fuse_ops(self.ops, self.num_qubits)
+        return self._fused
+
+    def bind(self, angles):
+        self.params = np.asarray(angles, dtype=float)
+
+    def cx(self, ctrl, targ):
+        self._append('cx', (ctrl, targ))
+
+    def cz(self, ctrl, targ):
+        self._append('cz', (ctrl, targ))
+
+    def rx(self, theta, qubit):
+        self._append('rx', (qubit,), theta)
+
+    def ry(self, theta, qubit):
+        self._append('ry', (qubit,), theta)
+
+    def rz(self, theta, qubit):
+        self._append('rz', (qubit,), theta)
+
+    def sx(self, qubit):
+        self._append('sx', (qubit,))
+
+    def x(self, qubit):
+        self._append('x', (qubit,))
+
+    def rzcz(self, theta, ctrl, targ):
+        """ rzcz gadget of utils/synthesized_gates.py: RZ(theta) on ctrl followed by CZ. """
+        self._append('rzcz', (ctrl, targ), theta)
+
+    def xsx(self, qubit):
+        """ xsx gadget of utils/synthesized_gates.py: X followed by SX. """
+        self._append('xsx', (qubit,))
+
+    def ryrx(self, theta, qubitry, qubitrx):
+        """ ryrx gadget of utils/synthesized_gates.py: RY(theta) and RX(theta) sharing the angle. """
+        self._append('ryrx', (qubitry, qubitrx), theta)
+
+    def unitary(self, matrix, qubit):
+        self._codes.append(OPCODES.index('unitary'))
+        self._qubits.append([int(qubit), -1])
+        self._slots.append(len(self.unitaries))
+        self.unitaries.append(as_entries(matrix))
+        self._arrays = self._ops = self._fused = self._qiskit = None
+
+    def qiskit_circuit(self):
+        """ The tape as a QuantumCircuit with one Parameter per slot, built once. """
+        if self._qiskit is None:
+            theta = ParameterVector('theta', len(self.params))
+            circuit = QuantumCircuit(self.num_qubits)
+            for name, qubits, slot in self.ops:
+                if name == 'unitary':
+                    circuit.unitary(np.array(self.unitaries[slot]).reshape(2, 2), [qubits[0]])
+                elif name == 'rzcz':
+                    circuit.append(rzcz(theta[slot], *qubits), list(qubits))
+                elif name == 'ryrx':
+                    circuit.append(ryrx(theta[slot], *qubits), list(qubits))
+                elif name == 'xsx':
+                    circuit.append(xsx(), list(qubits))
+                elif slot >= 0:
+                    getattr(circuit, name)(theta[slot], *qubits)
+                else:
+                    getattr(circuit, name)(*qubits)
+            self._qiskit = circuit
+        return self._qiskit
+
+    def __len__(self):
+        return len(self._codes)
+
+
+def compile_tape(n_qubits, groups, simulator = 'numpy', unitaries = (), noise = None):
+    """
+    Builds the OpTape of a whole env state from its gate groups in one go:
+    gates are ordered by layer and then by the position of their group in
+    groups (the order gates of one layer are applied in), and the parameter
+    slots follow the env's angle order (see GateGroup.keys).
+    """
+    groups = [g if g.rank is not None else g._replace(rank=i) for i, g in enumerate(groups)]
+    groups = [g for g in groups if len(g.layers)]
+    if not groups:
+        return OpTape(n_qubits, simulator, noise)
+    sizes = [len(g.layers) for g in groups]
+    layers = np.concatenate([np.asarray(g.layers) for g in groups])
+    rank = np.repeat([g.rank for g in groups], sizes)
+    pos = np.concatenate([np.arange(k) if g.pos is None else np.asarray(g.pos) for g, k in zip(groups, sizes)])
+    opcodes = np.repeat(np.array([OPCODES.index(g.name) for g in groups], dtype=np.int8), sizes)
+    qubits = np.full((len(layers), 2), -1, dtype=np.intp)
+    slots = np.full(len(layers), -1, dtype=np.intp)
+
+    start, param_idx, param_keys, thetas = 0, [], [], []
+    for g, k in zip(groups, sizes):
+        g_qubits = np.asarray(g.qubits).reshape(k, -1)
+        qubits[start:start+k, :g_qubits.shape[1]] = g_qubits
+        if g.thetas is not None:
+            param_idx.append(np.arange(start, start+k))
+            param_keys.append(np.column_stack((np.asarray(g.layers), np.asarray(g.keys).reshape(k, 2))))
+            thetas.append(np.asarray(g.thetas, dtype=float))
+        elif g.refs is not None:
+            slots[start:start+k] = g.refs
+        start += k
+
+    params = np.zeros(0)
+    if param_idx:
+        param_idx, param_keys = np.concatenate(param_idx), np.concatenate(param_keys)
+        slot_order = np.lexsort(param_keys.T[::-1])
+        slots[param_idx[slot_order]] = np.arange(len(slot_order))
+        params = np.concatenate(thetas)[slot_order]
+
+    order = np.lexsort((pos, rank, layers))
+    return OpTape.from_arrays(n_qubits, opcodes[order], qubits[order], slots[order], params, unitaries, simulator, noise)
+
+
+def one_hot_positions(state, start, stop, gates = None):
+    """
+    nonzero() of the one-hot rows [start, stop) of an env state, (layers, rows - start, qubits).
+    With gates, the sorted (layer, row, qubit) of every gate (StateStore.gates() in
+    utils/state_store.py), they are read from the gate list instead of the state.
+    """
+    if gates is None:
+        return np.nonzero(state[:, start:stop] == 1)
+    sel = (gates[:, 1] >= start) & (gates[:, 1] < stop)
+    return gates[sel, 0], gates[sel, 1] - start, gates[sel, 2]
+
+
+def one_qubit_groups(pos, names, thetas, angle_rows):
+    """
+    GateGroups of the one-qubit rows of a state, in row order.
+
+    pos        : nonzero() of those rows, (layers, rows, qubits)
+    names      : gate of every row
+    thetas     : angle rows of the state, (layers, rows, qubits)
+    angle_rows : angle row of every parametric gate name
+    """
+    layers, rows, qubits = pos
+    groups = []
+    for r, name in enumerate(names):
+        sel = rows == r
+        if name in angle_rows:
+            row = angle_rows[name]
+            keys = np.column_stack((np.full(sel.sum(), row), qubits[sel]))
+            groups.append(GateGroup(name, layers[sel], qubits[sel], thetas[layers[sel], row, qubits[sel]], keys))
+        else:
+            groups.append(GateGroup(name, layers[sel], qubits[sel]))
+    return groups
+
+
+DIAGONAL_OPS = {'rz', 'cz', 'rzcz'}
+ONE_QUBIT_OPS = {'rx', 'ry', 'sx', 'x', 'xsx', 'unitary'}
+MAX_DIMS = 32
+
+
+class DiagonalRun:
+    """
+    A run of diagonal gates applied as one broadcast multiply. Its phase only
+    depends on the t qubits the run touches, so it is a tensor of 2^t entries,
+    exp(i sum_k theta_k (b_k - 1/2)) times the CZ signs (-1)^(b_c b_t), that
+    multiplies the state viewed with an axis of length 2 per touched qubit
+    and one merged axis per stretch of untouched qubits.
+
+    shape       : view of the state (big endian axes, see the module docstring)
+    phase_shape : shape of the phase tensor, 2 on the touched axes, 1 elsewhere
+    slots       : parameter slot of every RZ (and rzcz) of the run
+    signs       : (len(slots), 2^t) b_k - 1/2 of the qubit of every RZ
+    sign        : (2^t,) product of the CZ signs
+    """
+    def __init__(self, n_qubits, gates):
+        touched = sorted({q for _, qubits, _ in gates for q in qubits}, reverse=True)
+        t = len(touched)
+        axis = {q: i for i, q in enumerate(touched)}
+        bits = np.arange(2**t)[:, None] >> np.arange(t - 1, -1, -1) & 1
+        self.shape, self.phase_shape = [], []
+        prev = n_qubits
+        for q in touched + [-1]:
+            if prev - q > 1:
+                self.shape.append(2**(prev - q - 1))
+                self.phase_shape.append(1)
+            if q >= 0:
+                self.shape.append(2)
+                self.phase_shape.append(2)
+            prev = q
+        slots, signs = [], []
+        self.sign = np.ones(2**t)
+        for name, qubits, slot in gates:
+            if name in ('rz', 'rzcz'):
+                slots.append(slot)
+                signs.append(bits[:, axis[qubits[0]]] - 0.5)
+            if name in ('cz', 'rzcz'):
+                self.sign *= 1 - 2*(bits[:, axis[qubits[0]]] & bits[:, axis[qubits[1]]])
+        self.slots = np.array(slots, dtype=np.intp)
+        self.signs = np.array(signs).reshape(len(slots), 2**t)
+
+    def phases(self, params):
+        """ (2^t,) phases at the angles params, or (B, 2^t) for a (B, P) angle array. """
+        return self.sign * np.exp(1j * (np.asarray(params)[..., self.slots] @ self.signs))
+
+
+def fuse_ops(ops, n_qubits):
+    """
+    Fusion pass over the (name, qubits, slot) ops of a tape. Returns the same
+    form, in which
+
+    ('diagonal', qubits, DiagonalRun) replaces a run of diagonal gates, and
+    ('matrix', (q,), factors) the consecutive one-qubit gates on qubit q,
+    factors being their (name, slot, op) in circuit order (see fused_entries).
+
+    Diagonal gates commute with each other and gates on different qubits
+    commute, so a run keeps growing until a non-diagonal gate touches one of
+    its qubits; pending one-qubit gates are on qubits the run does not
+    touch and commute with it. An RZ on a qubit with pending gates is fused
+    into their matrix. Single gates are kept as they are.
+    """
+    program, mats, run, touched = [], {}, [], set()
+
+    def flush_matrix(q):
+        factors = mats.pop(q)
+        program.append(factors[0][2] if len(factors) == 1 and factors[0][2] is not None else ('matrix', (q,), factors))
+
+    def flush_run():
+        fused = DiagonalRun(n_qubits, run) if len(run) > 1 else None
+        if fused is not None and len(fused.shape) <= MAX_DIMS:
+            program.append(('diagonal', tuple(sorted(touched)), fused))
+        else:
+            program.extend(run)
+        run.clear()
+        touched.clear()
+
+    def add_one_qubit(name, q, slot, op):
+        if q in touched:
+            flush_run()
+        mats.setdefault(q, []).append((name, slot, op))
+
+    for op in ops:
+        name, qubits, slot = op
+        if name == 'rz' and qubits[0] in mats:
+            mats[qubits[0]].append((name, slot, op))
+        elif name in DIAGONAL_OPS:
+            for q in qubits:
+                if q in mats:
+                    flush_matrix(q)
+            run.append(op)
+            touched.update(qubits)
+        elif name in ONE_QUBIT_OPS:
+            add_one_qubit(name, qubits[0], slot, op)
+        elif name == 'ryrx':
+            add_one_qubit('ry', qubits[0], slot, None)
+            add_one_qubit('rx', qubits[1], slot, None)
+        else:
+            for q in qubits:
+                if q in mats:
+                    flush_matrix(q)
+            if touched.intersection(qubits):
+                flush_run()
+            program.append(op)
+    flush_run()
+    for q in list(mats):
+        flush_matrix(q)
+    return program
+
+
+def _product(a, b):
+    """ a @ b for 2x2 matrices as (m00, m01, m10, m11) tuples """
+    return (a[0]*b[0] + a[1]*b[2], a[0]*b[1] + a[1]*b[3], a[2]*b[0] + a[3]*b[2], a[2]*b[1] + a[3]*b[3])
+
+
+FIXED_ENTRIES = {'sx': SX_ENTRIES, 'x': as_entries(X_MATRIX), 'xsx': XSX_ENTRIES}
+
+
+def fused_entries(factors, params, unitaries):
+    """ The matrix of a ('matrix', qubits, factors) op at the angles params, as entries. """
+    m = (1, 0, 0, 1)
+    for name, p, _ in factors:
+        if name == 'rz':
+            d0, d1 = rz_phases(params[p])
+            f = (d0, 0, 0, d1)
+        elif name == 'rx':
+            f = rx_matrix(params[p])
+        elif name == 'ry':
+            f = ry_matrix(params[p])
+        elif name == 'unitary':
+            f = unitaries[p]
+        else:
+            f = FIXED_ENTRIES[name]
+        m = _product(f, m)
+    return m
+
+
+def fused_matrices(factors, angles, unitaries):
+    """ (B, 2, 2) matrices of a ('matrix', qubits, factors) op, row b at the angles angles[b]. """
+    m = np.eye(2, dtype=complex)
+    for name, p, _ in factors:
+        if name == 'rz':
+            f = np.zeros((len(angles), 2, 2), dtype=complex)
+            f[:, 0, 0], f[:, 1, 1] = np.exp(-0.5j*angles[:, p]), np.exp(0.5j*angles[:, p])
+        elif name == 'rx':
+            f = rx_matrices(angles[:, p])
+        elif name == 'ry':
+            f = ry_matrices(angles[:, p])
+        else:
+            f = np.array(unitaries[p] if name == 'unitary' else FIXED_ENTRIES[name]).reshape(2, 2)
+        m = f @ m
+    return np.broadcast_to(m, (len(angles), 2, 2))
+
+
+def state_array(state):
+    """ The env state (a torch tensor, possibly on the GPU) as a numpy array. """
+    if hasattr(state, 'detach'):
+        state = state.detach().cpu()
+    return np.asarray(state)
+
+
+class StatevectorSimulator:
+    """
+    Applies gates as strided kernels on two preallocated state buffers.
+    Diagonal gates act in place; dense and permutation gates write into
+    the other buffer (one numpy call per gate) and the buffers swap.
+    Since the buffers never move, the strided views for every qubit and
+    the permutations for every qubit pair are built once and reused.
+    One instance per qubit count and dtype is kept by get_simulator().
+    """
+    def __init__(self, n_qubits, dtype = np.complex128):
+        self.n_qubits = n_qubits
+        self.dim = 2**n_qubits
+        self._buffers = [np.zeros(self.dim, dtype=dtype), np.zeros(self.dim, dtype=dtype)]
+        self._cur = 0
+        self._mat = np.empty((2, 2), dtype=dtype)
+        self._views = [[buf.reshape(-1, 2, 2**q) for q in range(n_qubits)] for buf in self._buffers]
+        self._perms = {}
+        self._index = np.arange(self.dim)
+
+    @property
+    def state(self):
+        return self._buffers[self._cur]
+
+    def reset(self):
+        state = self._buffers[self._cur]
+        state[:] = 0
+        state[0] = 1
+        return state
+
+    def _permute(self, perm):
+        np.take(self._buffers[self._cur], perm, out=self._buffers[1-self._cur])
+        self._cur = 1 - self._cur
+
+    def _flip(self, ctrl, targ):
+        """ Index permutation of X on targ, conditioned on ctrl (unconditioned if ctrl is None). """
+        if (ctrl, targ) not in self._perms:
+            flip = self._index ^ (1 << targ)
+            if ctrl is not None:
+                flip = np.where(self._index >> ctrl & 1, flip, self._index)
+            self._perms[(ctrl, targ)] = flip
+        return self._perms[(ctrl, targ)]
+
+    def apply_matrix(self, m, qubit):
+        """ m = (m00, m01, m10, m11) """
+        self._mat.ravel()[:] = m
+        np.matmul(self._mat, self._views[self._cur][qubit], out=self._views[1-self._cur][qubit])
+        self._cur = 1 - self._cur
+
+    def apply_diagonal(self, d0, d1, qubit):
+        v = self._views[self._cur][qubit]
+        v[:, 0, :] *= d0
+        v[:, 1, :] *= d1
+
+    def apply_phases(self, phases, run):
+        """ The phases of a DiagonalRun, in place. """
+        self.state.reshape(run.shape)[...] *= phases.astype(self.state.dtype, copy=False).reshape(run.phase_shape)
+
+    def apply_x(self, qubit):
+        self._permute(self._flip(None, qubit))
+
+    def apply_cz(self, ctrl, targ):
+        hi, lo = max(ctrl, targ), min(ctrl, targ)
+        self.state.reshape(-1, 2, 2**(hi-lo-1), 2, 2**lo)[:, 1, :, 1, :] *= -1
+
+    def apply_cx(self, ctrl, targ):
+        self._permute(self._flip(ctrl, targ))
+
+    def apply_gate(self, name, qubits, theta=None):
+        if name == 'cx':
+            self.apply_cx(*qubits)
+        elif name == 'cz':
+            self.apply_cz(*qubits)
+        elif name == 'rz':
+            self.apply_diagonal(*rz_phases(theta), qubits[0])
+        elif name == 'rx':
+            self.apply_matrix(rx_matrix(theta), qubits[0])
+        elif name == 'ry':
+            self.apply_matrix(ry_matrix(theta), qubits[0])
+        elif name == 'sx':
+            self.apply_matrix(SX_ENTRIES, qubits[0])
+        elif name == 'x':
+            self.apply_x(qubits[0])
+        elif name == 'xsx':
+            self.apply_matrix(XSX_ENTRIES, qubits[0])
+        elif name == 'rzcz':
+            self.apply_diagonal(*rz_phases(theta), qubits[0])
+            self.apply_cz(*qubits)
+        elif name == 'ryrx':
+            self.apply_matrix(ry_matrix(theta), qubits[0])
+            self.apply_matrix(rx_matrix(theta), qubits[1])
+        else:
+            raise ValueError(f'gate {name} is not supported by the numpy simulator')
+
+    def run(self, circuit):
+        self.reset()
+        params = circuit.params
+        for name, qubits, p in circuit.fused:
+            if name == 'diagonal':
+                self.apply_phases(p.phases(params), p)
+            elif name == 'matrix':
+                self.apply_matrix(fused_entries(p, params, circuit.unitaries), qubits[0])
+            elif name == 'unitary':
+                self.apply_matrix(circuit.unitaries[p], qubits[0])
+            else:
+                self.apply_gate(name, qubits, params[p] if p >= 0 else None)
+        return self.state
+
+
+class BatchStatevectorSimulator:
+    """
+    The kernels of StatevectorSimulator applied to a (B, 2^n) array: row b
+    is the circuit evaluated at the b-th angle vector. Every gate is still
+    one numpy call, so the Python overhead per gate is shared by the batch.
+    Parametric gates build a (B, 2, 2) stack of matrices (or (B,) phases).
+    """
+    def __init__(self, n_qubits):
+        self.n_qubits = n_qubits
+        self.dim = 2**n_qubits
+        self._perms = {}
+        self._index = np.arange(self.dim)
+
+    def _flip(self, ctrl, targ):
+        if (ctrl, targ) not in self._perms:
+            flip = self._index ^ (1 << targ)
+            if ctrl is not None:
+                flip = np.where(self._index >> ctrl & 1, flip, self._index)
+            self._perms[(ctrl, targ)] = flip
+        return self._perms[(ctrl, targ)]
+
+    def _view(self, states, qubit):
+        return states.reshape(len(states), -1, 2, 2**qubit)
+
+    def apply_matrix(self, states, m, qubit):
+        """ m is a (2, 2) matrix shared by all rows or a (B, 2, 2) stack """
+        v = self._view(states, qubit)
+        m = m.astype(states.dtype, copy=False)
+        if m.ndim == 3:
+            m = m[:, None]
+        return np.matmul(m, v).reshape(states.shape)
+
+    def apply_diagonal(self, states, d0, d1, qubit):
+        v = self._view(states, qubit)
+        v[:, :, 0, :] *= d0[:, None, None]
+        v[:, :, 1, :] *= d1[:, None, None]
+        return states
+
+    def apply_cz(self, states, ctrl, targ):
+        hi, lo = max(ctrl, targ), min(ctrl, targ)
+        states.reshape(len(states), -1, 2, 2**(hi-lo-1), 2, 2**lo)[:, :, 1, :, 1, :] *= -1
+        return states
+
+    def apply_phases(self, states, phases, run):
+        """ (B, 2^t) phases of a DiagonalRun, row by row, in place. """
+        B = len(states)
+        states.reshape([B] + run.shape)[...] *= phases.astype(states.dtype, copy=False).reshape([B] + run.phase_shape)
+        return states
+
+    def apply_gate(self, states, name, qubits, theta=None):
+        if name == 'cx':
+            return np.take(states, self._flip(*qubits), axis=1)
+        elif name == 'cz':
+            return self.apply_cz(states, *qubits)
+        elif name == 'rz':
+            return self.apply_diagonal(states, np.exp(-0.5j*theta), np.exp(0.5j*theta), qubits[0])
+        elif name == 'rx':
+            return self.apply_matrix(states, rx_matrices(theta), qubits[0])
+        elif name == 'ry':
+            return self.apply_matrix(states, ry_matrices(theta), qubits[0])
+        elif name == 'sx':
+            return self.apply_matrix(states, SX_MATRIX, qubits[0])
+        elif name == 'x':
+            return np.take(states, self._flip(None, qubits[0]), axis=1)
+        elif name == 'xsx':
+            return self.apply_matrix(states, XSX_MATRIX, qubits[0])
+        elif name == 'rzcz':
+            states = self.apply_diagonal(states, np.exp(-0.5j*theta), np.exp(0.5j*theta), qubits[0])
+            return self.apply_cz(states, *qubits)
+        elif name == 'ryrx':
+            states = self.apply_matrix(states, ry_matrices(theta), qubits[0])
+            return self.apply_matrix(states, rx_matrices(theta), qubits[1])
+        else:
+            raise ValueError(f'gate {name} is not supported by the numpy simulator')
+
+    def run(self, circuit, angles, states=None, start=0, stop=None, dtype=np.complex128):
+        """
+        Applies circuit.ops[start:stop] with row b bound to angles[b]. The rows
+        start in |0> (of dtype) unless states (a (B, 2^n) array, used in place)
+        is given. The whole circuit runs through its fused ops.
+        """
+        angles = np.atleast_2d(np.asarray(angles, dtype=float))
+        if states is None:
+            states = np.zeros((len(angles), self.dim), dtype=dtype)
+            states[:, 0] = 1
+        ops = circuit.fused if start == 0 and stop is None else circuit.ops[start:stop]
+        for name, qubits, p in ops:
+            if name == 'diagonal':
+                states = self.apply_phases(states, p.phases(angles), p)
+            elif name == 'matrix':
+                states = self.apply_matrix(states, fused_matrices(p, angles, circuit.unitaries), qubits[0])
+            elif name == 'unitary':
+                m = np.array(circuit.unitaries[p]).reshape(2, 2)
+                states = self.apply_matrix(states, m, qubits[0])
+            else:
+                states = self.apply_gate(states, name, qubits, angles[:, p] if p >= 0 else None)
+        return states
+
+
+def rx_matrices(theta):
+    c, s = np.cos(theta/2), np.sin(theta/2)
+    return np.stack((c, -1j*s, -1j*s, c), axis=-1).reshape(-1, 2, 2)
+
+
+def ry_matrices(theta):
+    c, s = np.cos(theta/2), np.sin(theta/2)
+    return np.stack((c, -s, s, c), axis=-1).reshape(-1, 2, 2).astype(complex)
+
+
+_SIMULATORS = {}
+_BATCH_SIMULATORS = {}
+
+def get_simulator(n_qubits, dtype = np.complex128):
+    """ Returns the (cached) simulator with a preallocated buffer for n_qubits. """
+    key = (n_qubits, np.dtype(dtype))
+    if key not in _SIMULATORS:
+        _SIMULATORS[key] = StatevectorSimulator(n_qubits, dtype)
+    return _SIMULATORS[key]
+
+
+def get_batch_simulator(n_qubits):
+    if n_qubits not in _BATCH_SIMULATORS:
+        _BATCH_SIMULATORS[n_qubits] = BatchStatevectorSimulator(n_qubits)
+    return _BATCH_SIMULATORS[n_qubits]
+
+
+def expectation(state, op):
+    """ <state|op|state> for a PauliHamiltonian (bitwise kernels) or a dense Hermitian matrix. """
+    if hasattr(op, 'expectation'):
+        return op.expectation(state)
+    return float(np.vdot(state, np.asarray(op) @ state).real)
+
+
+def expectation_batch(states, op):
+    """ <state_b|op|state_b> for every row of a (B, 2^n) array. """
+    if hasattr(op, 'expectation_batch'):
+        return op.expectation_batch(states)
+    return np.sum(states.conj() * (states @ np.asarray(op).T), axis=1).real
+
+
+def state_dtype(op):
+    """ dtype of the statevectors an observable is evaluated on (complex64 for a single-precision one). """
+    return getattr(op, 'state_dtype', np.complex128)
+
+
+def has_statevector(circuit):
+    """ Whether the numpy statevector kernels (adjoint gradient, rotosolve sweep) apply: a noiseless, non-MPS OpTape. """
+    return isinstance(circuit, OpTape) and circuit.noise is None and circuit.simulator != 'mps'
+
+
+def simulate(circuit, dtype = np.complex128):
+    """
+    Statevector of an OpTape at its bound angles, on the backend the tape was
+    compiled for; dtype only applies to the numpy backend. An MPS is
+    contracted to the dense state, which is only meant for small checks.
+    """
+    if circuit.simulator == 'mps':
+        from environments.VQEs.mps import get_mps_simulator
+        sim = get_mps_simulator(circuit.num_qubits)
+        sim.run(circuit)
+        return sim.statevector()
+    if circuit.simulator == 'qiskit':
+        return Statevector(circuit.qiskit_circuit().assign_parameters(circuit.params)).data
+    return get_simulator(circuit.num_qubits, dtype).run(circuit)
+
+
+def get_energy_tape(angles, observable, circuit):
+    """
+    Energy of an OpTape with its parameter slots bound to angles.
+
+    Input:
+    angles      [array]         : one angle per parameter slot
+    observable  [PauliHamiltonian or array] : Hamiltonian
+    circuit     [OpTape]        : compiled ansatz circuit
+
+    Output:
+    expval [float] : expectation value
+    """
+    circuit.bind(angles)
+    return get_exp_val_tape(circuit, observable)
+
+
+def get_exp_val_tape(circuit, op):
+    """ Energy of an OpTape at the angles it was built with (Tr(op rho) if it carries noise). """
+    if circuit.noise is not None:
+        return circuit.noise.energy(circuit, op)
+    if circuit.simulator == 'mps':
+        from environments.VQEs.mps import mps_energy
+        return mps_energy(circuit, op)
+    if circuit.simulator == 'clifford':
+        from environments.VQEs.clifford import get_clifford_energy
+        return get_clifford_energy(circuit, op)
+    energy = expectation(simulate(circuit, state_dtype(op)), op)
+    if getattr(op, 'reference', None) is not None:
+        op.check_precision(energy, expectation(simulate(circuit), op.reference))
+    return energy
+
+
+def get_family_energies(circuit, family):
+    """
+    (K,) energies of a circuit at its bound angles for every member of a
+    HamiltonianFamily (utils/pauli_hamiltonian.py): all of them from one
+    statevector where there is one, from one MPS run on the MPS backend, and
+    component by component otherwise (noisy and Clifford tapes).
+    """
+    if not isinstance(circuit, OpTape):
+        return family.expectations(Statevector(circuit).data)
+    if has_statevector(circuit):
+        return family.expectations(simulate(circuit, family.state_dtype))
+    if circuit.simulator == 'mps' and circuit.noise is None:
+        from environments.VQEs.mps import mps_family_energies
+        return mps_family_energies(circuit, family)
+    return family.weights @ np.array([get_exp_val_tape(circuit, a) for a in family.components])
+
+
+def get_energy_batch(angles, circuit, hamiltonian):
+    """
+    Energies of an OpTape at B angle vectors. The numpy backend simulates
+    them together, the Qiskit and MPS backends and noisy tapes row by row.
+
+    Input:
+    angles      [array]         : (B, P) angles, one row per evaluation
+    circuit     [OpTape]        : compiled ansatz circuit
+    hamiltonian [PauliHamiltonian or array] : Hamiltonian
+
+    Output:
+    energies [array] : (B,) expectation values
+    """
+    if circuit.noise is not None:
+        return circuit.noise.energy_batch(angles, circuit, hamiltonian)
+    if circuit.simulator in ('qiskit', 'mps'):
+        return np.array([get_energy_tape(x, hamiltonian, circuit) for x in angles])
+    sim = get_batch_simulator(circuit.num_qubits)
+    energies = expectation_batch(sim.run(circuit, angles, dtype=state_dtype(hamiltonian)), hamiltonian)
+    if getattr(hamiltonian, 'reference', None) is not None:
+        hamiltonian.check_precision(energies, expectation_batch(sim.run(circuit, angles), hamiltonian.reference))
+    return energies
@@ -1,18 +1,23 @@
 
 
 import torch
-from ..utils.utils_synthesized import *
+from utils.utils_synthesized import *
 from sys import stdout
 import scipy
-from VQEs import VQE_nd_synthesized_1 as vc
+import environments.VQEs.VQE_nd_synthesized_1 as vc
 import os
 import numpy as np
 import copy
-from ..utils import curricula
+from utils import curricula
+from utils.pauli_hamiltonian import load_hamiltonian, load_hamiltonian_family
+from utils.angle_cache import AngleCache
+from utils.energy_memo import EnergyMemo
+from utils.action_masks import IllegalActionTable
+from utils.state_store import StateStore
 import copy
 import time
 from qiskit import QuantumCircuit
-from ..utils.synthesized_gates import ryrx
+from utils.synthesized_gates import ryrx
 
 class CircuitEnv():
 
@@ -29,8 +34,7 @@ class CircuitEnv():
         self.ham_type = conf['problem']['ham_type']
 
         if noise_values !=0:
-            indx = conf['env']['noise_values'].index(',')
-            self.noise_values = [float(noise_values[1:indx]), float(noise_values[indx+1:-1])]
+            self.noise_values = [float(value) for value in noise_values[1:-1].split(',')]
         else:
             self.noise_values = []
         self.noise_models = noise_models[0:len(self.noise_values)]
@@ -39,11 +43,29 @@ class CircuitEnv():
             self.phys_noise = True
         else:
             self.phys_noise = False
+        # density matrix (0) or the number of noise trajectories, see environments/VQEs/noise.py
+        self.noise_options = {'trajectories': conf['env']['trajectories'] if "trajectories" in conf['env'].keys() else 0,
+                              'seed': conf['env']['noise_seed'] if "noise_seed" in conf['env'].keys() else 0,
+                              'threads': conf['env']['noise_threads'] if "noise_threads" in conf['env'].keys() else 1}
+        self.energy_stderr = 0.0
 
         self.err_mitig = conf['env']['err_mitig']
+        self.simulator = conf['env']['simulator'] if "simulator" in conf['env'].keys() else 'qiskit'
+        # 'single': complex64 statevectors on the numpy simulator, precision_check compares them with complex128
+        self.precision = conf['env']['precision'] if "precision" in conf['env'].keys() else 'double'
+        self.precision_check = conf['env']['precision_check'] if "precision_check" in conf['env'].keys() else 0
+        if self.simulator == 'mps':
+            # bond dimension and SVD cutoff of the MPS backend, see environments/VQEs/mps.py
+            vc.set_mps_options(conf['env']['bond_dim'] if "bond_dim" in conf['env'].keys() else 64,
+                               conf['env']['mps_cutoff'] if "mps_cutoff" in conf['env'].keys() else 1e-10)
+        if self.simulator == 'clifford':
+            # Pauli strings of the Heisenberg-picture Hamiltonian before the statevector fallback, see environments/VQEs/clifford.py
+            vc.set_clifford_options(conf['env']['clifford_max_terms'] if "clifford_max_terms" in conf['env'].keys() else 4096)
         
 
         self.ham_model = conf['problem']['ham_model']
+        # h-sweep: ham_models of the same ham_type share the env, one of them is the target of an episode (see reset)
+        self.ham_models = conf['problem']['ham_models'] if "ham_models" in conf['problem'].keys() else None
 
         self.fake_min_energy = conf['env']['fake_min_energy'] if "fake_min_energy" in conf['env'].keys() else None
         self.fn_type = conf['env']['fn_type']
@@ -63,12 +85,17 @@ class CircuitEnv():
         
         print(f"ham_data/{self.ham_type}_{self.ham_model}.npz")
         self.curriculum_dict = {}
-        __ham = np.load(f"ham_data/{self.ham_type}_{self.ham_model}.npz")
         # print(f"ham_data/{self.ham_type}_{self.ham_model}.npz")
         # print()
         
         
-        self.hamiltonian, eigvals = __ham['hamiltonian'],__ham['eigvals']
+        self.hamiltonian, eigvals = load_hamiltonian(f"ham_data/{self.ham_type}_{self.ham_model}.npz", self.precision, self.precision_check)
+        # finite-shot energies for n_shots > 0, see environments/VQEs/shots.py
+        self.shot_estimator = vc.ShotEstimator(self.hamiltonian, self.n_shots, conf['env']['shot_seed'] if "shot_seed" in conf['env'].keys() else 0) if int(self.n_shots) > 0 else None
+        # energies of circuits already evaluated at the same angles, see utils/energy_memo.py
+        self.energy_memo = EnergyMemo(conf['env']['energy_memo'] if "energy_memo" in conf['env'].keys() else 10000)
+        # (prev_energy, energy_stderr, family_energies) of the empty circuit by problem, filled by reset()
+        self.empty_energies = {}
 
         min_eig = conf['env']['fake_min_energy'] if "fake_min_energy" in conf['env'].keys() else min(eigvals)
 
@@ -76,6 +103,16 @@ class CircuitEnv():
         self.max_eig = max(eigvals)
 
         self.curriculum_dict[self.ham_type] = curricula.__dict__[conf['env']['curriculum_type']](conf['env'], target_energy=min_eig)
+        self.family, self.target, self.family_energies = None, 0, None
+        if self.ham_models is not None:
+            if self.ham_model not in self.ham_models:
+                raise ValueError(f'ham_model {self.ham_model} is not one of ham_models {self.ham_models}')
+            # energies are also scored against the whole sweep, see HamiltonianFamily in utils/pauli_hamiltonian.py
+            self.family, self.family_eigvals = load_hamiltonian_family([f"ham_data/{self.ham_type}_{model}.npz" for model in self.ham_models], self.precision, self.precision_check)
+            self.target = self.ham_models.index(self.ham_model)
+            for model, model_eigvals in zip(self.ham_models, self.family_eigvals):
+                self.curriculum_dict[f"{self.ham_type}_{model}"] = curricula.__dict__[conf['env']['curriculum_type']](conf['env'],
+                    target_energy=self.fake_min_energy if self.fake_min_energy is not None else min(model_eigvals))
 
         # print(self.curriculum_dict)
 
@@ -91,6 +128,8 @@ class CircuitEnv():
         self.prev_energy = None
         self.moments = [0]*self.num_qubits
         self.illegal_actions = [[]]*self.num_qubits
+        self.illegal_table = IllegalActionTable(self.action_dict, self.update_illegal_actions, self.device)
+        self.store = StateStore(self.num_layers, (self.num_qubits+3+self.num_qubits)+(3+self.num_qubits), self.num_qubits, self.num_qubits+3+self.num_qubits, self.state_with_angles)
         self.energy = 0
         self.opt_ang_save = 0
 
@@ -104,6 +143,25 @@ class CircuitEnv():
             self.global_iters = conf['non_local_opt']['global_iters']
             self.optim_method = conf['non_local_opt']["method"]
             self.optim_alg = conf['non_local_opt']['optim_alg']
+            self.gradient = conf['non_local_opt']['gradient'] if "gradient" in conf['non_local_opt'].keys() else 'adjoint'
+            self.incremental = conf['non_local_opt']['incremental'] if "incremental" in conf['non_local_opt'].keys() else 0
+            self.polish_iters = conf['non_local_opt']['polish_iters'] if "polish_iters" in conf['non_local_opt'].keys() else self.global_iters // 10
+            if "angle_cache" in conf['non_local_opt'].keys() and conf['non_local_opt']['angle_cache'] > 0:
+                # optimized angles shared across episodes (and across seeds through angle_cache_path)
+                # one cache per Hamiltonian of an h-sweep, reset() selects the target's; runs share a
+                # namespace only with the same gate set, noise, backend and precision
+                settings = dict(decomposed = self.decomposed, noise_models = self.noise_models, noise_values = self.noise_values,
+                                trajectories = self.noise_options['trajectories'], n_shots = int(self.n_shots),
+                                simulator = self.simulator, precision = self.precision)
+                self.angle_caches = {model: AngleCache(conf['non_local_opt']['angle_cache'],
+                                                       conf['non_local_opt']['angle_cache_path'] if "angle_cache_path" in conf['non_local_opt'].keys() else None,
+                                                       namespace = AngleCache.namespace(f"{vc.__name__.split('.')[-1]}_{self.ham_type}_{model}_{self.optim_alg}", **settings))
+                                     for model in (self.ham_models or [self.ham_model])}
+                self.angle_cache = self.angle_caches[self.ham_model]
+            else:
+                self.angle_cache = None
+            self.angle_cache_mode = conf['non_local_opt']['angle_cache_mode'] if "angle_cache_mode" in conf['non_local_opt'].keys() else 'skip'
+            self.angle_cache_key = conf['non_local_opt']['angle_cache_key'] if "angle_cache_key" in conf['non_local_opt'].keys() else 'state'
             
 
             if 'a' in conf['non_local_opt'].keys():
@@ -128,6 +186,8 @@ class CircuitEnv():
         else:
             self.global_iters = 0
             self.optim_method = None
+            self.incremental = 0
+            self.angle_cache = None
         
             
 
@@ -142,8 +202,6 @@ class CircuitEnv():
         Variable 'step_counter' points last non-empty layer.
         """  
         
-        next_state = self.state.clone()
-        
         self.step_counter += 1
         self.depth = 2
 
@@ -190,15 +248,16 @@ class CircuitEnv():
         elif ctrl2 < self.num_qubits:
             gate_tensor = max( self.moments[ctrl2], self.moments[targ2] )
 
+        position = None
         # CX GATE APPEND
         if ctrl1 < self.num_qubits:
-            next_state[gate_tensor][targ1][ctrl1] = 1
+            position = (gate_tensor, targ1, ctrl1)
         # 1q GATE APPEND
         elif rot_qubit < self.num_qubits:
-            next_state[gate_tensor][self.num_qubits+rot_axis-1][rot_qubit] = 1
+            position = (gate_tensor, self.num_qubits+rot_axis-1, rot_qubit)
         # MOD RYRX GATE APPEND
         elif ctrl2 < self.num_qubits:
-            next_state[gate_tensor][self.num_qubits+3+targ2][ctrl2] = 1
+            position = (gate_tensor, self.num_qubits+3+targ2, ctrl2)
 
 
         if rot_qubit < self.num_qubits:
@@ -216,11 +275,12 @@ class CircuitEnv():
         self.illegal_action_new()
         if self.optim_method in ["scipy_each_step"]:
             thetas, _, opt_ang = self.scipy_optim(self.optim_alg)
-            for i in range(self.num_layers):
-                for j in range(5):
-                    next_state[i][self.num_qubits+3+self.num_qubits+j,:] = thetas[i][j,:]
+        # the optimizer ran on the circuit before this action, the new gate goes into the state after it
+        if position is not None:
+            self.store.add(*position)
+        if self.optim_method in ["scipy_each_step"]:
+            self.state[:, self.num_qubits+3+self.num_qubits:] = thetas
         self.opt_ang_save = opt_ang
-        self.state = next_state.clone()
         
         energy,energy_noiseless = self.get_energy()
 
@@ -230,7 +290,8 @@ class CircuitEnv():
         self.energy = energy
         # print(self.energy)
 
-        if energy < self.curriculum.lowest_energy and train_flag:
+        # with trajectory noise only an energy that is lower by more than its standard error counts
+        if energy + self.energy_stderr < self.curriculum.lowest_energy and train_flag:
             self.curriculum.lowest_energy = copy.copy(energy)
     
         self.error = float(abs(self.min_eig-energy))
@@ -260,15 +321,12 @@ class CircuitEnv():
             if self.step_counter == self.halting_step:
                 done = 1
         if done:
-            self.curriculum.update_threshold(energy_done=energy_done)
-            self.done_threshold = self.curriculum.get_current_threshold()
-            self.curriculum_dict[self.current_prob] = copy.deepcopy(self.curriculum)
+            # the episode is merged into the curriculum of the problem as it is now, envs that
+            # share curriculum_dict may have finished episodes since reset() (environments/vector_env.py)
+            self.curriculum_dict[self.current_prob] = self.curriculum_dict[self.current_prob].finish(self.curriculum, energy_done)
+            self.done_threshold = self.curriculum_dict[self.current_prob].get_current_threshold()
         
-        if self.state_with_angles:
-            return next_state.view(-1).to(self.device), torch.tensor(rwd, dtype=torch.float32, device=self.device), done
-        else:
-            next_state = next_state[:, :self.num_qubits+3+self.num_qubits]
-            return next_state.reshape(-1).to(self.device), torch.tensor(rwd, dtype=torch.float32, device=self.device), done
+        return self.store.observation().to(self.device), torch.tensor(rwd, dtype=torch.float32, device=self.device), done
 
     def reset(self):
         """
@@ -289,10 +347,12 @@ class CircuitEnv():
         """
         
 
-        state = torch.zeros((self.num_layers, (self.num_qubits+3+self.num_qubits)+(3+self.num_qubits), self.num_qubits))
+        state = self.store.reset()
         
 
         self.state = state
+        # angle positions that went through scipy_optim, the rest are new (incremental mode)
+        self.optimized_angles = torch.zeros_like(state[:, self.num_qubits+3+self.num_qubits:], dtype=torch.bool)
         
         
         if self.random_halt:
@@ -305,27 +365,35 @@ class CircuitEnv():
         self.current_action = [self.num_qubits]*4
         self.illegal_actions = [[]]*self.num_qubits
 
-        if self.decomposed:
-            self.make_circuit_decomposed(state)
-        else:
-            self.make_circuit(state)
         self.step_counter = -1
         
         self.moments = [0]*self.num_qubits
-        self.current_prob = self.ham_type
-        self.curriculum = copy.deepcopy(self.curriculum_dict[self.current_prob])
-        self.done_threshold = copy.deepcopy(self.curriculum.get_current_threshold())
+        if self.family is not None:
+            # target Hamiltonian of this episode, drawn uniformly from the sweep
+            self.target = np.random.randint(len(self.family))
+            self.ham_model = self.ham_models[self.target]
+            self.max_eig = max(self.family_eigvals[self.target])
+            if self.angle_cache is not None:
+                self.angle_cache = self.angle_caches[self.ham_model]
+        self.current_prob = self.ham_type if self.family is None else f"{self.ham_type}_{self.ham_model}"
+        self.curriculum = self.curriculum_dict[self.current_prob].snapshot()
+        self.done_threshold = self.curriculum.get_current_threshold()
         self.ham_type = self.ham_type
-        __ham = np.load(f"ham_data/{self.ham_type}_{self.ham_model}.npz")
-        self.hamiltonian,eigvals= __ham['hamiltonian'],__ham['eigvals']
+        self.hamiltonian, eigvals = load_hamiltonian(f"ham_data/{self.ham_type}_{self.ham_model}.npz", self.precision, self.precision_check)
         self.min_eig = self.fake_min_energy if self.fake_min_energy is not None else min(eigvals)
-        self.prev_energy = self.get_energy(state)[1]
-
-        if self.state_with_angles:
-            return state.reshape(-1).to(self.device)
+        if self.family is not None and self.shot_estimator is not None:
+            # the same stream of draws, weighted with the terms of the new target
+            self.shot_estimator = vc.ShotEstimator(self.hamiltonian, self.n_shots, self.shot_estimator.rng)
+        if self.shot_estimator is None and not (self.phys_noise and self.noise_options['trajectories']):
+            # the empty circuit has the same energy every episode, it is evaluated once per problem
+            # (shots and noise trajectories draw random numbers, those runs still evaluate it)
+            if self.current_prob not in self.empty_energies:
+                self.empty_energies[self.current_prob] = (self.get_energy(state)[1], self.energy_stderr, self.family_energies)
+            self.prev_energy, self.energy_stderr, self.family_energies = self.empty_energies[self.current_prob]
         else:
-            state = state[:, :self.num_qubits+3+self.num_qubits]
-            return state.reshape(-1).to(self.device)
+            self.prev_energy = self.get_energy(state)[1]
+
+        return self.store.observation().to(self.device)
 
     def make_circuit(self, thetas=None):
         """
@@ -345,11 +413,14 @@ class CircuitEnv():
         [0., 0.], - The ryrx (angle)
         """
         
-        state = self.state.clone()
+        state = self.state
         if thetas is None:
             thetas = state[:, (self.num_qubits+3+self.num_qubits):]
         
-        circuit = QuantumCircuit(self.num_qubits)
+        if self.simulator != 'qiskit':
+            circuit = vc.OpTape(self.num_qubits, self.simulator)
+        else:
+            circuit = QuantumCircuit(self.num_qubits)
         for i in range(self.num_layers):
             """
             OLDS!
@@ -375,7 +446,11 @@ class CircuitEnv():
             ctrl_ryrx = ryrx_pos[1]
             if len(ctrl_ryrx) != 0:
                 for r in range(len(ctrl_ryrx)):
-                    circuit.append(ryrx(thetas[i][targ_ryrx[r]+3][ctrl_ryrx[r]].item(), qubitrx=ctrl_ryrx[r], qubitry=targ_ryrx[r]), [ctrl_ryrx[r], targ_ryrx[r]])
+                    theta = thetas[i][targ_ryrx[r]+3][ctrl_ryrx[r]].item()
+                    if self.simulator != 'qiskit':
+                        circuit.ryrx(theta, qubitry=ctrl_ryrx[r], qubitrx=targ_ryrx[r])
+                    else:
+                        circuit.append(ryrx(theta, qubitrx=ctrl_ryrx[r], qubitry=targ_ryrx[r]), [ctrl_ryrx[r], targ_ryrx[r]])
             
             rot_direction_list, rot_qubit_list = oneq_gate_pos[0], oneq_gate_pos[1]
             if len(rot_qubit_list) != 0:
@@ -395,25 +470,42 @@ class CircuitEnv():
 
     def get_energy(self, thetas=None):
         
-        if self.decomposed:
-            circ = self.make_circuit_decomposed(thetas)
-        else:
-            circ = self.make_circuit(thetas)
-        qulacs_inst = vc.Parametric_Circuit(n_qubits = self.num_qubits, noise_models = self.noise_models, noise_values = self.noise_values)
+        qulacs_inst = vc.Parametric_Circuit(n_qubits = self.num_qubits, noise_models = self.noise_models, noise_values = self.noise_values, simulator = self.simulator, noise_options = self.noise_options)
         
         if self.decomposed:
-            noisy_circ = qulacs_inst.construct_ansatz_decomposed(self.state)
+            noisy_circ = qulacs_inst.construct_ansatz_decomposed(self.state, self.store.gates())
 
         else:
-            noisy_circ = qulacs_inst.construct_ansatz(self.state)
+            noisy_circ = qulacs_inst.construct_ansatz(self.state, self.store.gates())
         # print(noisy_circ)
-        expval_noisy = vc.get_exp_val(self.num_qubits,noisy_circ,self.hamiltonian,self.phys_noise,self.err_mitig)
+        if self.family is not None and not self.phys_noise and thetas is None:
+            # the ansatz is noiseless: the target's energy is one of the sweep's, all of them from one pass
+            self.family_energies = self.energy_memo.evaluate_family(noisy_circ, self.family, vc.get_family_energies)
+            expval_noisy, self.energy_stderr = float(self.family_energies[self.target]), 0.0
+        else:
+            expval_noisy, self.energy_stderr = self.energy_memo.evaluate(noisy_circ, self.hamiltonian,
+                lambda c: vc.get_exp_val(self.num_qubits,c,self.hamiltonian,self.phys_noise,self.err_mitig))
         
-        expval_noiseless = vc.get_exp_val(self.num_qubits,circ,self.hamiltonian)
+        if self.phys_noise or thetas is not None:
+            if self.decomposed:
+                circ = self.make_circuit_decomposed(thetas)
+            else:
+                circ = self.make_circuit(thetas)
+            if self.family is not None:
+                # noiseless energies of every Hamiltonian of the sweep from one pass, the target's among them
+                self.family_energies = self.energy_memo.evaluate_family(circ, self.family, vc.get_family_energies)
+                expval_noiseless = float(self.family_energies[self.target])
+            else:
+                expval_noiseless = self.energy_memo.evaluate(circ, self.hamiltonian, lambda c: vc.get_exp_val(self.num_qubits,c,self.hamiltonian))[0]
+        else:
+            # without noise the ansatz is the noiseless circuit
+            expval_noiseless = expval_noisy
 
-        shot_noise = 0       
+        if self.shot_estimator is not None:
+            expval_noisy, shot_variance = self.shot_estimator.estimate(noisy_circ)
+            self.energy_stderr = np.sqrt(self.energy_stderr**2 + shot_variance)
             
-        energy = expval_noisy + shot_noise
+        energy = expval_noisy
         
         energy_noiseless = expval_noiseless
         
@@ -439,45 +531,75 @@ class CircuitEnv():
         [0., 0.], - The ryrx (angle)
         """
 
-        state = self.state.clone()
+        state = self.state
         thetas = state[:, self.num_qubits+3+self.num_qubits:]
         if self.decomposed:
-            rot_pos = (state[:,self.num_qubits: self.num_qubits+3+self.num_qubits] == 1).nonzero( as_tuple = True )
+            rot_pos = tuple(torch.from_numpy(pos) for pos in vc.one_hot_positions(state, self.num_qubits, self.num_qubits+3+self.num_qubits, self.store.gates()))
         else:
-            rot_pos = (state[:,self.num_qubits: self.num_qubits+3+self.num_qubits] == 1).nonzero( as_tuple = True )
+            rot_pos = tuple(torch.from_numpy(pos) for pos in vc.one_hot_positions(state, self.num_qubits, self.num_qubits+3+self.num_qubits, self.store.gates()))
         # print(rot_pos)
         angles = thetas[rot_pos]
         # print(thetas)
         # print(angles.shape, 'the angles!')
 
 
-        qulacs_inst = vc.Parametric_Circuit(n_qubits=self.num_qubits,noise_models=self.noise_models,noise_values = self.noise_values)
+        qulacs_inst = vc.Parametric_Circuit(n_qubits=self.num_qubits,noise_models=self.noise_models,noise_values = self.noise_values, simulator = self.simulator, noise_options = self.noise_options)
         if self.decomposed:
-            qulacs_circuit = qulacs_inst.construct_ansatz_decomposed(state)
+            qulacs_circuit = qulacs_inst.construct_ansatz_decomposed(state, self.store.gates())
         else: 
-            qulacs_circuit = qulacs_inst.construct_ansatz(state)
+            qulacs_circuit = qulacs_inst.construct_ansatz(state, self.store.gates())
         
         x0 = np.asarray(angles.cpu().detach())
 
         def cost(x):
-            return vc.get_energy_qiskit(x, observable = self.hamiltonian, circuit = qulacs_circuit,
-            n_qubits = self.num_qubits,
-            n_shots = int(self.n_shots), phys_noise = self.phys_noise,
-                      which_angles=[])
-
-        if list(which_angles):
-            result_min_qulacs = scipy.optimize.minimize(cost, x0 = x0[which_angles], method = method, options = {'maxiter':self.global_iters})
-            x0[which_angles] = result_min_qulacs['x']
-            thetas = state[:, self.num_qubits+3+self.num_qubits:]
-            thetas[rot_pos] = torch.tensor(x0, dtype=torch.float)
+            # trial energies are recorded for get_energy, see utils/energy_memo.py
+            return self.energy_memo.cost(x, qulacs_circuit, self.hamiltonian, lambda x: vc.get_energy_qiskit(x, observable = self.hamiltonian, circuit = qulacs_circuit,
+                n_qubits = self.num_qubits,
+                n_shots = int(self.n_shots), phys_noise = self.phys_noise,
+                          which_angles=[]))
+
+        def optimize(x, which, maxiter):
+            return vc.optimize(cost, x, qulacs_circuit, self.hamiltonian, method,
+                               self.global_iters if maxiter is None else maxiter, self.gradient, which)
+
+        form = vc.canonicalize(qulacs_circuit) if self.angle_cache is not None and self.angle_cache_key == 'canonical' else None
+        cache_key, cached = self.angle_cache.lookup(state[:, :self.num_qubits+3+self.num_qubits], form, len(x0)) if self.angle_cache is not None else (None, None)
+        if cached is not None and self.angle_cache_mode == 'skip':
+            result_min_qulacs = scipy.optimize.OptimizeResult(x = cached.angles, fun = cached.energy, nfev = 0)
         else:
-            result_min_qulacs = scipy.optimize.minimize(cost, x0 = x0, method = method, options = {'maxiter':self.global_iters})
-            thetas = state[:, self.num_qubits+3+self.num_qubits:]
-            thetas[rot_pos] = torch.tensor(result_min_qulacs['x'], dtype=torch.float)
-        # print(thetas)
+            if cached is not None:
+                x0 = cached.angles.copy()
+            if self.incremental:
+                new_angles = np.nonzero(~self.optimized_angles[rot_pos].cpu().numpy())[0]
+                result_min_qulacs = vc.incremental_optimize(optimize, x0, new_angles, self.polish_iters)
+            elif list(which_angles):
+                result_min_qulacs = optimize(x0, which_angles, None)
+            else:
+                result_min_qulacs = optimize(x0, None, None)
+            if self.angle_cache is not None:
+                self.angle_cache.put(cache_key, result_min_qulacs['x'], result_min_qulacs.get('fun'), result_min_qulacs['nfev'], form)
+        self.optimized_angles[rot_pos] = True
+        thetas = state[:, self.num_qubits+3+self.num_qubits:].clone()
+        thetas[rot_pos] = torch.tensor(result_min_qulacs['x'], dtype=torch.float)
 
         return thetas, result_min_qulacs['nfev'], result_min_qulacs['x']
 
+    def canonical_key(self, state = None):
+        """
+        Key of the circuit of state (default: the current one) up to gate
+        commutation, cancellations and merged rotations, see
+        environments/VQEs/canonical.py. Action sequences that build the same
+        circuit share it, so the angle cache and the replay memory can key on it.
+        """
+        gates = self.store.gates() if state is None else None
+        state = self.state if state is None else state
+        qulacs_inst = vc.Parametric_Circuit(n_qubits=self.num_qubits,noise_models=self.noise_models,noise_values = self.noise_values, simulator = self.simulator, noise_options = self.noise_options)
+        if self.decomposed:
+            qulacs_circuit = qulacs_inst.construct_ansatz_decomposed(state, gates)
+        else:
+            qulacs_circuit = qulacs_inst.construct_ansatz(state, gates)
+        return vc.canonicalize(qulacs_circuit).key
+
     def reward_fn(self, energy):
         
         
@@ -676,8 +798,15 @@ class CircuitEnv():
 
         
     def illegal_action_new(self):
-        action = self.current_action
-        illegal_action = self.illegal_actions
+        """ Updates the illegal actions with the last action and returns their ids (utils/action_masks.py). """
+        self.illegal_actions, illegal_action_decode = self.illegal_table.step(self.illegal_actions, self.current_action)
+        return illegal_action_decode
+
+    def illegal_action_mask(self):
+        """ Boolean mask of size action_size, True for the current illegal actions. """
+        return self.illegal_table.mask(self.illegal_actions)
+
+    def update_illegal_actions(self, illegal_action, action):
         ctrl, targ = action[0], (action[0] + action[1]) % self.num_qubits
         rot_qubit, rot_axis = action[2], action[3]
 
@@ -794,13 +923,7 @@ class CircuitEnv():
                 illegal_action[indx] = illegal_action[indx+1]
                 illegal_action[indx+1] = []
         
-        illegal_action_decode = []
-        for key, contain in self.action_dict.items():
-            for ill_action in illegal_action:
-                if ill_action == contain:
-                    illegal_action_decode.append(key)
-        self.illegal_actions = illegal_action
-        return illegal_action_decode
+        return illegal_action
 
 
 
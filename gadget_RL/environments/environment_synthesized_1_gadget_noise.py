@@ -6,10 +6,14 @@ import environments.VQEs.VQE_synthesized_1_gadget_noise as vc
 import numpy as np
 import copy
 from utils import curricula
+from utils.pauli_hamiltonian import load_hamiltonian, load_hamiltonian_family
+from utils.angle_cache import AngleCache
+from utils.energy_memo import EnergyMemo
+from utils.action_masks import IllegalActionTable
+from utils.state_store import StateStore
 import copy
 from qiskit import QuantumCircuit
 from utils.synthesized_gates import *
-from qiskit.quantum_info import random_unitary
 
 class CircuitEnv():
 
@@ -26,8 +30,7 @@ class CircuitEnv():
         self.ham_type = conf['problem']['ham_type']
 
         if noise_values !=0:
-            indx = conf['env']['noise_values'].index(',')
-            self.noise_values = [float(noise_values[1:indx]), float(noise_values[indx+1:-1])]
+            self.noise_values = [float(value) for value in noise_values[1:-1].split(',')]
         else:
             self.noise_values = []
         self.noise_models = noise_models[0:len(self.noise_values)]
@@ -36,9 +39,30 @@ class CircuitEnv():
             self.phys_noise = True
         else:
             self.phys_noise = False
+        # density matrix (0) or the number of noise trajectories, see environments/VQEs/noise.py
+        self.noise_options = {'trajectories': conf['env']['trajectories'] if "trajectories" in conf['env'].keys() else 0,
+                              'seed': conf['env']['noise_seed'] if "noise_seed" in conf['env'].keys() else 0,
+                              'threads': conf['env']['noise_threads'] if "noise_threads" in conf['env'].keys() else 1}
+        self.energy_stderr = 0.0
+        # noise unitary after the rzcz gadgets, injected with gadget_noise_prob
+        self.gadget_noise = vc.GadgetNoise(conf['env']['gadget_noise_prob'] if "gadget_noise_prob" in conf['env'].keys() else 0.5,
+                                           conf['env']['gadget_noise_seed'] if "gadget_noise_seed" in conf['env'].keys() else 0)
 
         self.err_mitig = conf['env']['err_mitig']
+        self.simulator = conf['env']['simulator'] if "simulator" in conf['env'].keys() else 'qiskit'
+        # 'single': complex64 statevectors on the numpy simulator, precision_check compares them with complex128
+        self.precision = conf['env']['precision'] if "precision" in conf['env'].keys() else 'double'
+        self.precision_check = conf['env']['precision_check'] if "precision_check" in conf['env'].keys() else 0
+        if self.simulator == 'mps':
+            # bond dimension and SVD cutoff of the MPS backend, see environments/VQEs/mps.py
+            vc.set_mps_options(conf['env']['bond_dim'] if "bond_dim" in conf['env'].keys() else 64,
+                               conf['env']['mps_cutoff'] if "mps_cutoff" in conf['env'].keys() else 1e-10)
+        if self.simulator == 'clifford':
+            # Pauli strings of the Heisenberg-picture Hamiltonian before the statevector fallback, see environments/VQEs/clifford.py
+            vc.set_clifford_options(conf['env']['clifford_max_terms'] if "clifford_max_terms" in conf['env'].keys() else 4096)
         self.ham_model = conf['problem']['ham_model']
+        # h-sweep: ham_models of the same ham_type share the env, one of them is the target of an episode (see reset)
+        self.ham_models = conf['problem']['ham_models'] if "ham_models" in conf['problem'].keys() else None
         self.fake_min_energy = conf['env']['fake_min_energy'] if "fake_min_energy" in conf['env'].keys() else None
         self.fn_type = conf['env']['fn_type']
         
@@ -59,12 +83,17 @@ class CircuitEnv():
         
         print(f"ham_data/{self.ham_type}_{self.ham_model}.npz")
         self.curriculum_dict = {}
-        __ham = np.load(f"ham_data/{self.ham_type}_{self.ham_model}.npz")
         # print(f"ham_data/{self.ham_type}_{self.ham_model}.npz")
         # print()
         
         
-        self.hamiltonian, eigvals = __ham['hamiltonian'],__ham['eigvals']
+        self.hamiltonian, eigvals = load_hamiltonian(f"ham_data/{self.ham_type}_{self.ham_model}.npz", self.precision, self.precision_check)
+        # finite-shot energies for n_shots > 0, see environments/VQEs/shots.py
+        self.shot_estimator = vc.ShotEstimator(self.hamiltonian, self.n_shots, conf['env']['shot_seed'] if "shot_seed" in conf['env'].keys() else 0) if int(self.n_shots) > 0 else None
+        # energies of circuits already evaluated at the same angles, see utils/energy_memo.py
+        self.energy_memo = EnergyMemo(conf['env']['energy_memo'] if "energy_memo" in conf['env'].keys() else 10000)
+        # (prev_energy, energy_stderr, family_energies) of the empty circuit by problem, filled by reset()
+        self.empty_energies = {}
 
         min_eig = conf['env']['fake_min_energy'] if "fake_min_energy" in conf['env'].keys() else min(eigvals)
 
@@ -72,6 +101,16 @@ class CircuitEnv():
         self.max_eig = max(eigvals)
 
         self.curriculum_dict[self.ham_type] = curricula.__dict__[conf['env']['curriculum_type']](conf['env'], target_energy=min_eig)
+        self.family, self.target, self.family_energies = None, 0, None
+        if self.ham_models is not None:
+            if self.ham_model not in self.ham_models:
+                raise ValueError(f'ham_model {self.ham_model} is not one of ham_models {self.ham_models}')
+            # energies are also scored against the whole sweep, see HamiltonianFamily in utils/pauli_hamiltonian.py
+            self.family, self.family_eigvals = load_hamiltonian_family([f"ham_data/{self.ham_type}_{model}.npz" for model in self.ham_models], self.precision, self.precision_check)
+            self.target = self.ham_models.index(self.ham_model)
+            for model, model_eigvals in zip(self.ham_models, self.family_eigvals):
+                self.curriculum_dict[f"{self.ham_type}_{model}"] = curricula.__dict__[conf['env']['curriculum_type']](conf['env'],
+                    target_energy=self.fake_min_energy if self.fake_min_energy is not None else min(model_eigvals))
 
         # print(self.curriculum_dict)
 
@@ -87,6 +126,8 @@ class CircuitEnv():
         self.prev_energy = None
         self.moments = [0]*self.num_qubits
         self.illegal_actions = [[]]*self.num_qubits
+        self.illegal_table = IllegalActionTable(self.action_dict, self.update_illegal_actions, self.device)
+        self.store = StateStore(self.num_layers, self.num_qubits+3+self.num_qubits+1+self.num_qubits, self.num_qubits, self.num_qubits+3+self.num_qubits, self.state_with_angles)
         self.energy = 0
         self.opt_ang_save = 0
 
@@ -100,6 +141,25 @@ class CircuitEnv():
             self.global_iters = conf['non_local_opt']['global_iters']
             self.optim_method = conf['non_local_opt']["method"]
             self.optim_alg = conf['non_local_opt']['optim_alg']
+            self.gradient = conf['non_local_opt']['gradient'] if "gradient" in conf['non_local_opt'].keys() else 'adjoint'
+            self.incremental = conf['non_local_opt']['incremental'] if "incremental" in conf['non_local_opt'].keys() else 0
+            self.polish_iters = conf['non_local_opt']['polish_iters'] if "polish_iters" in conf['non_local_opt'].keys() else self.global_iters // 10
+            if "angle_cache" in conf['non_local_opt'].keys() and conf['non_local_opt']['angle_cache'] > 0:
+                # optimized angles shared across episodes (and across seeds through angle_cache_path)
+                # one cache per Hamiltonian of an h-sweep, reset() selects the target's; runs share a
+                # namespace only with the same gate set, noise, backend and precision
+                settings = dict(decomposed = self.decomposed, noise_models = self.noise_models, noise_values = self.noise_values,
+                                trajectories = self.noise_options['trajectories'], n_shots = int(self.n_shots),
+                                simulator = self.simulator, precision = self.precision, gadget_noise = (self.gadget_noise.prob, self.gadget_noise.entries))
+                self.angle_caches = {model: AngleCache(conf['non_local_opt']['angle_cache'],
+                                                       conf['non_local_opt']['angle_cache_path'] if "angle_cache_path" in conf['non_local_opt'].keys() else None,
+                                                       namespace = AngleCache.namespace(f"{vc.__name__.split('.')[-1]}_{self.ham_type}_{model}_{self.optim_alg}", **settings))
+                                     for model in (self.ham_models or [self.ham_model])}
+                self.angle_cache = self.angle_caches[self.ham_model]
+            else:
+                self.angle_cache = None
+            self.angle_cache_mode = conf['non_local_opt']['angle_cache_mode'] if "angle_cache_mode" in conf['non_local_opt'].keys() else 'skip'
+            self.angle_cache_key = conf['non_local_opt']['angle_cache_key'] if "angle_cache_key" in conf['non_local_opt'].keys() else 'state'
             
 
             if 'a' in conf['non_local_opt'].keys():
@@ -124,6 +184,8 @@ class CircuitEnv():
         else:
             self.global_iters = 0
             self.optim_method = None
+            self.incremental = 0
+            self.angle_cache = None
         
             
 
@@ -136,8 +198,6 @@ class CircuitEnv():
         Variable 'step_counter' points last non-empty layer.
         """  
         
-        next_state = self.state.clone()
-        
         self.step_counter += 1
 
         """
@@ -186,15 +246,16 @@ class CircuitEnv():
         elif ctrl2 < self.num_qubits:
             gate_tensor = max( self.moments[ctrl2], self.moments[targ2] )
 
+        position = None
         # CZ GATE APPEND
         if ctrl1 < self.num_qubits:
-            next_state[gate_tensor][targ1][ctrl1] = 1
+            position = (gate_tensor, targ1, ctrl1)
         # MOD 1q GATE APPEND (THE LAST ROW IS RZ)
         elif rot_qubit < self.num_qubits:
-            next_state[gate_tensor][self.num_qubits+rot_axis-1][rot_qubit] = 1
+            position = (gate_tensor, self.num_qubits+rot_axis-1, rot_qubit)
         # MOD RZCZ GATE APPEND
         elif ctrl2 < self.num_qubits:
-            next_state[gate_tensor][targ2+self.num_qubits+3][ctrl2] = 1
+            position = (gate_tensor, targ2+self.num_qubits+3, ctrl2)
 
         """
         # RZCZ GATE APPEND
@@ -221,11 +282,12 @@ class CircuitEnv():
         self.illegal_action_new()
         if self.optim_method in ["scipy_each_step"]:
             thetas, _, _ = self.scipy_optim(self.optim_alg)
-            for i in range(self.num_layers):
-                for j in range(3):
-                    next_state[i][self.num_qubits+3+self.num_qubits+j,:] = thetas[i][j,:]
+        # the optimizer ran on the circuit before this action, the new gate goes into the state after it
+        if position is not None:
+            self.store.add(*position)
+        if self.optim_method in ["scipy_each_step"]:
+            self.state[:, self.num_qubits+3+self.num_qubits:] = thetas
         self.opt_ang_save = 0 # opt_ang
-        self.state = next_state.clone()
         
         energy,energy_noiseless = self.get_energy()
 
@@ -235,7 +297,8 @@ class CircuitEnv():
         self.energy = energy
         # print(self.energy)
 
-        if energy < self.curriculum.lowest_energy and train_flag:
+        # with trajectory noise only an energy that is lower by more than its standard error counts
+        if energy + self.energy_stderr < self.curriculum.lowest_energy and train_flag:
             self.curriculum.lowest_energy = copy.copy(energy)
     
         self.error = float(abs(self.min_eig-energy))
@@ -263,15 +326,12 @@ class CircuitEnv():
             if self.step_counter == self.halting_step:
                 done = 1
         if done:
-            self.curriculum.update_threshold(energy_done=energy_done)
-            self.done_threshold = self.curriculum.get_current_threshold()
-            self.curriculum_dict[self.current_prob] = copy.deepcopy(self.curriculum)
+            # the episode is merged into the curriculum of the problem as it is now, envs that
+            # share curriculum_dict may have finished episodes since reset() (environments/vector_env.py)
+            self.curriculum_dict[self.current_prob] = self.curriculum_dict[self.current_prob].finish(self.curriculum, energy_done)
+            self.done_threshold = self.curriculum_dict[self.current_prob].get_current_threshold()
         
-        if self.state_with_angles:
-            return next_state.view(-1).to(self.device), torch.tensor(rwd, dtype=torch.float32, device=self.device), done
-        else:
-            next_state = next_state[:, :self.num_qubits+3+self.num_qubits]
-            return next_state.reshape(-1).to(self.device), torch.tensor(rwd, dtype=torch.float32, device=self.device), done
+        return self.store.observation().to(self.device), torch.tensor(rwd, dtype=torch.float32, device=self.device), done
 
     def reset(self):
         """
@@ -285,12 +345,15 @@ class CircuitEnv():
             append it in circuit creator)
         """
 
-        state = torch.zeros((self.num_layers, self.num_qubits+3+self.num_qubits+1+self.num_qubits, self.num_qubits))
+        state = self.store.reset()
         """
         EXPLAIN
         state = torch.zeros((self.num_layers, self.num_qubits+3+self.num_qubits+self.num_qubits+1, self.num_qubits))
         """
         self.state = state
+        self.gadget_noise.reset()
+        # angle positions that went through scipy_optim, the rest are new (incremental mode)
+        self.optimized_angles = torch.zeros_like(state[:, self.num_qubits+3+self.num_qubits:], dtype=torch.bool)
         
         
         if self.random_halt:
@@ -303,24 +366,35 @@ class CircuitEnv():
         self.current_action = [self.num_qubits]*6
         self.illegal_actions = [[]]*self.num_qubits
 
-        self.make_circuit_decomposed(state)
         self.step_counter = -1
         
         self.moments = [0]*self.num_qubits
-        self.current_prob = self.ham_type
-        self.curriculum = copy.deepcopy(self.curriculum_dict[self.current_prob])
-        self.done_threshold = copy.deepcopy(self.curriculum.get_current_threshold())
+        if self.family is not None:
+            # target Hamiltonian of this episode, drawn uniformly from the sweep
+            self.target = np.random.randint(len(self.family))
+            self.ham_model = self.ham_models[self.target]
+            self.max_eig = max(self.family_eigvals[self.target])
+            if self.angle_cache is not None:
+                self.angle_cache = self.angle_caches[self.ham_model]
+        self.current_prob = self.ham_type if self.family is None else f"{self.ham_type}_{self.ham_model}"
+        self.curriculum = self.curriculum_dict[self.current_prob].snapshot()
+        self.done_threshold = self.curriculum.get_current_threshold()
         self.ham_type = self.ham_type
-        __ham = np.load(f"ham_data/{self.ham_type}_{self.ham_model}.npz")
-        self.hamiltonian,eigvals= __ham['hamiltonian'],__ham['eigvals']
+        self.hamiltonian, eigvals = load_hamiltonian(f"ham_data/{self.ham_type}_{self.ham_model}.npz", self.precision, self.precision_check)
         self.min_eig = self.fake_min_energy if self.fake_min_energy is not None else min(eigvals)
-        self.prev_energy = self.get_energy(state)[1]
-
-        if self.state_with_angles:
-            return state.reshape(-1).to(self.device)
+        if self.family is not None and self.shot_estimator is not None:
+            # the same stream of draws, weighted with the terms of the new target
+            self.shot_estimator = vc.ShotEstimator(self.hamiltonian, self.n_shots, self.shot_estimator.rng)
+        if self.shot_estimator is None and not (self.phys_noise and self.noise_options['trajectories']):
+            # the empty circuit has the same energy every episode, it is evaluated once per problem
+            # (shots and noise trajectories draw random numbers, those runs still evaluate it)
+            if self.current_prob not in self.empty_energies:
+                self.empty_energies[self.current_prob] = (self.get_energy(state)[1], self.energy_stderr, self.family_energies)
+            self.prev_energy, self.energy_stderr, self.family_energies = self.empty_energies[self.current_prob]
         else:
-            state = state[:, :self.num_qubits+3+self.num_qubits]
-            return state.reshape(-1).to(self.device)
+            self.prev_energy = self.get_energy(state)[1]
+
+        return self.store.observation().to(self.device)
 
     def make_circuit_decomposed(self, thetas=None):
         """
@@ -367,11 +441,14 @@ class CircuitEnv():
         [0., 0., 0.], - The RZCZ (angle)
         [0., 0., 0.], - The RZ (angle)
         """
-        state = self.state.clone()
+        state = self.state
         if thetas is None:
             thetas = state[:, self.num_qubits+3+self.num_qubits:]
         
-        circuit = QuantumCircuit(self.num_qubits)
+        if self.simulator != 'qiskit':
+            circuit = vc.OpTape(self.num_qubits, self.simulator)
+        else:
+            circuit = QuantumCircuit(self.num_qubits)
         for i in range(self.num_layers):
             """
             OLDS!
@@ -397,10 +474,16 @@ class CircuitEnv():
             ctrl_rzcz = rzcz_pos[1]
             if len(ctrl_rzcz) != 0:
                 for r in range(len(ctrl_rzcz)):
-                    circuit.append(rzcz(thetas[i][targ_rzcz[r]+1][ctrl_rzcz[r]].item(), ctrl=ctrl_rzcz[r], targ=targ_rzcz[r]), [ctrl_rzcz[r], targ_rzcz[r]])
-                    if random.random() < 0.5:
-                        noise_unitary = random_unitary(2, seed=42)
-                        circuit.append(noise_unitary, [ctrl_rzcz[r]])
+                    theta = thetas[i][targ_rzcz[r]+1][ctrl_rzcz[r]].item()
+                    if self.simulator != 'qiskit':
+                        circuit.rzcz(theta, ctrl_rzcz[r], targ_rzcz[r])
+                    else:
+                        circuit.append(rzcz(theta, ctrl=ctrl_rzcz[r], targ=targ_rzcz[r]), [ctrl_rzcz[r], targ_rzcz[r]])
+                    if self.gadget_noise.inject(i, ctrl_rzcz[r], targ_rzcz[r]):
+                        if self.simulator != 'qiskit':
+                            circuit.unitary(self.gadget_noise.matrix, ctrl_rzcz[r])
+                        else:
+                            circuit.unitary(self.gadget_noise.matrix, [ctrl_rzcz[r]])
                         
             rot_direction_list, rot_qubit_list = oneq_gate_pos[0], oneq_gate_pos[1]
             if len(rot_qubit_list) != 0:
@@ -420,9 +503,30 @@ class CircuitEnv():
 
     def get_energy(self, thetas=None):
         
-        circ = self.make_circuit_decomposed(thetas)
-        expval_noiseless = vc.get_exp_val(self.num_qubits,circ,self.hamiltonian)
-        energy = expval_noiseless + 0
+        # the ansatz of the optimizer, so its last energies are in the memo; it is noiseless without phys_noise
+        qiskit_inst = vc.Parametric_Circuit(n_qubits = self.num_qubits, noise_models = self.noise_models, noise_values = self.noise_values, simulator = self.simulator, noise_options = self.noise_options,
+                                           gadget_noise = self.gadget_noise)
+        noisy_circ = qiskit_inst.construct_ansatz_decomposed(self.state, self.store.gates())
+        if self.family is not None and not self.phys_noise and thetas is None:
+            # the ansatz is noiseless: the target's energy is one of the sweep's, all of them from one pass
+            self.family_energies = self.energy_memo.evaluate_family(noisy_circ, self.family, vc.get_family_energies)
+            energy, self.energy_stderr = float(self.family_energies[self.target]), 0.0
+        else:
+            energy, self.energy_stderr = self.energy_memo.evaluate(noisy_circ, self.hamiltonian,
+                lambda c: vc.get_exp_val(self.num_qubits,c,self.hamiltonian,self.phys_noise,self.err_mitig))
+        if self.phys_noise or thetas is not None:
+            circ = self.make_circuit_decomposed(thetas)
+            if self.family is not None:
+                # noiseless energies of every Hamiltonian of the sweep from one pass, the target's among them
+                self.family_energies = self.energy_memo.evaluate_family(circ, self.family, vc.get_family_energies)
+                expval_noiseless = float(self.family_energies[self.target])
+            else:
+                expval_noiseless = self.energy_memo.evaluate(circ, self.hamiltonian, lambda c: vc.get_exp_val(self.num_qubits,c,self.hamiltonian))[0]
+        else:
+            expval_noiseless = energy
+        if self.shot_estimator is not None:
+            energy, shot_variance = self.shot_estimator.estimate(noisy_circ)
+            self.energy_stderr = np.sqrt(self.energy_stderr**2 + shot_variance)
         energy_noiseless = expval_noiseless        
         return energy, energy_noiseless
     
@@ -458,13 +562,14 @@ class CircuitEnv():
         THE TODO:   Move "The RZCZ" after "The X" so that you can directly extract the rotation position
                     and the angles.
         """
-        state = self.state.clone()
+        state = self.state
         thetas = state[:, self.num_qubits+3+self.num_qubits:]
-        rot_pos = (state[:,self.num_qubits+2: self.num_qubits+2+3] == 1).nonzero( as_tuple = True )
+        rot_pos = tuple(torch.from_numpy(pos) for pos in vc.one_hot_positions(state, self.num_qubits+2, 2*self.num_qubits+3, self.store.gates()))
         angles = thetas[rot_pos]
-        qiskit_inst = vc.Parametric_Circuit(n_qubits=self.num_qubits,noise_models=self.noise_models,noise_values = self.noise_values)
+        qiskit_inst = vc.Parametric_Circuit(n_qubits=self.num_qubits,noise_models=self.noise_models,noise_values = self.noise_values, simulator = self.simulator, noise_options = self.noise_options,
+                                           gadget_noise = self.gadget_noise)
         
-        qiskit_circuit = qiskit_inst.construct_ansatz_decomposed(state)
+        qiskit_circuit = qiskit_inst.construct_ansatz_decomposed(state, self.store.gates())
         # print('-x-x-x-x-')
         # print(qiskit_circuit)
         # print('-x-x-x-x-')
@@ -472,23 +577,53 @@ class CircuitEnv():
         x0 = np.asarray(angles.cpu().detach())
 
         def cost(x):
-            return vc.get_energy_qiskit(x, observable = self.hamiltonian, circuit = qiskit_circuit,
-            n_qubits = self.num_qubits,
-            n_shots = int(self.n_shots), phys_noise = self.phys_noise,
-                      which_angles=[])
-
-        if list(which_angles):
-            result_min_qiskit = scipy.optimize.minimize(cost, x0 = x0[which_angles], method = method, options = {'maxiter':self.global_iters})
-            x0[which_angles] = result_min_qiskit['x']
-            thetas = state[:, self.num_qubits+3+self.num_qubits:]
-            thetas[rot_pos] = torch.tensor(x0, dtype=torch.float)
+            # trial energies are recorded for get_energy, see utils/energy_memo.py
+            return self.energy_memo.cost(x, qiskit_circuit, self.hamiltonian, lambda x: vc.get_energy_qiskit(x, observable = self.hamiltonian, circuit = qiskit_circuit,
+                n_qubits = self.num_qubits,
+                n_shots = int(self.n_shots), phys_noise = self.phys_noise,
+                          which_angles=[]))
+
+        def optimize(x, which, maxiter):
+            return vc.optimize(cost, x, qiskit_circuit, self.hamiltonian, method,
+                               self.global_iters if maxiter is None else maxiter, self.gradient, which)
+
+        form = vc.canonicalize(qiskit_circuit) if self.angle_cache is not None and self.angle_cache_key == 'canonical' else None
+        # the injected gadget noise changes every episode, it is part of the key
+        cache_key, cached = self.angle_cache.lookup(state[:, :self.num_qubits+3+self.num_qubits], form, len(x0), self.gadget_noise.injected()) if self.angle_cache is not None else (None, None)
+        if cached is not None and self.angle_cache_mode == 'skip':
+            result_min_qiskit = scipy.optimize.OptimizeResult(x = cached.angles, fun = cached.energy, nfev = 0)
         else:
-            result_min_qiskit = scipy.optimize.minimize(cost, x0 = x0, method = method, options = {'maxiter':self.global_iters})
-            thetas = state[:, self.num_qubits+3+self.num_qubits:]
-            thetas[rot_pos] = torch.tensor(result_min_qiskit['x'], dtype=torch.float)
+            if cached is not None:
+                x0 = cached.angles.copy()
+            if self.incremental:
+                new_angles = np.nonzero(~self.optimized_angles[rot_pos].cpu().numpy())[0]
+                result_min_qiskit = vc.incremental_optimize(optimize, x0, new_angles, self.polish_iters)
+            elif list(which_angles):
+                result_min_qiskit = optimize(x0, which_angles, None)
+            else:
+                result_min_qiskit = optimize(x0, None, None)
+            if self.angle_cache is not None:
+                self.angle_cache.put(cache_key, result_min_qiskit['x'], result_min_qiskit.get('fun'), result_min_qiskit['nfev'], form)
+        self.optimized_angles[rot_pos] = True
+        thetas = state[:, self.num_qubits+3+self.num_qubits:].clone()
+        thetas[rot_pos] = torch.tensor(result_min_qiskit['x'], dtype=torch.float)
 
         return thetas, result_min_qiskit['nfev'], result_min_qiskit['x']
 
+    def canonical_key(self, state = None):
+        """
+        Key of the circuit of state (default: the current one) up to gate
+        commutation, cancellations and merged rotations, see
+        environments/VQEs/canonical.py. Action sequences that build the same
+        circuit share it, so the angle cache and the replay memory can key on it.
+        """
+        gates = self.store.gates() if state is None else None
+        state = self.state if state is None else state
+        qiskit_inst = vc.Parametric_Circuit(n_qubits=self.num_qubits,noise_models=self.noise_models,noise_values = self.noise_values, simulator = self.simulator, noise_options = self.noise_options,
+                                           gadget_noise = self.gadget_noise)
+        qiskit_circuit = qiskit_inst.construct_ansatz_decomposed(state, gates)
+        return vc.canonicalize(qiskit_circuit).key
+
     def reward_fn(self, energy):
         
         
@@ -546,8 +681,15 @@ class CircuitEnv():
 
         
     def illegal_action_new(self):
-        action = self.current_action
-        illegal_action = self.illegal_actions
+        """ Updates the illegal actions with the last action and returns their ids (utils/action_masks.py). """
+        self.illegal_actions, illegal_action_decode = self.illegal_table.step(self.illegal_actions, self.current_action)
+        return illegal_action_decode
+
+    def illegal_action_mask(self):
+        """ Boolean mask of size action_size, True for the current illegal actions. """
+        return self.illegal_table.mask(self.illegal_actions)
+
+    def update_illegal_actions(self, illegal_action, action):
         
         ctrl_cz, targ_cz = action[0], action[1] #CZ
         ctrl_rzcz, targ_rzcz = action[2], (action[2] + action[3]) % self.num_qubits # RZCZ
@@ -728,13 +870,7 @@ class CircuitEnv():
                 illegal_action[indx] = illegal_action[indx+1]
                 illegal_action[indx+1] = []
         
-        illegal_action_decode = []
-        for key, contain in dictionary_of_actions_synthesized(self.num_qubits).items():
-            for ill_action in illegal_action:
-                if ill_action == contain:
-                    illegal_action_decode.append(key)
-        self.illegal_actions = illegal_action
-        return illegal_action_decode
+        return illegal_action
 
 
 
@@ -0,0 +1,215 @@
+"""
+N CircuitEnvs in worker processes.
+
+SubprocCircuitEnv has the interface of VectorCircuitEnv (environments/vector_env.py),
+but every environment lives in its own process, so the angle optimizations of
+one step run on as many cores as there are workers. step_async(actions) sends
+the actions and returns at once; step_wait() collects the results. Workers
+write their states into one shared-memory float32 array ([N, state] current
+states and [N, state] last states of finished episodes), only rewards, done
+flags and a few scalars of the env go through the pipes.
+
+The parent keeps a view of every env (envs[i], a SimpleNamespace with
+prev_energy, done_threshold, current_prob, target, error, ...), refreshed after each
+reset and step, which transform(state, env) and the training loop read.
+
+The parent also keeps the curricula of the envs (curriculum_dict). A worker
+whose episode ends returns the episode's curriculum instead of resetting;
+the parent merges it (Curriculum.finish) and resets the env with its
+curricula, so the workers share them as the envs of VectorCircuitEnv do.
+
+Worker i seeds numpy, random and torch with seed + i, so the workers draw
+different episodes. A slot whose action is None is not stepped, as in
+VectorCircuitEnv.
+"""
+import importlib
+import multiprocessing as mp
+import random
+import traceback
+from multiprocessing import shared_memory
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+
+ENV_ATTRS = ('prev_energy', 'done_threshold', 'current_prob', 'error', 'error_noiseless',
+             'opt_ang_save', 'rwd', 'target')
+
+
+def _env_attrs(env):
+    return {attr: getattr(env, attr, None) for attr in ENV_ATTRS}
+
+
+def _worker(remote, env_module, conf, seed):
+    torch.set_num_threads(1)
+    np.random.seed(seed)
+    random.seed(seed)
+    torch.manual_seed(seed)
+    try:
+        env = importlib.import_module(env_module).CircuitEnv(conf, device=torch.device('cpu'))
+        # the state is allocated by reset(), its length can differ from env.state_size
+        state_len = env.reset().numel()
+        remote.send(('spec', (state_len, env.state_size, env.action_size, env.num_layers, env.curriculum_dict)))
+        index, shm_name, num_envs = remote.recv()
+        shm = shared_memory.SharedMemory(name=shm_name)
+        buffer = np.ndarray((2, num_envs, state_len), dtype=np.float32, buffer=shm.buf)
+        states, final_states = buffer[0, index], buffer[1, index]
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'reset':
+                # the curricula of the parent, with the episodes of every worker
+                env.curriculum_dict.update(data)
+                states[:] = env.reset().cpu().numpy()
+                remote.send(('ok', (_env_attrs(env), env.illegal_action_new())))
+            elif cmd == 'step':
+                action, train_flag = data
+                state, reward, done = env.step(action, train_flag)
+                info = _env_attrs(env)
+                episode = None
+                if done:
+                    # the parent merges the episode into its curricula and resets the env with them;
+                    # done_threshold was the threshold of the episode's curriculum until this step
+                    final_states[:] = state.cpu().numpy()
+                    episode = (env.current_prob, env.curriculum, int(env.error < env.curriculum.get_current_threshold()))
+                else:
+                    states[:] = state.cpu().numpy()
+                remote.send(('ok', (float(reward), int(done), info, env.illegal_action_new(), episode)))
+            elif cmd == 'close':
+                break
+        del states, final_states, buffer
+        shm.close()
+    except (KeyboardInterrupt, EOFError, BrokenPipeError):
+        # the parent is gone or closed the pipe before reading the last reply
+        pass
+    except Exception:
+        remote.send(('error', traceback.format_exc()))
+    finally:
+        remote.close()
+
+
+class SubprocCircuitEnv:
+    def __init__(self, env_module, conf, num_envs, transform = None, seed = 0, start_method = 'spawn', device = torch.device('cpu')):
+        self.num_envs = num_envs
+        self.transform = transform if transform is not None else (lambda state, env: state)
+        self.device = device
+        ctx = mp.get_context(start_method)
+        self.remotes, self.processes = [], []
+        for i in range(num_envs):
+            remote, work_remote = ctx.Pipe()
+            process = ctx.Process(target=_worker, args=(work_remote, env_module, conf, seed + i), daemon=True)
+            process.start()
+            work_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+        state_len, self.state_size, self.action_size, self.num_layers, self.curriculum_dict = [self._recv(remote) for remote in self.remotes][0]
+
+        self.shm = shared_memory.SharedMemory(create=True, size=2 * num_envs * state_len * 4)
+        self.buffer = np.ndarray((2, num_envs, state_len), dtype=np.float32, buffer=self.shm.buf)
+        for i, remote in enumerate(self.remotes):
+            remote.send((i, self.shm.name, num_envs))
+
+        self.envs = [SimpleNamespace(**dict.fromkeys(ENV_ATTRS)) for _ in range(num_envs)]
+        self.ill_actions = [[] for _ in range(num_envs)]
+        self.final_states = [None] * num_envs
+        self.infos = [dict() for _ in range(num_envs)]
+        self.stepping = []
+        self.waiting = False
+        self.closed = False
+
+    @staticmethod
+    def _recv(remote):
+        status, data = remote.recv()
+        if status == 'error':
+            raise RuntimeError(f'CircuitEnv worker failed:\n{data}')
+        return data
+
+    def _states(self, which = 0):
+        return torch.tensor(self.buffer[which], device=self.device)
+
+    def reset(self):
+        self._reset(range(self.num_envs))
+        states = self._states()
+        return torch.stack([self.transform(state, env) for state, env in zip(states, self.envs)])
+
+    def _reset(self, slots):
+        for i in slots:
+            self.remotes[i].send(('reset', self.curriculum_dict))
+        for i in slots:
+            attrs, self.ill_actions[i] = self._recv(self.remotes[i])
+            self.envs[i].__dict__.update(attrs)
+
+    def illegal_actions(self):
+        """ List of the illegal actions of every slot, as of the last reset or step. """
+        return self.ill_actions
+
+    def step_async(self, actions, train_flag = True):
+        self.stepping = [i for i, action in enumerate(actions) if action is not None]
+        for i in self.stepping:
+            self.remotes[i].send(('step', (actions[i], train_flag)))
+        self.waiting = True
+
+    def step_wait(self):
+        results = {i: self._recv(self.remotes[i]) for i in self.stepping}
+        self.waiting = False
+        final_states = self._states(1)
+        rewards, dones, finished = [], [], []
+        for i in range(self.num_envs):
+            if i not in results:
+                rewards.append(0.)
+                dones.append(0)
+                continue
+            reward, done, info, ill_actions, episode = results[i]
+            self.ill_actions[i] = ill_actions
+            self.infos[i] = {'error': info['error'],
+                             'error_noiseless': info['error_noiseless'],
+                             'opt_ang': info['opt_ang_save'],
+                             'rwd': info['rwd'],
+                             'done_threshold': info['done_threshold'],
+                             'current_prob': info['current_prob']}
+            if done:
+                self.final_states[i] = self.transform(final_states[i], SimpleNamespace(**info))
+                # in slot order, as VectorCircuitEnv steps its envs
+                prob, curriculum, energy_done = episode
+                self.curriculum_dict[prob] = self.curriculum_dict[prob].finish(curriculum, energy_done)
+                finished.append(i)
+            self.envs[i].__dict__.update(info)
+            rewards.append(reward)
+            dones.append(done)
+        # finished envs start their next episode from the merged curricula
+        self._reset(finished)
+        # every stepped worker has written its rows by now, the others kept theirs
+        states = self._states(0)
+        return (torch.stack([self.transform(state, env) for state, env in zip(states, self.envs)]),
+                torch.tensor(rewards, dtype=torch.float32, device=self.device),
+                torch.tensor(dones, device=self.device))
+
+    def step(self, actions, train_flag = True):
+        self.step_async(actions, train_flag)
+        return self.step_wait()
+
+    def close(self, timeout = 10):
+        """
+        Stops the workers and frees the shared memory. Also after a failed
+        step: workers that died or do not stop within timeout seconds (e.g.
+        still in a step whose result is not read) are terminated.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            for remote in self.remotes:
+                try:
+                    remote.send(('close', None))
+                except (EOFError, BrokenPipeError, ConnectionResetError):
+                    pass
+                remote.close()
+            for process in self.processes:
+                process.join(timeout)
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+        finally:
+            del self.buffer
+            self.shm.close()
+            self.shm.unlink()
@@ -0,0 +1,86 @@
+"""
+N CircuitEnvs stepped in lockstep.
+
+VectorCircuitEnv holds one environment per episode slot (any of the
+CircuitEnv classes, all built from the same config) and steps them together:
+reset() returns the [N, state] batch of first states and step(actions)
+applies one action per slot and returns the stacked next states, rewards
+and done flags. A slot whose episode ends is reset at once, so the row it
+returns is the first state of its next episode; the last state of the
+finished episode is kept in final_states and the statistics of the step
+that ended it in infos. The agent scores the N states with one forward pass
+(act_batch of agents/batched_act.py).
+
+The envs share one curriculum_dict: every finished episode is merged into
+the curriculum of its problem (Curriculum.finish in utils/curricula.py), so
+the thresholds move with the total number of episodes as in the sequential
+loop. An episode keeps the threshold it started with, so slots that started
+before and after an update run with different thresholds.
+
+The optional transform(state, env) is applied to every state before it is
+returned (main.py passes modify_state, which appends the energy and the
+threshold of the env), and to the last state before the slot is reset.
+
+A slot whose action is None is not stepped: its row repeats the last state
+it returned, with reward and done 0 (the training loops pass None for the
+slots that have no episode left).
+
+The N circuits differ after the first action, so the angle optimization of
+a step still runs env by env (the optimizers of environment_synthesized_2
+evaluate their trial angles of one circuit together with get_energy_batch),
+and the auto-resets reuse the empty-circuit energy every env computes once.
+"""
+import torch
+
+
+class VectorCircuitEnv:
+    def __init__(self, envs, transform = None):
+        self.envs = list(envs)
+        self.num_envs = len(self.envs)
+        # one curriculum per problem for all slots, as for the episodes of one env
+        for env in self.envs[1:]:
+            env.curriculum_dict = self.envs[0].curriculum_dict
+        self.transform = transform if transform is not None else (lambda state, env: state)
+        self.action_size = self.envs[0].action_size
+        self.state_size = self.envs[0].state_size
+        self.num_layers = self.envs[0].num_layers
+        self.final_states = [None] * self.num_envs
+        self.infos = [dict() for _ in range(self.num_envs)]
+        self.states = [None] * self.num_envs
+
+    def reset(self):
+        self.states = [self.transform(env.reset(), env) for env in self.envs]
+        return torch.stack(self.states)
+
+    def illegal_actions(self):
+        """ List of the illegal actions of every slot. """
+        return [env.illegal_action_new() for env in self.envs]
+
+    def step(self, actions, train_flag = True):
+        """
+        actions[i] is the action of slot i as env.step takes it (an entry of agent.translate),
+        or None to leave slot i alone. Returns states [N, state], rewards [N] and dones [N].
+        """
+        states, rewards, dones = [], [], []
+        for i, (env, action) in enumerate(zip(self.envs, actions)):
+            if action is None:
+                states.append(self.states[i])
+                rewards.append(torch.tensor(0., dtype=torch.float32, device=self.states[i].device))
+                dones.append(0)
+                continue
+            state, reward, done = env.step(action, train_flag)
+            state = self.transform(state, env)
+            self.infos[i] = {'error': env.error,
+                             'error_noiseless': env.error_noiseless,
+                             'opt_ang': env.opt_ang_save,
+                             'rwd': env.rwd,
+                             'done_threshold': env.done_threshold,
+                             'current_prob': env.current_prob}
+            if done:
+                self.final_states[i] = state
+                state = self.transform(env.reset(), env)
+            states.append(state)
+            rewards.append(reward)
+            dones.append(int(done))
+        self.states = states
+        return torch.stack(states), torch.stack(rewards), torch.tensor(dones, device=states[0].device)
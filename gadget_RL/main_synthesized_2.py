@@ -8,6 +8,9 @@ import pathlib
 import copy
 from utils.utils_synthesized import get_config
 from environments.environment_synthesized_2 import CircuitEnv
+from environments.vector_env import VectorCircuitEnv
+from environments.subproc_env import SubprocCircuitEnv
+from utils.lockstep import train_lockstep
 import agents
 import time
 import pickle
@@ -65,6 +68,9 @@ def modify_state(state,env):
         
     if "threshold_in_state" in conf['agent'].keys() and conf['agent']["threshold_in_state"]:
         state = torch.cat((state, torch.tensor(env.done_threshold,dtype=torch.float,device=device).view(1)))
+    if "ham_models" in conf['problem'].keys():
+        # index of the episode's target in ham_models, drawn by env.reset()
+        state = torch.cat((state, torch.tensor(env.target,dtype=torch.float,device=device).view(1)))
     # print('state size in modified state')
     # print(state.shape)  
     return state
@@ -231,8 +237,16 @@ if __name__ == '__main__':
 
     
     """ Environment and Agent initialization"""
-    environment = CircuitEnv(conf, device=device)
-    agent = agents.__dict__[conf['agent']['agent_type']].__dict__[conf['agent']['agent_class']](conf, environment.action_size, environment.state_size, device)
+    n_envs = conf['general']['n_envs'] if "n_envs" in conf['general'].keys() else 1
+    subproc_envs = n_envs > 1 and "subproc_envs" in conf['general'].keys() and conf['general']['subproc_envs']
+    if subproc_envs:
+        # the environments live in the workers only
+        vec_env = SubprocCircuitEnv(CircuitEnv.__module__, conf, n_envs, transform=modify_state, seed=args.seed)
+        action_size, state_size = vec_env.action_size, vec_env.state_size
+    else:
+        environment = CircuitEnv(conf, device=device)
+        action_size, state_size = environment.action_size, environment.state_size
+    agent = agents.__dict__[conf['agent']['agent_type']].__dict__[conf['agent']['agent_class']](conf, action_size, state_size, device)
     agent.saver = Saver(f"{results_path}{args.experiment_name}{args.config}", args.seed)
 
     if conf['agent']['init_net']: 
@@ -250,7 +264,17 @@ if __name__ == '__main__':
         if not conf['agent']['epsilon_restart']:
             agent.epsilon = agent.epsilon_min
 
-    train(agent, environment, conf['general']['episodes'], args.seed, f"{results_path}{args.experiment_name}{args.config}",conf['env']['accept_err'])
+    if subproc_envs:
+        try:
+            train_lockstep(agent, vec_env, conf['general']['episodes'], args.seed, f"{results_path}{args.experiment_name}{args.config}",conf['env']['accept_err'], conf, device)
+        finally:
+            vec_env.close()
+    elif n_envs > 1:
+        vec_env = VectorCircuitEnv([environment] + [CircuitEnv(conf, device=device) for _ in range(n_envs - 1)],
+                                   transform=modify_state)
+        train_lockstep(agent, vec_env, conf['general']['episodes'], args.seed, f"{results_path}{args.experiment_name}{args.config}",conf['env']['accept_err'], conf, device)
+    else:
+        train(agent, environment, conf['general']['episodes'], args.seed, f"{results_path}{args.experiment_name}{args.config}",conf['env']['accept_err'])
     agent.saver.save_file()
             
     torch.save(agent.policy_net.state_dict(), f"{results_path}{args.experiment_name}{args.config}/thresh_{conf['env']['accept_err']}_{args.seed}_model.pth")
@@ -1,6 +1,8 @@
 import numpy as np
 import scipy.linalg as la
+from functools import lru_cache
 import matplotlib.pyplot as plt
+from utils.pauli_hamiltonian import PauliHamiltonian
 
 def pauli_matrices():
     """Return the Pauli matrices."""
@@ -43,6 +45,49 @@ def construct_hamiltonian(J, h, N):
     return H
 
 
+def tfim_pauli_terms(J, h, N):
+    """Pauli strings and coefficients of the same Hamiltonian as construct_hamiltonian.
+    Labels follow the np.kron order above (leftmost character = first kron factor = qubit N-1).
+    """
+    paulis, coeffs = [], []
+    for i in range(N - 1):
+        paulis.append('I'*i + 'ZZ' + 'I'*(N - i - 2))
+        coeffs.append(-J)
+    for i in range(N):
+        paulis.append('I'*i + 'X' + 'I'*(N - i - 1))
+        coeffs.append(-h)
+    return paulis, coeffs
+
+
+def tfim_hamiltonian(J, h, N):
+    """Matrix-free TFIM Hamiltonian: PauliHamiltonian.matvec gives H|psi> and
+    PauliHamiltonian.expectation gives <psi|H|psi> with O(N 2^N) memory, so
+    chains well past the dense limit of construct_hamiltonian are fine.
+    """
+    return PauliHamiltonian(*tfim_pauli_terms(J, h, N))
+
+
+@lru_cache(maxsize=None)
+def tfim_ground_energy(N, J, h):
+    """Ground energy of the TFIM, cached per (N, J, h).
+    The open chain maps to free fermions (Jordan-Wigner): E0 = -sum of the
+    singular values of the bidiagonal matrix with h on the diagonal and J
+    above it. Exact and O(N^3), so ham_data files can be written for the
+    20-40 qubit chains of the MPS backend, where even Lanczos is out of reach.
+    """
+    bidiagonal = np.diag(np.full(N, float(h))) + np.diag(np.full(N - 1, float(J)), 1)
+    return -float(np.sum(la.svdvals(bidiagonal)))
+
+
+def tfim_extreme_eigvals(N, J, h):
+    """(ground energy, highest energy) of the TFIM. The open-chain spectrum is
+    symmetric: Z on even and Y on odd sites flips the sign of every X_i and
+    every Z_i Z_{i+1}, so the highest energy is minus the ground energy.
+    """
+    ground = tfim_ground_energy(N, J, h)
+    return ground, -ground
+
+
 def TFIM_hardness_measure_plot():
     J = 1 # HOPPIN STRENGTH
     for q in [2]:
@@ -67,7 +112,7 @@ def TFIM_hardness_measure_plot():
     plt.show()
 
 
-def hamitlonian_contruct_with_hardness(mag_field_strength_list):
+def hamitlonian_contruct_with_hardness(mag_field_strength_list, N = 6):
     """
     J fixed
         -- h << J hard problem. 
@@ -77,21 +122,21 @@ def hamitlonian_contruct_with_hardness(mag_field_strength_list):
             - Many local minima
         -- h >> J easier problem
             - Paramagnetic region
+
+    The environments only need min/max of 'eigvals', so only the two
+    extreme eigenvalues are stored (matrix-free, no dense matrix is built).
     """
     J = 1 # HOPPIN STRENGTH
-    N = 6 # NUMBER OF QUBITS
     for h in mag_field_strength_list:
         print(h)
-        H = construct_hamiltonian(J, h, N)
         print(f'J:{J}, h:{h}, N:{N}')
         print('Sum of pauli coeff:', (N-1)*-J+ N*-h)
-        ham = dict()
-        ham['hamiltonian'], ham['eigvals'] = H, la.eig(H)[0].real
-        print('Minimum eigenvalue', np.min(ham['eigvals']))
+        eigvals = np.array(tfim_extreme_eigvals(N, J, h))
+        print('Minimum eigenvalue', np.min(eigvals))
         # exit()
-        np.savez(f'ham_data/tfim_{N}q_j{J}_h{h}.npz', **ham)
+        tfim_hamiltonian(J, h, N).save(f'ham_data/tfim_{N}q_j{J}_h{h}.npz', eigvals = eigvals)
         ham = np.load(f"ham_data/tfim_{N}q_j{J}_h{h}.npz")
-        _, eigvals = ham['hamiltonian'], ham['eigvals']
+        eigvals = ham['eigvals']
         print('Eigenvalues', eigvals)
         print('x-x-x-x-x-x-x-x DONE x-x-x-x-x-x-x-x')
         print()
@@ -0,0 +1,62 @@
+"""
+Illegal actions of a CircuitEnv as bitmasks over the action ids.
+
+The illegal actions of an env (the gates that would undo one of the last
+gates on their qubits) are kept as a list of num_qubits slots, each empty or
+an action of the action dictionary, and updated with every new action by
+CircuitEnv.update_illegal_actions. The update depends only on the slots and
+the action, so IllegalActionTable runs it once per (slots, action) pair and
+keeps the result: the new slots, their action ids and their bitmask, an int
+with bit i set for action id i (bits[i] = 1 << i). Later steps from the same
+slots with the same action are one dict lookup, instead of the update and a
+scan of the whole action dictionary.
+
+Works with every action dictionary of utils/utils.py and
+utils/utils_synthesized.py, the actions are only compared for equality.
+"""
+import torch
+
+
+def _key(actions):
+    return tuple(tuple(action) for action in actions)
+
+
+class IllegalActionTable:
+    def __init__(self, action_dict, update, device = torch.device('cpu')):
+        """ update(slots, action) returns the slots after action (it may modify slots). """
+        self.action_dict = action_dict
+        self.update = update
+        self.device = device
+        self.action_size = len(action_dict)
+        self.ids = {tuple(action): key for key, action in action_dict.items()}
+        self.bits = {key: 1 << key for key in action_dict.keys()}
+        self._transitions = {}
+        self._masks = {}
+
+    def decode(self, slots):
+        """ Sorted action ids of the non-empty slots. """
+        return sorted(self.ids[key] for key in _key(slots) if key in self.ids)
+
+    def bitmask(self, slots):
+        mask = 0
+        for key in self.decode(slots):
+            mask |= self.bits[key]
+        return mask
+
+    def step(self, slots, action):
+        """ (slots after action, their action ids). """
+        transition = (_key(slots), tuple(action))
+        entry = self._transitions.get(transition)
+        if entry is None:
+            new_slots = self.update(list(slots), action)
+            entry = self._transitions[transition] = (new_slots, self.decode(new_slots))
+        return list(entry[0]), list(entry[1])
+
+    def mask(self, slots):
+        """ Boolean torch mask of size action_size, True for the illegal actions of slots. """
+        bitmask = self.bitmask(slots)
+        mask = self._masks.get(bitmask)
+        if mask is None:
+            bits = [(bitmask >> key) & 1 for key in range(self.action_size)]
+            mask = self._masks[bitmask] = torch.tensor(bits, dtype=torch.bool, device=self.device)
+        return mask.clone()
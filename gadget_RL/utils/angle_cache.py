@@ -0,0 +1,125 @@
+"""
+Cross-episode cache of optimized angles, keyed by circuit structure.
+
+The agent revisits the same action prefixes many times, and for a given
+Hamiltonian the optimum of scipy_optim only depends on the gates, i.e. on
+the one-hot part of CircuitEnv.state. AngleCache maps a hash of that part
+to the optimized angles, their energy and the nfev it took, and keeps the
+max_size most recently used entries in memory. Everything else the optimum
+depends on (the gate set the one-hot rows stand for, the noise, the backend
+and its precision) goes into the namespace, see AngleCache.namespace, or
+into the extra part of the key (the injected gadget noise of an episode).
+An entry whose number of angles does not match the circuit is a miss.
+
+With a path, every entry is also written to <path>/<namespace>/<key>.npz
+(atomically, so several seeds can share one directory) and a memory miss
+falls back to the disk.
+
+With the CanonicalForm of the circuit (environments/VQEs/canonical.py) the
+key is the canonical one instead, so action sequences that build the same
+circuit up to gate commutation share an entry; its angles are then stored in
+the canonical order and mapped back to the env's angles on a hit.
+"""
+import os
+import hashlib
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+
+CacheEntry = namedtuple('CacheEntry', 'angles energy nfev')
+
+
+class AngleCache:
+    def __init__(self, max_size = 10000, path = None, namespace = ''):
+        self.max_size = max_size
+        self.path = os.path.join(path, namespace) if path else None
+        self.namespace = namespace
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def namespace(name, **settings):
+        """ name and a digest of the settings the optimized angles depend on. """
+        digest = hashlib.blake2b(repr(sorted(settings.items())).encode(), digest_size=8)
+        return f'{name}_{digest.hexdigest()}'
+
+    @staticmethod
+    def key(structure, extra = None):
+        """
+        Hash of the gate structure, the one-hot part of the env state (a tensor
+        or an array), and of extra (anything with a stable repr) if given.
+        """
+        if hasattr(structure, 'detach'):
+            structure = structure.detach().cpu().numpy()
+        structure = np.asarray(structure) != 0
+        digest = hashlib.blake2b(np.packbits(structure).tobytes(), digest_size=16)
+        digest.update(np.asarray(structure.shape, dtype=np.int64).tobytes())
+        if extra is not None:
+            digest.update(repr(extra).encode())
+        return digest.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, f'{key}.npz')
+
+    def _insert(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, key, size = None):
+        """ The CacheEntry of key, or None (also if it does not hold size angles). Counts a hit or a miss. """
+        if key in self._entries:
+            entry = self._entries[key]
+            if size is None or len(entry.angles) == size:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        elif self.path and os.path.exists(self._file(key)):
+            with np.load(self._file(key)) as data:
+                entry = CacheEntry(data['angles'], float(data['energy']), int(data['nfev']))
+            if size is None or len(entry.angles) == size:
+                self._insert(key, entry)
+                self.hits += 1
+                self.disk_hits += 1
+                return entry
+        self.misses += 1
+        return None
+
+    def lookup(self, structure, form = None, size = None, extra = None):
+        """
+        (key, CacheEntry or None) of a gate structure, or of its canonical form
+        if given. size is the number of angles of the circuit, extra goes into
+        the key of the structure (see key).
+        """
+        if form is None:
+            key = self.key(structure, extra)
+            return key, self.get(key, size)
+        entry = self.get(form.key, None if size is None else len(form.groups))
+        if entry is not None:
+            entry = entry._replace(angles = form.from_canonical(entry.angles))
+        return form.key, entry
+
+    def put(self, key, angles, energy, nfev, form = None):
+        if form is not None:
+            angles = form.to_canonical(angles)
+        energy = np.nan if energy is None else float(energy)
+        entry = CacheEntry(np.array(angles, dtype=float), energy, int(nfev))
+        self._insert(key, entry)
+        if self.path:
+            tmp = os.path.join(self.path, f'.{key}.{os.getpid()}.npz')
+            np.savez(tmp, angles=entry.angles, energy=entry.energy, nfev=entry.nfev)
+            os.replace(tmp, self._file(key))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0, 'size': len(self._entries)}
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,5 +1,38 @@
+class Curriculum:
+    """
+    The state of a curriculum is a handful of numbers kept in __slots__. The
+    envs keep one curriculum per problem and work on a snapshot() of it during
+    an episode, which copies the slots instead of a copy.deepcopy. At the end
+    of the episode finish() applies it to the curriculum of the problem.
+    """
+    __slots__ = ()
+
+    def snapshot(self):
+        snapshot = object.__new__(type(self))
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                setattr(snapshot, name, getattr(self, name))
+        return snapshot
+
+    def finish(self, episode, energy_done):
+        """
+        The curriculum after an episode that worked on episode, a snapshot of
+        self or of an earlier state of it: its lowest energy is kept and the
+        threshold updated. With one env episode is self plus the lowest energy
+        of the episode; envs sharing the curriculum (vector_env.py) can finish
+        other episodes in between, which are kept as well.
+        """
+        curriculum = self.snapshot()
+        curriculum.lowest_energy = min(self.lowest_energy, episode.lowest_energy)
+        curriculum.update_threshold(energy_done=energy_done)
+        return curriculum
+
+
+
+class MovingThreshold(Curriculum):
+    __slots__ = ('amortisation', 'greedy_shift_time', 'min_en', 'success_thresh', 'succ_radius_shift', 'succes_switch',
+                 'current_threshold', 'lowest_energy', 'success_counter', 'radius_shift_counter', 'call_counter')
 
-class MovingThreshold:
     def __init__(self, config, **kw):
         self.amortisation = config['shift_threshold_ball'] 
         self.greedy_shift_time = config['shift_threshold_time'] 
@@ -50,7 +83,9 @@ class MovingThreshold:
             self.reduce_amortisation()
         self.greedy_shift()
     
-class SuccesCountThreshold:
+class SuccesCountThreshold(Curriculum):
+    __slots__ = ('min_en', 'success_thresh', 'current_threshold', 'lowest_energy', 'success_counter')
+
     def __init__(self, config, **kw):
         self.min_en = kw.get('target_energy') 
         self.success_thresh = config["success_thresh"]
@@ -77,7 +112,9 @@ class SuccesCountThreshold:
             self.greedy_shift()
 
 
-class VanillaCurriculum:
+class VanillaCurriculum(Curriculum):
+    __slots__ = ('thresholds', 'episodes', 'episodes_completed', 'min_en', 'current_threshold', 'lowest_energy')
+
     def __init__(self, config, **kw):
         
         
@@ -0,0 +1,152 @@
+"""
+In-process memo of circuit energies, keyed by compiled circuit and angles.
+
+CircuitEnv.step ends scipy_optim at the optimum and then evaluates the same
+circuit at the same angles again in get_energy, and reset() evaluates the
+empty circuit, whose energy never changes, every episode. EnergyMemo maps a
+hash of the OpTape (gates, qubits, parameter slots, fixed unitaries,
+backend and noise model), of the observable and of the bound angles to the
+energy and its standard error, and keeps the max_size most recently used
+entries.
+
+Angles are rounded to float32 in the key, the precision the env state keeps
+them in, so the optimum the cost function recorded in float64 is found again
+from the angles written back into the state. The cost function of the
+optimizer only reads the memo at angles that are float32 already, i.e. at
+its starting point, the angles of the env state (which get_energy has just
+evaluated when the optimizer runs on the previous state); every other trial
+point is evaluated and recorded.
+
+The energies of all members of a HamiltonianFamily (an h-sweep) are kept
+as one entry, see evaluate_family.
+
+Circuits that are not OpTapes (QuantumCircuits of the Qiskit backend) are
+evaluated without the memo.
+"""
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+class EnergyMemo:
+    def __init__(self, max_size = 10000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._digests = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _digest(self, obj, make):
+        """ make(obj), computed once per object (tapes and Hamiltonians are reused across calls). """
+        cached = self._digests.get(id(obj))
+        if cached is None or cached[0] is not obj:
+            if len(self._digests) > 8:
+                self._digests.clear()
+            cached = self._digests[id(obj)] = (obj, make(obj))
+        return cached[1]
+
+    @staticmethod
+    def circuit_digest(circuit):
+        digest = hashlib.blake2b(digest_size=16)
+        for array in (circuit.opcodes, circuit.qubits, circuit.slots):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        digest.update(np.asarray(circuit.unitaries, dtype=complex).tobytes())
+        digest.update(f'{circuit.num_qubits} {circuit.simulator} {circuit.noise!r}'.encode())
+        return digest.digest()
+
+    @staticmethod
+    def observable_digest(observable):
+        digest = hashlib.blake2b(digest_size=16)
+        if hasattr(observable, 'members'):
+            for member in observable.members:
+                digest.update(EnergyMemo.observable_digest(member))
+        elif hasattr(observable, 'paulis'):
+            digest.update(' '.join(observable.paulis).encode())
+            digest.update(np.asarray(observable.coeffs).tobytes())
+            digest.update(str(getattr(observable, 'precision', '')).encode())
+        else:
+            digest.update(np.ascontiguousarray(observable).tobytes())
+        return digest.digest()
+
+    def key(self, circuit, observable):
+        """ Key of an OpTape at its bound angles and an observable, None for other circuits. """
+        if not hasattr(circuit, 'opcodes'):
+            return None
+        digest = hashlib.blake2b(self._digest(circuit, self.circuit_digest), digest_size=16)
+        digest.update(self._digest(observable, self.observable_digest))
+        digest.update(np.asarray(circuit.params, dtype=np.float32).tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """ (energy, stderr) of key, or None. Counts a hit or a miss. """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, energy, stderr = 0.0):
+        if key is None:
+            return
+        self._entries[key] = (float(energy), float(stderr))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def record(self, circuit, observable, energy):
+        """ Stores the energy just computed for circuit at its bound angles (and the stderr of its noise). """
+        if self.max_size > 0:
+            self.put(self.key(circuit, observable), energy, _stderr(circuit))
+
+    def cost(self, x, circuit, observable, fun):
+        """ fun(x) for the cost function of the optimizer, looked up for float32 angles and recorded otherwise. """
+        x = np.asarray(x, dtype=float)
+        if self.max_size > 0 and np.array_equal(x, x.astype(np.float32)):
+            circuit.bind(x)
+            entry = self.get(self.key(circuit, observable))
+            if entry is not None:
+                return entry[0]
+        energy = fun(x)
+        self.record(circuit, observable, energy)
+        return energy
+
+    def evaluate(self, circuit, observable, exp_val):
+        """ (energy, stderr) of circuit at its bound angles, from the memo or exp_val(circuit). """
+        key = self.key(circuit, observable) if self.max_size > 0 else None
+        if key is None:
+            return exp_val(circuit), _stderr(circuit)
+        entry = self.get(key)
+        if entry is None:
+            entry = (exp_val(circuit), _stderr(circuit))
+            self.put(key, *entry)
+        return entry
+
+    def evaluate_family(self, circuit, family, energies):
+        """ (K,) energies of circuit for every member of a HamiltonianFamily, from the memo or energies(circuit, family). """
+        key = self.key(circuit, family) if self.max_size > 0 else None
+        if key is None:
+            return energies(circuit, family)
+        entry = self.get(key)
+        if entry is None:
+            entry = np.array(energies(circuit, family), dtype=float)
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0, 'size': len(self._entries)}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _stderr(circuit):
+    """ Standard error of the last energy of a noisy circuit (trajectory noise), 0 otherwise. """
+    noise = getattr(circuit, 'noise', None)
+    return noise.stderr if noise is not None else 0.0
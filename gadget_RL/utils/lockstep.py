@@ -0,0 +1,107 @@
+"""
+Lockstep training loop of the main*.py scripts.
+
+train_lockstep trains agent on the N environments of vec_env (a
+VectorCircuitEnv of environments/vector_env.py or a SubprocCircuitEnv of
+environments/subproc_env.py), the loop the scripts run when [general] n_envs
+is above 1. The N actions of a step come from act_batch (agents/batched_act.py),
+so any agent class works, with one forward pass for the DQN agents.
+Checkpoints are written every save_every finished episodes; with
+count_threshold the number of episodes ending below an error of 0.0016 is
+saved to threshold_crossed.npy, as the train loop of main.py does.
+"""
+import time
+
+import numpy as np
+import torch
+
+from agents.batched_act import act_batch
+
+
+def train_lockstep(agent, vec_env, episodes, seed, output_path, threshold, conf, device, save_every = 50, count_threshold = True):
+    """Training loop stepping conf['general']['n_envs'] episodes in lockstep (environments/vector_env.py)."""
+    slots = list(range(min(vec_env.num_envs, episodes)))
+    slots += [None] * (vec_env.num_envs - len(slots))
+    next_episode, finished = len([e for e in slots if e is not None]), 0
+    threshold_crossed = 0
+    t0 = [time.time()] * vec_env.num_envs
+    itrs = [0] * vec_env.num_envs
+    states = vec_env.reset()
+    for i, env in enumerate(vec_env.envs):
+        if slots[i] is not None:
+            agent.saver.get_new_episode('train', slots[i])
+            agent.saver.stats_file['train'][slots[i]]['bond_distance'] = env.current_prob
+            agent.saver.stats_file['train'][slots[i]]['done_threshold'] = env.done_threshold
+    agent.policy_net.train()
+
+    while any(e is not None for e in slots):
+        # slots without an episode left are neither scored nor stepped
+        active = [i for i, e in enumerate(slots) if e is not None]
+        ill_actions = vec_env.illegal_actions()
+        actions = [None] * vec_env.num_envs
+        for i, (action, _) in zip(active, act_batch(agent, states[active], [ill_actions[i] for i in active])):
+            actions[i] = action
+        next_states, rewards, dones = vec_env.step([agent.translate[action] if action is not None else None for action in actions])
+
+        for i, env in enumerate(vec_env.envs):
+            episode_no = slots[i]
+            if episode_no is None:
+                continue
+            info = vec_env.infos[i]
+            done = int(dones[i])
+            next_state = vec_env.final_states[i] if done else next_states[i]
+            agent.remember(states[i].clone(),
+                           torch.tensor(actions[i], device=device),
+                           rewards[i],
+                           next_state.clone(),
+                           torch.tensor(done, device=device))
+
+            agent.saver.stats_file['train'][episode_no]['actions'].append(actions[i])
+            agent.saver.stats_file['train'][episode_no]['errors'].append(info['error'])
+            agent.saver.stats_file['train'][episode_no]['errors_noiseless'].append(info['error_noiseless'])
+            agent.saver.stats_file['train'][episode_no]['opt_ang'].append(info['opt_ang'])
+            agent.saver.stats_file['train'][episode_no]['rewards'].append(info['rwd'])
+            agent.saver.stats_file['train'][episode_no]['time'].append(time.time()-t0[i])
+
+            if agent.memory_reset_switch:
+               if info['error'] < agent.memory_reset_threshold:
+                   agent.memory_reset_counter += 1
+               if agent.memory_reset_counter == agent.memory_reset_switch:
+                   agent.memory.clean_memory()
+                   agent.memory_reset_switch = False
+                   agent.memory_reset_counter = False
+
+            if done:
+                if episode_no%20==0:
+                    print("episode: {}/{}, score: {}, e: {:.2}, rwd: {} \n"
+                            .format(episode_no, episodes, itrs[i]+1, agent.epsilon, rewards[i]),flush=True)
+                finished += 1
+                if count_threshold and info['error'] <= 0.0016:
+                    threshold_crossed += 1
+                    np.save( f'threshold_crossed', threshold_crossed )
+                if finished %save_every==0:
+                    agent.saver.save_file()
+                    torch.save(agent.policy_net.state_dict(), f"{output_path}/thresh_{threshold}_{seed}_model.pth")
+                    torch.save(agent.optim.state_dict(), f"{output_path}/thresh_{threshold}_{seed}_optim.pth")
+                    torch.save( {i: a._asdict() for i,a in enumerate(agent.memory.memory)}, f"{output_path}/thresh_{threshold}_{seed}_replay_buffer.pth")
+                # the env is reset already, its row of next_states starts the next episode
+                slots[i] = next_episode if next_episode < episodes else None
+                t0[i], itrs[i] = time.time(), 0
+                if slots[i] is not None:
+                    next_episode += 1
+                    agent.saver.get_new_episode('train', slots[i])
+                    agent.saver.stats_file['train'][slots[i]]['bond_distance'] = env.current_prob
+                    agent.saver.stats_file['train'][slots[i]]['done_threshold'] = env.done_threshold
+                continue
+
+            if len(agent.memory) > conf['agent']['batch_size']:
+                if "replay_ratio" in conf['agent'].keys():
+                    if  itrs[i] % conf['agent']["replay_ratio"]==0:
+                        loss = agent.replay(conf['agent']['batch_size'])
+                else:
+                    loss = agent.replay(conf['agent']['batch_size'])
+                assert type(loss) == float
+                agent.saver.stats_file['train'][episode_no]['loss'].append(loss)
+                agent.saver.validate_stats(episode_no, 'train')
+            itrs[i] += 1
+        states = next_states
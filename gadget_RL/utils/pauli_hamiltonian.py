@@ -0,0 +1,393 @@
+"""
+Sparse Pauli-sum Hamiltonians.
+
+H = sum_k coeffs[k] * P_k where every P_k is a Pauli string written with
+the Qiskit label convention: the leftmost character acts on the highest
+qubit, i.e. label[i] acts on qubit n-1-i. This is the same ordering as the
+np.kron products in utils/TFIM_ham_gen.py, so a label reads like the kron
+product that builds the dense matrix.
+
+A Pauli string is stored as two bit masks: x_mask (X or Y on that qubit)
+and z_mask (Z or Y). With P = i^ny X^x Z^z (ny = number of Y's),
+    P|j> = i^ny (-1)^popcount(j & z) |j ^ x>
+so neither the expectation value nor H|psi> needs the 2^n x 2^n matrix.
+
+precision = 'single' keeps the diagonal and the X-flip weights in float32
+(complex64) and expects complex64 statevectors (state_dtype, which the numpy
+simulator reads), halving memory and bandwidth per state; the sums of the
+expectation values are still accumulated in float64. In verification mode
+(load_hamiltonian(..., verify=True)) a complex128 copy is kept as reference
+and the energy functions of simulator.py evaluate both, keeping the largest
+deviation in precision_error.
+
+A HamiltonianFamily scores one state against several Hamiltonians on the
+same Pauli strings (an h-sweep of the TFIM) through their shared
+components, see its docstring.
+
+load_hamiltonian reads every file once per process and hands out the same
+PauliHamiltonian afterwards (with its kernels, built on first use), so the
+envs, which load their Hamiltonian again on every reset, share it.
+"""
+import os
+from functools import cached_property
+import numpy as np
+import scipy.linalg as la
+from scipy.sparse.linalg import LinearOperator, eigsh
+
+
+def _popcount_parity(values):
+    """ (-1)^popcount(values) for an integer array. """
+    parity = np.zeros(values.shape, dtype=np.int64)
+    v = values.copy()
+    while np.any(v):
+        parity ^= v & 1
+        v >>= 1
+    return 1 - 2*parity
+
+
+PRECISIONS = {'double': (np.float64, np.complex128), 'single': (np.float32, np.complex64)}
+
+
+def _real_vdot(a, b):
+    """ Re <a|b> (on the last axis), accumulated in float64 for single-precision arrays. """
+    if a.dtype == np.complex128:
+        return np.sum(a.conj() * b, axis=-1).real if a.ndim > 1 else float(np.vdot(a, b).real)
+    out = np.sum(a.conj() * b, axis=-1, dtype=np.complex128).real
+    return out if a.ndim > 1 else float(out)
+
+
+def label_to_masks(label):
+    n = len(label)
+    x_mask, z_mask = 0, 0
+    for i, p in enumerate(label):
+        bit = 1 << (n - 1 - i)
+        if p in 'XY':
+            x_mask |= bit
+        if p in 'ZY':
+            z_mask |= bit
+        if p not in 'IXYZ':
+            raise ValueError(f'invalid Pauli label {label}')
+    return x_mask, z_mask
+
+
+def masks_to_label(x_mask, z_mask, n_qubits):
+    label = ''
+    for q in range(n_qubits-1, -1, -1):
+        x, z = x_mask >> q & 1, z_mask >> q & 1
+        label += 'IXZY'[x + 2*z]
+    return label
+
+
+class PauliHamiltonian:
+    """
+    Pauli-sum Hamiltonian evaluated with bitwise kernels in O(terms * 2^n).
+
+    Terms are grouped by x_mask on first use of the kernels:
+    - the x_mask == 0 group (I/Z strings, e.g. the TFIM ZZ couplings) is
+      folded into one real diagonal, so it costs a single dot product;
+    - every other group is one "X-flip": <psi| flip_x (w_x * psi)>, where
+      w_x is a scalar when the group has no Z/Y part (e.g. the TFIM
+      transverse field) and a per-basis-state weight vector otherwise.
+    Building them lazily keeps a Hamiltonian of many qubits usable with the
+    MPS backend, which only reads paulis and coeffs (mpo()).
+    """
+    def __init__(self, paulis, coeffs, precision = 'double'):
+        self.paulis = [str(p) for p in paulis]
+        self.coeffs = np.asarray(coeffs, dtype=float)
+        if precision not in PRECISIONS:
+            raise ValueError(f'unknown precision {precision}')
+        self.precision = precision
+        self.state_dtype = PRECISIONS[precision][1]
+        self.reference = None
+        self.precision_error = 0.0
+        self._mpo = None
+        if len(self.paulis) == 0:
+            raise ValueError('a PauliHamiltonian needs at least one term')
+        self.n_qubits = len(self.paulis[0])
+        self.dim = 2**self.n_qubits
+        self.masks = []
+        for label in self.paulis:
+            if len(label) != self.n_qubits:
+                raise ValueError('all Pauli strings must act on the same number of qubits')
+            self.masks.append(label_to_masks(label))
+
+    @cached_property
+    def _index(self):
+        return np.arange(self.dim)
+
+    @cached_property
+    def _kernels(self):
+        """ (diagonal, flips) of the bitwise kernels, see the class docstring. """
+        real_dtype = PRECISIONS[self.precision][0]
+        groups = {}
+        for (x_mask, z_mask), c in zip(self.masks, self.coeffs):
+            groups.setdefault(x_mask, []).append((z_mask, c))
+
+        diagonal = np.zeros(self.dim)
+        flips = []
+        for x_mask, terms in groups.items():
+            if x_mask == 0:
+                for z_mask, c in terms:
+                    diagonal += c * _popcount_parity(self._index & z_mask)
+                continue
+            if all(z_mask == 0 for z_mask, _ in terms):
+                weight = float(sum(c for _, c in terms))
+            else:
+                weight = np.zeros(self.dim, dtype=complex)
+                for z_mask, c in terms:
+                    n_y = bin(x_mask & z_mask).count('1')
+                    weight += c * (1j**n_y) * _popcount_parity(self._index & z_mask)
+                weight = weight.real.astype(real_dtype) if not np.any(weight.imag) else weight.astype(self.state_dtype)
+            flips.append((x_mask, weight))
+        return diagonal.astype(real_dtype), flips
+
+    @property
+    def diagonal(self):
+        return self._kernels[0]
+
+    @property
+    def flips(self):
+        return self._kernels[1]
+
+    @property
+    def is_real(self):
+        return all(np.isrealobj(weight) for _, weight in self.flips)
+
+    def __len__(self):
+        return len(self.paulis)
+
+    def _flip(self, state, x_mask):
+        """ state[..., j ^ x_mask]; single-bit masks use a strided view instead of a gather. """
+        if x_mask & (x_mask - 1) == 0:
+            q = x_mask.bit_length() - 1
+            v = state.reshape(state.shape[:-1] + (-1, 2, 2**q))
+            return v[..., ::-1, :].reshape(state.shape)
+        return state[..., self._index ^ x_mask]
+
+    def expectation(self, state):
+        """ <state|H|state> for a normalised statevector. """
+        probs = state.real**2 + state.imag**2
+        energy = float(probs @ self.diagonal) if probs.dtype == np.float64 else float(np.sum(probs * self.diagonal, dtype=np.float64))
+        for x_mask, weight in self.flips:
+            if np.isscalar(weight):
+                energy += weight * _real_vdot(self._flip(state, x_mask), state)
+            else:
+                energy += _real_vdot(self._flip(state, x_mask), weight * state)
+        return energy
+
+    def expectation_density(self, rho):
+        """
+        Tr(H rho) for a (2^n, 2^n) density matrix: the diagonal against
+        rho[j, j] plus, per X-flip, w_x[j] against rho[j, j ^ x].
+        """
+        energy = float(self.diagonal @ np.diagonal(rho).real)
+        for x_mask, weight in self.flips:
+            energy += float(np.sum(weight * rho[self._index, self._index ^ x_mask]).real)
+        return energy
+
+    def mpo(self):
+        """
+        Matrix product operator of H, W[q] of shape (D_left, D_right, 2, 2) per
+        qubit q ([out, in] physical indices), built once. Bond states: 0 before
+        a term starts, 1 after it ended, plus one state per term that spans the
+        bond, so the open-chain TFIM has bond dimension 3 (4 with a periodic
+        coupling). The contraction starts in state 0 and ends in state 1.
+        """
+        if self._mpo is not None:
+            return self._mpo
+        n = self.n_qubits
+        matrices = {'I': np.eye(2), 'X': np.array([[0, 1], [1, 0]]),
+                    'Y': np.array([[0, -1j], [1j, 0]]), 'Z': np.diag([1, -1])}
+        terms = []
+        for label, c in zip(self.paulis, self.coeffs):
+            ops = label[::-1]
+            support = [q for q in range(n) if ops[q] != 'I'] or [0]
+            terms.append((ops, c, support[0], support[-1]))
+        # bond b is the one right of qubit b; bond -1 and n-1 are the boundaries
+        states = [{} for _ in range(n + 1)]
+        for t, (_, _, first, last) in enumerate(terms):
+            for b in range(first, last):
+                states[b + 1][t] = 2 + len(states[b + 1])
+        dims = [2 + len(st) for st in states]
+        mpo = []
+        for q in range(n):
+            W = np.zeros((dims[q], dims[q + 1], 2, 2), dtype=complex)
+            W[0, 0] = W[1, 1] = np.eye(2)
+            for t, (ops, c, first, last) in enumerate(terms):
+                if not first <= q <= last:
+                    continue
+                left = 0 if q == first else states[q][t]
+                right = 1 if q == last else states[q + 1][t]
+                W[left, right] += (c if q == first else 1) * matrices[ops[q]]
+            mpo.append(W)
+        self._mpo = mpo
+        return mpo
+
+    def check_precision(self, energies, reference_energies):
+        """ Verification mode: keeps the largest |energy - complex128 energy| seen. """
+        error = float(np.max(np.abs(np.asarray(energies) - reference_energies), initial=0.0))
+        self.precision_error = max(self.precision_error, error)
+
+    def expectation_batch(self, states):
+        """ <state_b|H|state_b> for every row of a (B, 2^n) array. """
+        return _real_vdot(states, self.matvec(states))
+
+    def matvec(self, state):
+        """ H|state> (on the last axis), computed with the same diagonal/X-flip grouping as expectation(). """
+        out = self.diagonal * state
+        for x_mask, weight in self.flips:
+            if np.isscalar(weight) and x_mask & (x_mask - 1) == 0:
+                q = x_mask.bit_length() - 1
+                shape = state.shape[:-1] + (-1, 2, 2**q)
+                out.reshape(shape)[...] += weight * state.reshape(shape)[..., ::-1, :]
+            else:
+                out += self._flip(weight * state, x_mask)
+        return out
+
+    def linear_operator(self):
+        """ scipy LinearOperator wrapping matvec, e.g. for eigsh. Real when H has no Y-odd terms. """
+        dtype = float if self.is_real else complex
+        return LinearOperator((self.dim, self.dim), matvec=lambda x: self.matvec(np.ravel(x)), dtype=dtype)
+
+    def ground_energy(self, dense_max_qubits = 8):
+        """
+        Lowest eigenvalue of H. Small systems use the dense spectrum, larger
+        ones a Lanczos solve (eigsh) on the matrix-free operator, so memory
+        stays linear in 2^n.
+        """
+        return self.extreme_eigvals(dense_max_qubits, highest = False)[0]
+
+    def extreme_eigvals(self, dense_max_qubits = 8, highest = True):
+        """ (lowest, highest) eigenvalue of H; highest is None when highest=False. """
+        if self.n_qubits <= dense_max_qubits:
+            eigvals = la.eigvalsh(self.to_dense())
+            return float(eigvals[0]), float(eigvals[-1]) if highest else None
+        op = self.linear_operator()
+        low = float(eigsh(op, k=1, which='SA', return_eigenvectors=False)[0])
+        if not highest:
+            return low, None
+        return low, float(eigsh(op, k=1, which='LA', return_eigenvectors=False)[0])
+
+    def to_dense(self):
+        """ Dense matrix, only meant for small systems and verification. """
+        mat = np.zeros((self.dim, self.dim), dtype=complex)
+        mat[self._index, self._index] = self.diagonal
+        for x_mask, weight in self.flips:
+            mat[self._index ^ x_mask, self._index] += weight
+        return mat
+
+    @classmethod
+    def from_dense(cls, matrix, tol=1e-12, precision = 'double'):
+        """
+        Compatibility converter for the dense 'hamiltonian' arrays in old
+        ham_data/*.npz files: c_P = Tr(P H) / 2^n for every Pauli string P.
+        For each x_mask, the 2^n coefficients over z_mask come out of one
+        Walsh-Hadamard transform of the diagonal H[j, j ^ x].
+        """
+        matrix = np.asarray(matrix)
+        dim = matrix.shape[0]
+        n_qubits = int(round(np.log2(dim)))
+        index = np.arange(dim)
+        paulis, coeffs = [], []
+        for x_mask in range(dim):
+            v = matrix[index, index ^ x_mask].astype(complex)
+            # Walsh-Hadamard transform: v[z] -> sum_j (-1)^popcount(j & z) v[j]
+            h = 1
+            while h < dim:
+                v = v.reshape(-1, 2, h)
+                v = np.stack((v[:, 0] + v[:, 1], v[:, 0] - v[:, 1]), axis=1).reshape(-1)
+                h *= 2
+            for z_mask in np.nonzero(np.abs(v) > tol*dim)[0]:
+                n_y = bin(x_mask & int(z_mask)).count('1')
+                c = v[z_mask] * (1j**n_y) / dim
+                paulis.append(masks_to_label(x_mask, int(z_mask), n_qubits))
+                coeffs.append(c.real)
+        return cls(paulis, coeffs, precision)
+
+    def save(self, path, **kw):
+        """ Writes the ham_data npz format: 'paulis', 'coeffs' plus any extra arrays (e.g. eigvals). """
+        np.savez(path, paulis=np.array(self.paulis), coeffs=self.coeffs, **kw)
+
+
+# (hamiltonian, eigvals) by (path, precision, verify), see load_hamiltonian
+_loaded = {}
+
+
+def load_hamiltonian(path, precision = 'double', verify = False):
+    """
+    Loads a ham_data/*.npz file and returns (PauliHamiltonian, eigvals).
+    Files in the Pauli format carry 'paulis' and 'coeffs'; older files
+    with a dense 'hamiltonian' matrix are converted on the fly.
+    precision is 'double' or 'single'; verify keeps a complex128 reference
+    for a single-precision one, see the module docstring.
+    Loaded once per process and (path, precision, verify); the eigvals are
+    read-only since every caller gets the same array.
+    """
+    key = (os.path.abspath(path), precision, verify)
+    if key not in _loaded:
+        ham = np.load(path)
+        if 'paulis' in ham.files:
+            hamiltonian = PauliHamiltonian(ham['paulis'], ham['coeffs'], precision)
+        else:
+            hamiltonian = PauliHamiltonian.from_dense(ham['hamiltonian'], precision = precision)
+        if verify and precision != 'double':
+            hamiltonian.reference = PauliHamiltonian(hamiltonian.paulis, hamiltonian.coeffs)
+        eigvals = ham['eigvals']
+        eigvals.setflags(write=False)
+        _loaded[key] = (hamiltonian, eigvals)
+    return _loaded[key]
+
+
+class HamiltonianFamily:
+    """
+    Hamiltonians H_k = sum_c weights[k, c] A_c over shared components A_c.
+
+    The terms of all members are collected by Pauli string into a (K, terms)
+    coefficient matrix, and terms whose coefficient columns are proportional
+    form one component: for a TFIM h-sweep (J fixed) all ZZ couplings are
+    one component and all X fields another, with weights (1, h_k / h_0).
+    expectations() computes <A_c> once per state, so the energies of the
+    whole family cost about as much as the energy of one member.
+    """
+    def __init__(self, hamiltonians, names = None):
+        self.members = list(hamiltonians)
+        if not self.members or not all(isinstance(h, PauliHamiltonian) for h in self.members):
+            raise ValueError('a HamiltonianFamily needs at least one PauliHamiltonian')
+        self.names = list(names) if names is not None else list(range(len(self.members)))
+        self.n_qubits = self.members[0].n_qubits
+        self.precision = self.members[0].precision
+        self.state_dtype = self.members[0].state_dtype
+        labels = list(dict.fromkeys(p for h in self.members for p in h.paulis))
+        column = {label: t for t, label in enumerate(labels)}
+        coeffs = np.zeros((len(self.members), len(labels)))
+        for k, h in enumerate(self.members):
+            if h.n_qubits != self.n_qubits:
+                raise ValueError('all members of a HamiltonianFamily must act on the same number of qubits')
+            np.add.at(coeffs[k], [column[p] for p in h.paulis], h.coeffs)
+        groups = {}
+        for t in range(len(labels)):
+            scale = coeffs[np.flatnonzero(coeffs[:, t])[0], t] if np.any(coeffs[:, t]) else 0.0
+            if scale == 0.0:
+                continue
+            direction = tuple(np.round(coeffs[:, t] / scale, 12))
+            groups.setdefault(direction, []).append((labels[t], scale))
+        self.components = [PauliHamiltonian([label for label, _ in terms], [c for _, c in terms], self.precision)
+                           for terms in groups.values()]
+        self.weights = np.array(list(groups.keys())).reshape(len(groups), len(self.members)).T
+
+    def __len__(self):
+        return len(self.members)
+
+    def expectations(self, state):
+        """ (K,) energies <state|H_k|state> of every member. """
+        return self.weights @ np.array([a.expectation(state) for a in self.components])
+
+    def expectations_batch(self, states):
+        """ (B, K) energies of every row of a (B, 2^n) array. """
+        return np.stack([a.expectation_batch(states) for a in self.components], axis=1) @ self.weights.T
+
+
+def load_hamiltonian_family(paths, precision = 'double', verify = False):
+    """ (HamiltonianFamily, list of eigvals) of several ham_data files, see load_hamiltonian. """
+    loaded = [load_hamiltonian(path, precision, verify) for path in paths]
+    return HamiltonianFamily([h for h, _ in loaded], paths), [eigvals for _, eigvals in loaded]
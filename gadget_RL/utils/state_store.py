@@ -0,0 +1,59 @@
+"""
+The env state in one preallocated buffer, updated in place.
+
+CircuitEnv.state is a (layers x rows x qubits) tensor whose first gate_rows
+rows are one-hot gate positions and whose remaining rows hold the angles.
+StateStore allocates it once per env; reset() zeroes it and every action
+sets one entry with add(layer, row, qubit), which also appends the position
+to a preallocated gate list. The compilers in environments/VQEs read the
+sorted gate list (gates()) instead of scanning the one-hot rows, and
+observation() copies the agent's view of the state (the whole buffer, or
+only the one-hot rows without angles) out of the buffer.
+
+The buffer is shared between steps, so everything that outlives a step
+(the observations handed to the agent, the replay memory) is a copy.
+"""
+import numpy as np
+import torch
+
+
+class StateStore:
+    def __init__(self, num_layers, num_rows, num_qubits, gate_rows, with_angles = True):
+        self.gate_rows = gate_rows
+        self.with_angles = with_angles
+        self.state = torch.zeros((num_layers, num_rows, num_qubits))
+        self.flat = self.state.view(-1)
+        # every layer holds at most one gate per qubit
+        self._gates = np.zeros((num_layers * num_qubits, 3), dtype=np.intp)
+        self._count = 0
+        self._sorted = None
+
+    def reset(self):
+        self.state.zero_()
+        self._count = 0
+        self._sorted = None
+        return self.state
+
+    def add(self, layer, row, qubit):
+        """ Sets the one-hot entry of a new gate. """
+        self.state[layer, row, qubit] = 1
+        self._gates[self._count] = layer, row, qubit
+        self._count += 1
+        self._sorted = None
+
+    def gates(self):
+        """ (layer, row, qubit) of every gate, sorted like np.nonzero of the one-hot rows. """
+        if self._sorted is None:
+            gates = self._gates[:self._count]
+            self._sorted = gates[np.lexsort(gates.T[::-1])]
+        return self._sorted
+
+    def __len__(self):
+        return self._count
+
+    def observation(self):
+        """ Copy of the flattened state, without the angle rows unless with_angles. """
+        if self.with_angles:
+            return self.flat.clone()
+        # reshape only copies a non-contiguous slice, with one layer it is a view of the buffer
+        return self.state[:, :self.gate_rows].reshape(-1).clone()
@@ -20,13 +20,15 @@ def get_config(config_name,experiment_name, path='configuration_files',
             floats = ['learning_rate',  'dropout', 'alpha', 
                       'beta', 'beta_incr', 
                       "shift_threshold_ball","succes_switch","tolearance_to_thresh","memory_reset_threshold",
-                      "fake_min_energy","_true_en"]
+                      "fake_min_energy","_true_en",
+                      "a", "c", "gamma", "lamda", "beta_1", "beta_2", "gadget_noise_prob", "mps_cutoff"]
             strings = ['ham_type', 'fn_type', 'geometry','method','agent_type',
                        "agent_class","init_seed","init_path","init_thresh","method",
-                       "mapping","optim_alg", "curriculum_type"]
+                       "mapping","optim_alg", "curriculum_type", "simulator", "gradient",
+                       "angle_cache_mode", "angle_cache_path", "angle_cache_key"]
             lists = ['episodes','neurons', 'accept_err','epsilon_decay',"epsilon_min",
                      "epsilon_decay",'final_gamma','memory_clean',
-                     'update_target_net', 'epsilon_restart', "thresholds", "switch_episodes"]
+                     'update_target_net', 'epsilon_restart', "thresholds", "switch_episodes", "ham_models"]
             if key in floats:
                 config_dict[sections].update({key: float(val)})
             elif key in strings: